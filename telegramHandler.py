@@ -1,22 +1,42 @@
-import boto3
-import requests
 import json
 import os
 import math
+import binascii
 import logging
 
 import telegramHandlerDBWriter
-from telegramHandlerHelper import sort_results_by_distance, filter_merchant_source_and_category, paginate_results, \
-    format_json_response, create_reply_keyboard_page_markup, update_source_filters
+import telegramHandlerClients
+import telegramHandlerCodec
+import telegramHandlerMetrics
+import telegramHandlerProfile
+import telegramHandlerUserCache
+import telegramHandlerRender
+from telegramHandlerDispatch import dispatch, dispatch_after, wait_for_dispatched
+from telegramHandlerHelper import sort_results_by_distance, filter_merchant_source_and_category, \
+    create_reply_keyboard_page_markup, update_source_filters, normalise_results, select_results_page, \
+    iterate_results_within_radius, complete_sort_by_distance, MAX_SEARCH_RADIUS, RADIUS_CHANGE
 
 # Global variables
 TOKEN = os.environ['TELEGRAM_BOT_TOKEN']
 CHEAPO_CHAT_ID = int(os.environ['CHEAPO_CHAT_ID'])
 REGISTRATION_PASSPHRASE = os.environ['REGISTRATION_PASSPHRASE']
-BASE_URL = "https://api.telegram.org/bot{}".format(TOKEN)
+TELEGRAM_API_URL = os.environ.get('TELEGRAM_API_URL', "https://api.telegram.org")  # Overridden to test against a local fake Bot API
+BASE_URL = "{}/bot{}".format(TELEGRAM_API_URL, TOKEN)
 SOURCE_DESC_NUM_MAP = {"ENTR": 1, "CITI": 2, "OCBC": 3}
 SOURCE_NUM_DESC_MAP = {1: "ENTR", 2: "CITI", 3: "OCBC"}
 MAX_NUM_RESULTS_PER_PAGE = 20
+RADIUS_FAST_PATH = os.environ.get('RADIUS_FAST_PATH', "false").lower() == "true"  # Serve radius changes from a MAX_SEARCH_RADIUS superset
+GEO_CELL_CACHE = os.environ.get('GEO_CELL_CACHE', "false").lower() == "true"  # Share geo query results between nearby searches
+LAZY_RESULT_SORT = os.environ.get('LAZY_RESULT_SORT', "false").lower() == "true"  # Sort the first page of a new search before replying, the rest in the cache write
+VIEW_STATE_UPDATES = telegramHandlerDBWriter.view_state_database_table is not None  # Write filter and radius changes apart from the result
+# The modules of the optional features below are only imported where their flag is checked, so that a cold start does not
+# load those that are disabled
+SPATIAL_INDEX = os.environ.get('SPATIAL_INDEX_SNAPSHOT') is not None  # Query a local merchant snapshot instead of queryGeoDatabase
+PREFETCH = False  # Prefetch the next page and radius step while the user reads a reply, set by the long polling worker only
+PAYLOAD_STREAMING = os.environ.get('PAYLOAD_STREAMING', "false").lower() == "true"  # Parse the geo database payload merchant by merchant, dropping other categories
+TELEGRAM_SCHEDULER = os.environ.get('TELEGRAM_SCHEDULER', "false").lower() == "true"  # Rate limit, retry and coalesce the Bot API calls
+SESSION_CACHE = os.environ.get('SESSION_CACHE', "false").lower() == "true"  # Serve the results this container wrote or read last from memory
+CACHE_WRITE_STAGES = ["write_results_cache", "write_view_state"]  # Read by the next tap, which may reach another container, so replies wait for them
 
 # Logging configurations
 LOGGING_LEVEL = int(os.environ['LOGGING_LEVEL'])
@@ -25,20 +45,60 @@ logger.setLevel(LOGGING_LEVEL)
 
 
 # Invoke a lambda function and return the json data returned by the lambda function
-def invoke_lambda_function(function_name, invocation_type, payload_string):
-    lambda_client = boto3.client('lambda')
-    invoke_response = lambda_client.invoke(FunctionName=function_name, InvocationType=invocation_type,
-                                           Payload=payload_string)
-    return json.loads(invoke_response['Payload'].read())
+# If payload_parser is given, it parses the returned payload from its stream instead
+def invoke_lambda_function(function_name, invocation_type, payload_string, payload_parser=None):
+    lambda_client = telegramHandlerClients.get_lambda_client()
+    with telegramHandlerMetrics.span("invoke_" + function_name):
+        invoke_response = lambda_client.invoke(FunctionName=function_name, InvocationType=invocation_type,
+                                               Payload=payload_string)
+        if payload_parser is not None:
+            return payload_parser(invoke_response['Payload'])
+        return json.loads(invoke_response['Payload'].read())
+
+
+# Query the merchants around the search center, within its searchRadius if given
+def query_geo_database(search_center_details):
+    if SPATIAL_INDEX:
+        import telegramHandlerSpatialIndex
+        json_response = telegramHandlerSpatialIndex.query_spatial_index(search_center_details)
+        if json_response is not None:  # None if the snapshot could not be loaded
+            return json_response
+    if GEO_CELL_CACHE:
+        import telegramHandlerGeoCache
+        return telegramHandlerGeoCache.query_with_geo_cell_cache(search_center_details, invoke_geo_database)
+    return invoke_geo_database(search_center_details)
+
+
+def invoke_geo_database(search_center_details):
+    payload_parser = None
+    if PAYLOAD_STREAMING:
+        import telegramHandlerPayload
+        payload_parser = telegramHandlerPayload.parse_geo_payload
+    return invoke_lambda_function("queryGeoDatabase", "RequestResponse", json.dumps(search_center_details), payload_parser)
+
+
+# Post to the Telegram Bot API over the shared keep-alive session
+def post_to_bot_api(function_name, data):
+    with telegramHandlerMetrics.span("telegram_" + function_name.lstrip("/")):
+        return telegramHandlerClients.get_http_session().post(BASE_URL + function_name, data)
+
+
+# Post to the Telegram Bot API, through the outbound scheduler if enabled, where edits are sent in the background and
+# None is returned for them
+def post_to_telegram(function_name, data):
+    if TELEGRAM_SCHEDULER:
+        import telegramHandlerOutbound
+        return telegramHandlerOutbound.send(function_name, data, post_to_bot_api)
+    return post_to_bot_api(function_name, data)
 
 
 def authenticate_user(data, sender_telegram_id, first_name):
-    if telegramHandlerDBWriter.get_from_user_table(sender_telegram_id) is None:
+    if not telegramHandlerUserCache.is_registered_user(sender_telegram_id, telegramHandlerDBWriter.get_from_user_table):
         if "text" in data["message"] and REGISTRATION_PASSPHRASE in str(data["message"]["text"]).lower():
             if telegramHandlerDBWriter.write_to_user_table(sender_telegram_id, first_name) == True:
                 response = "Registration for " + str(sender_telegram_id) + " " + first_name + " successful."
                 data = {"text": response.encode("utf8"), "chat_id": sender_telegram_id}
-                requests.post(BASE_URL + "/sendMessage", data)
+                post_to_telegram("/sendMessage", data)
                 logger.info(str(sender_telegram_id) + " " + first_name + " successfully registered.")
         return False
     return True
@@ -46,13 +106,14 @@ def authenticate_user(data, sender_telegram_id, first_name):
 
 def acknowledge_callback_query(callback_query_id):
     reply_data = {"callback_query_id": callback_query_id}
-    requests.post(BASE_URL + "/answerCallbackQuery", reply_data)
+    post_to_telegram("/answerCallbackQuery", reply_data)
     logger.info("Callback query acknowledged.")
     return {"statusCode": 200}
 
 
 def reply_or_edit_message_text(json_response, current_page, sources_filter, sources_available, source_chat_id, source_message_id, mode):
-    markdown_reply = format_json_response(json_response)
+    markdown_reply = telegramHandlerRender.render_page(json_response)
+    telegramHandlerMetrics.put_size("ReplyLength", len(markdown_reply))
     reply_markup = create_reply_keyboard_page_markup(current_page, int(math.ceil(float(json_response['totalItems']) / float(MAX_NUM_RESULTS_PER_PAGE))), int(json_response['searchRadius']), sources_filter, sources_available)
     reply_data = {"chat_id": source_chat_id, "text": markdown_reply.encode("utf8"), "parse_mode": "markdown", "reply_markup": json.dumps(reply_markup)}
     if mode == "REPLY":
@@ -61,17 +122,76 @@ def reply_or_edit_message_text(json_response, current_page, sources_filter, sour
     elif mode == "EDIT":
         reply_data["message_id"] = source_message_id
         function_name = "/editMessageText"
-    post_reply = requests.post(BASE_URL + function_name, reply_data)
+    post_reply = post_to_telegram(function_name, reply_data)
     logger.info("Message replied / edited.")
-    logger.debug(str(post_reply.text))
+    if post_reply is not None:
+        logger.debug(str(post_reply.text))
 
 
-def update_result_cache(json_response, sources_filter, sources_available, source_chat_id, search_center_details=None):
+# Cache the result of the chat, the merchants a lazy sort left unsorted are sorted here, while the reply is sent
+def write_results_cache(chat_id, json_response):
+    if SESSION_CACHE:
+        import telegramHandlerSessionCache
+        return telegramHandlerSessionCache.put_result(chat_id, complete_sort_by_distance(json_response),
+                                                      telegramHandlerDBWriter.write_versioned_result_to_results_cache,
+                                                      ["viewVersion"] if VIEW_STATE_UPDATES else [])
+    return telegramHandlerDBWriter.write_to_results_cache(chat_id, complete_sort_by_distance(json_response))
+
+
+# Write the view state of the cached result of the chat, e.g. after a source filter toggle
+def write_view_state(chat_id, json_response):
+    if SESSION_CACHE:
+        import telegramHandlerSessionCache
+        return telegramHandlerSessionCache.put_view_state(chat_id, json_response,
+                                                          telegramHandlerDBWriter.write_view_state_to_results_cache)
+    return telegramHandlerDBWriter.write_view_state_to_results_cache(chat_id, json_response)
+
+
+# Read the cached result of the chat from dynamodb, None if the chat has none
+def read_results_cache(chat_id):
+    item = telegramHandlerDBWriter.get_from_result_cache(chat_id)
+    return telegramHandlerCodec.decode_result(item) if item is not None else None
+
+
+# Prefetch the page after current_page and the search of the next radius step of the cached result, the taps that
+# usually follow a reply, unless the radius step is served from the cached merchants or beyond MAX_SEARCH_RADIUS
+def prefetch_next_steps(chat_id, json_response, current_page):
+    import telegramHandlerPrefetch
+    next_search_center_details = None
+    next_radius = int(json_response['searchRadius']) + RADIUS_CHANGE
+    if next_radius <= MAX_SEARCH_RADIUS and not (RADIUS_FAST_PATH and next_radius <= json_response.get('fetchedRadius', 0)):
+        next_search_center_details = {"latitude": json_response['searchCenterLatitude'],
+                                      "longitude": json_response['searchCenterLongitude'],
+                                      "searchRadius": MAX_SEARCH_RADIUS if RADIUS_FAST_PATH else next_radius}
+    telegramHandlerPrefetch.prefetch_next_steps(chat_id, json_response, current_page, next_search_center_details,
+                                                prefetch_search)
+
+
+# Search and parse the merchants ahead of the callback, update_result_cache passes the parsed records through
+def prefetch_search(search_center_details):
+    return normalise_results(query_geo_database(search_center_details))
+
+
+def update_result_cache(json_response, sources_filter, sources_available, source_chat_id, search_center_details=None, search_radius=None):
     if search_center_details is not None:  # If it is an update to radius, i.e. new search, cache the entire search result
+        fetched_radius = json_response.get('fetchedRadius')  # Set if the result is a superset shared with nearby searches
+        json_response = normalise_results(json_response)  # Parse every merchant once, the cached records are reused by every callback
         json_response, sources_available = filter_merchant_source_and_category(json_response)  # Sources available can change w the new search
-        json_response = sort_results_by_distance(json_response, search_center_details)
+        telegramHandlerMetrics.put_size("MerchantCount", len(json_response['locations']))
+        json_response = sort_results_by_distance(json_response, search_center_details,
+                                                 top_k=MAX_NUM_RESULTS_PER_PAGE if LAZY_RESULT_SORT else None)
+        json_response['searchId'] = binascii.hexlify(os.urandom(16)).decode("ascii")  # Pages rendered for a previous search of the chat are not reused
+        if RADIUS_FAST_PATH or fetched_radius is not None:
+            json_response['fetchedRadius'] = fetched_radius or json_response['searchRadius']  # Smaller radii are served from these merchants
+    if search_radius is not None:  # Radius served from the cached merchants
+        json_response['searchRadius'] = search_radius
+    if 'fetchedRadius' in json_response:  # Only the merchants within the search radius are available
+        sources_available = list(set(merchant['source'] for merchant in iterate_results_within_radius(json_response)))
     json_response = update_source_filters(json_response, sources_filter, sources_available)
-    telegramHandlerDBWriter.write_to_results_cache(source_chat_id, json_response)
+    if VIEW_STATE_UPDATES and search_center_details is None and json_response.get('searchId') is not None:  # Same merchants
+        dispatch("write_view_state", write_view_state, source_chat_id, json_response)
+    else:
+        dispatch("write_results_cache", write_results_cache, source_chat_id, json_response)  # In parallel with the reply
     return sources_available, json_response  # Return the updated sources_available list and the cached json_response
 
 
@@ -81,8 +201,21 @@ def process_callback_query(data):
     callback_query_id = data["callback_query"]["id"]
     callback_query_data = data["callback_query"]["data"]
 
-    cached_message = telegramHandlerDBWriter.get_from_result_cache(source_chat_id)
-    cached_json_reply = json.loads(cached_message['Result'])
+    dispatch("answer_callback_query", acknowledge_callback_query, callback_query_id)  # Stop the button spinner right away
+
+    if SESSION_CACHE:  # Only the version is read from dynamodb if this container wrote or read the chat's result last
+        import telegramHandlerSessionCache
+        cached_json_reply = telegramHandlerSessionCache.get_result(source_chat_id, read_results_cache,
+                                                                   telegramHandlerDBWriter.get_result_cache_versions)
+    else:
+        cached_json_reply = read_results_cache(source_chat_id)
+    if cached_json_reply is None:  # e.g. its write failed, or the item was removed
+        telegramHandlerMetrics.add_count("MissingResults")
+        logger.warning(str(source_chat_id) + " has no cached result, asking for the location again.")
+        data = {"text": ("This search is no longer available, send me a location to search again!").encode("utf8"), "chat_id": source_chat_id}
+        post_to_telegram("/sendMessage", data)
+        return {"statusCode": 200}
+    telegramHandlerMetrics.put_size("MerchantCount", len(cached_json_reply['locations']))
     data_sources = cached_json_reply['sourcesFilter']
     original_sources_available = cached_json_reply['sourcesAvailable']
     search_center_details = {"latitude": cached_json_reply["searchCenterLatitude"],
@@ -94,23 +227,35 @@ def process_callback_query(data):
         callback_query_data = int(callback_query_data)
 
         if callback_query_data >= 250:  # If it involves changes to the radius
+            telegramHandlerMetrics.set_property("MessageType", "radius")
             search_radius = callback_query_data
-            search_center_details['searchRadius'] = int(search_radius)
 
-            # Execute another search with the new radius
-            json_response = invoke_lambda_function("queryGeoDatabase", "RequestResponse", json.dumps(search_center_details))
-            original_sources_available, json_response = update_result_cache(json_response, data_sources, original_sources_available, source_chat_id, search_center_details=search_center_details)
+            if RADIUS_FAST_PATH and search_radius <= cached_json_reply.get('fetchedRadius', 0):  # Already fetched, no new search needed
+                json_response = cached_json_reply
+                original_sources_available, json_response = update_result_cache(json_response, data_sources, original_sources_available, source_chat_id, search_radius=search_radius)
+            else:
+                # Execute another search with the new radius, or with the largest radius so that later changes are served from the cache
+                search_center_details['searchRadius'] = MAX_SEARCH_RADIUS if RADIUS_FAST_PATH else int(search_radius)
+                json_response = None
+                if PREFETCH:
+                    import telegramHandlerPrefetch
+                    json_response = telegramHandlerPrefetch.get_prefetched_search(search_center_details)
+                if json_response is None:
+                    json_response = query_geo_database(search_center_details)
+                original_sources_available, json_response = update_result_cache(json_response, data_sources, original_sources_available, source_chat_id, search_center_details=search_center_details, search_radius=search_radius if RADIUS_FAST_PATH else None)
 
         else:  # If its moving to the next page
+            telegramHandlerMetrics.set_property("MessageType", "page")
             current_page = callback_query_data  # For moving to the next page, dont reset the page number
             json_response = cached_json_reply
 
     else:  # If filter of the data source
+        telegramHandlerMetrics.set_property("MessageType", "filter")
         callback_query_data = str(callback_query_data)
 
         # If it is the last filter remaining and callback query request to turn it off, or if the filter is not to be displayd, ignore it
         if (len(data_sources) <= 1 and SOURCE_DESC_NUM_MAP.get(callback_query_data) in data_sources) or callback_query_data == "NIL":
-            return acknowledge_callback_query(callback_query_id)
+            return {"statusCode": 200}
 
         # Toggle the filter
         if SOURCE_DESC_NUM_MAP.get(callback_query_data) not in data_sources:
@@ -124,15 +269,96 @@ def process_callback_query(data):
     logger.debug("Callback query task defined.")
     logger.debug(json_response)
 
-    json_response, sources_available = filter_merchant_source_and_category(json_response, data_sources)
-    json_response = sort_results_by_distance(json_response, search_center_details)
-    json_response = paginate_results(json_response, current_page)
+    json_page = None
+    if PREFETCH and current_page > 1:  # Only the next pages are prefetched
+        import telegramHandlerPrefetch
+        json_page = telegramHandlerPrefetch.get_prefetched_page(json_response, current_page, data_sources)
+    if json_page is None:
+        json_page = select_results_page(json_response, current_page, data_sources, search_center_details)
+    json_page, sources_available = json_page
+
+    dispatch_after(CACHE_WRITE_STAGES, "edit_message_text", reply_or_edit_message_text, json_page, current_page, sources_available, original_sources_available, source_chat_id, source_message_id, "EDIT")
+    if PREFETCH:
+        prefetch_next_steps(source_chat_id, json_response, current_page)
+
+    return {"statusCode": 200}
+
+
+# Process a single telegram update, the stages it dispatched are waited for by the caller and errors are raised
+def process_update(data):
+    if "callback_query" in data:
+        telegramHandlerMetrics.set_property("MessageType", "callback")
+        return process_callback_query(data)
+
+    # If it is replying to a message not sent by the chatbot, ignore it
+    if "reply_to_message" in data["message"]:
+        if data["message"]["reply_to_message"]["from"]["id"] != CHEAPO_CHAT_ID:
+            telegramHandlerMetrics.set_property("MessageType", "ignored")
+            logger.debug("Message not from Cheapo.")
+            return {"statusCode": 200}
+
+    sender_telegram_id = data["message"]["from"]["id"]
+    chat_id = data["message"]["chat"]["id"]
+    chat_type = data["message"]["chat"]["type"]
+    source_message_id = data["message"]["message_id"]
+    first_name = data["message"]["from"]["first_name"]  # Reply the user with his/her details
 
-    reply_or_edit_message_text(json_response, current_page, sources_available, original_sources_available, source_chat_id, source_message_id, "EDIT")
+    if authenticate_user(data, sender_telegram_id, first_name) is False:
+        telegramHandlerMetrics.set_property("MessageType", "unregistered")
+        return {"statusCode": 200}
 
-    return acknowledge_callback_query(callback_query_id)
+    message = data["message"]
+
+    if "text" in message:
+        telegramHandlerMetrics.set_property("MessageType", "text")
+        logger.debug("Text message detected.")
+        if chat_type == "group" and str(message["text"]).lower() == "/hello":
+            data = {"text": ("Hello I am Cheapo! Reply this message to talk to me!").encode("utf8"), "chat_id": chat_id, "reply_to_message_id": source_message_id}
+            post_to_telegram("/sendMessage", data)
+        else:
+            data = {"text": (" Hello I am Cheapo! Send me a location to get started!").encode("utf8"), "chat_id": chat_id, "reply_to_message_id": source_message_id}
+            post_to_telegram("/sendMessage", data)
+        logger.debug("Text message processed.")
+
+    if "location" in message:
+        telegramHandlerMetrics.set_property("MessageType", "location")
+        logger.debug("Location message detected.")
+        if PREFETCH:  # The prefetches for the previous location of the chat are of no use anymore
+            import telegramHandlerPrefetch
+            telegramHandlerPrefetch.cancel_prefetches(chat_id)
+        json_response = query_geo_database(message["location"])
+
+        # There is no filter for the initial result, hence is all possible sources
+        sources_available, json_response = update_result_cache(json_response, SOURCE_DESC_NUM_MAP.values(),
+                                                               SOURCE_DESC_NUM_MAP.values(), chat_id,
+                                                               search_center_details=message["location"])
+        json_page = select_results_page(json_response, 1)[0]
+        dispatch_after(CACHE_WRITE_STAGES, "send_message_text", reply_or_edit_message_text, json_page, 1, sources_available, sources_available, chat_id, source_message_id, "REPLY")
+        if PREFETCH:
+            prefetch_next_steps(chat_id, json_response, 1)
+        logger.debug("Location message processed.")
+
+    return {"statusCode": 200}
+
+
+# Write the results the session cache still holds back, the reply was sent already so errors are only logged
+def flush_session_writes():
+    import telegramHandlerSessionCache
+    try:
+        telegramHandlerSessionCache.flush_session_writes()
+    except Exception as e:
+        logger.error("Unable to write the session results: " + type(e).__name__ + ": " + str(e))
+        telegramHandlerMetrics.add_count("Errors")
+
+
+# Chat of the update of a webhook event, to profile the invocations of the chats of PROFILE_CHAT_IDS
+def get_webhook_chat_ids(event):
+    data = json.loads(event["body"])
+    return [(data["callback_query"]["message"] if "callback_query" in data else data["message"])["chat"]["id"]]
 
 
+@telegramHandlerMetrics.instrumented_handler
+@telegramHandlerProfile.profiled_handler(get_webhook_chat_ids)
 def lambda_handler(event, context):
     try:
         logger.info("Starting Lambda Handler")
@@ -141,51 +367,27 @@ def lambda_handler(event, context):
         logger.debug("Event object received:")
         logger.debug(event)
 
-        if "callback_query" in data:
-            return process_callback_query(data)
+        process_update(data)
 
-        # If it is replying to a message not sent by the chatbot, ignore it
-        if "reply_to_message" in data["message"]:
-            if data["message"]["reply_to_message"]["from"]["id"] != CHEAPO_CHAT_ID:
-                logger.debug("Message not from Cheapo.")
-                return {"statusCode": 200}
+    except Exception as e:  # Answer 200 so that telegram does not retry the update, the traceback is logged instead
+        logger.exception("Unable to process the update: " + type(e).__name__ + ": " + str(e))
+        telegramHandlerMetrics.add_count("Errors")
+        telegramHandlerMetrics.set_property("ErrorType", type(e).__name__)
 
-        sender_telegram_id = data["message"]["from"]["id"]
-        chat_id = data["message"]["chat"]["id"]
-        chat_type = data["message"]["chat"]["type"]
-        source_message_id = data["message"]["message_id"]
-        first_name = data["message"]["from"]["first_name"]  # Reply the user with his/her details
-
-        if authenticate_user(data, sender_telegram_id, first_name) is False:
-            return {"statusCode": 200}
-
-        message = data["message"]
-
-        if "text" in message:
-            logger.debug("Text message detected.")
-            reply_url = BASE_URL + "/sendMessage"
-            if chat_type == "group" and str(message["text"]).lower() == "/hello":
-                data = {"text": ("Hello I am Cheapo! Reply this message to talk to me!").encode("utf8"), "chat_id": chat_id, "reply_to_message_id": source_message_id}
-                requests.post(reply_url, data)
-            else:
-                data = {"text": (" Hello I am Cheapo! Send me a location to get started!").encode("utf8"), "chat_id": chat_id, "reply_to_message_id": source_message_id}
-                requests.post(reply_url, data)
-            logger.debug("Text message processed.")
-
-        if "location" in message:
-            logger.debug("Location message detected.")
-            json_response = invoke_lambda_function("queryGeoDatabase", "RequestResponse", json.dumps(message["location"]))
-
-            # There is no filter for the initial result, hence is all possible sources
-            sources_available, json_response = update_result_cache(json_response, SOURCE_DESC_NUM_MAP.values(),
-                                                                   SOURCE_DESC_NUM_MAP.values(), chat_id,
-                                                                   search_center_details=message["location"])
-            json_response = paginate_results(json_response, 1)
-            reply_or_edit_message_text(json_response, 1, sources_available, sources_available, chat_id, source_message_id, "REPLY")
-            logger.debug("Location message processed.")
-
-    except Exception as e:
-        logger.error(str(e))
+    wait_for_dispatched()  # The container is frozen once the handler returns, finish every dispatched stage before that
+    if SESSION_CACHE:
+        flush_session_writes()
+    if TELEGRAM_SCHEDULER:
+        import telegramHandlerOutbound
+        telegramHandlerOutbound.wait_for_sent()
 
     logger.info("Terminating Lambda Handler")
-    return {"statusCode": 200}
\ No newline at end of file
+    return {"statusCode": 200}
+
+# Scheduled entry point, writes the bloom snapshot of the registered users to USER_BLOOM_SNAPSHOT, e.g. on a shared EFS mount
+@telegramHandlerMetrics.instrumented_handler
+def user_snapshot_handler(event, context):
+    telegramHandlerMetrics.set_property("MessageType", "user_snapshot")
+    telegramHandlerUserCache.write_bloom_snapshot(telegramHandlerDBWriter.scan_user_table_ids(),
+                                                  telegramHandlerUserCache.USER_BLOOM_SNAPSHOT)
+    return {"statusCode": 200}
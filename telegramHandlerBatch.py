@@ -0,0 +1,140 @@
+from collections import OrderedDict
+import json
+import os
+import threading
+import logging
+
+import telegramHandler
+import telegramHandlerDBWriter
+import telegramHandlerMetrics
+import telegramHandlerProfile
+import telegramHandlerUserCache
+from telegramHandlerDispatch import wait_for_dispatched
+
+# Batch configurations
+BATCH_CHAT_CONCURRENCY = int(os.environ.get('BATCH_CHAT_CONCURRENCY', 4))  # Chats processed at the same time, 0 processes them in turn
+
+logger = logging.getLogger()  # Configured by telegramHandler
+
+# The pool is kept at module level so that its threads are reused across invocations on a warm container
+# It is separate from the dispatch pool, as the chats wait for the stages they dispatch
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def _get_pool():
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                from multiprocessing.pool import ThreadPool
+                _pool = ThreadPool(BATCH_CHAT_CONCURRENCY)
+    return _pool
+
+
+# Return the (item identifier, update) of every update in the event, either SQS records with the webhook body of an
+# update, or {"updates": [...]} with the updates themselves, e.g. from getUpdates, identified by their update_id
+def parse_batch_event(event):
+    if "Records" in event:
+        return [(record["messageId"], record["body"]) for record in event["Records"]]
+    return [(str(update.get("update_id", index)), update) for index, update in enumerate(event["updates"])]
+
+
+def get_chat_id(update):
+    if "callback_query" in update:
+        return update["callback_query"]["message"]["chat"]["id"]
+    return update["message"]["chat"]["id"]
+
+
+# Chats of the updates of a batch event, to profile the batches with a chat of PROFILE_CHAT_IDS
+def get_batch_chat_ids(event):
+    return [get_chat_id(json.loads(update) if not isinstance(update, dict) else update)
+            for item_identifier, update in parse_batch_event(event)]
+
+
+# Look up every sender that is not cached yet with a single BatchGetItem, instead of a GetItem per update
+def prime_user_cache(updates):
+    telegram_ids = set(update["message"]["from"]["id"] for update in updates if "message" in update)
+    uncached_ids = telegramHandlerUserCache.get_uncached_users(telegram_ids)
+    if len(uncached_ids) == 0:
+        return
+    try:
+        items, unprocessed_ids = telegramHandlerDBWriter.batch_get_from_user_table(uncached_ids)
+    except Exception as e:  # Every update falls back to its own lookup
+        logger.warning("Unable to look up " + str(len(uncached_ids)) + " users together: " + str(e))
+        return
+    telegramHandlerUserCache.prime_users(set(uncached_ids) - set(unprocessed_ids), items)
+
+
+# Process the updates of a chat in order, and return the item identifiers of those that failed
+# Once an update fails, the later updates of the chat are not processed and fail as well, so that they are retried in order
+def process_chat_updates(chat_id, identified_updates, metrics_record=None):
+    failed_identifiers = []
+    with telegramHandlerMetrics.use_record(metrics_record):
+        telegramHandlerDBWriter.coalesce_results(chat_id)
+        for item_identifier, update in identified_updates:
+            if failed_identifiers:
+                failed_identifiers.append(item_identifier)
+                continue
+            try:
+                telegramHandler.process_update(update)
+                succeeded = wait_for_dispatched()
+            except Exception as e:
+                logger.exception("Unable to process update " + item_identifier + ": " + type(e).__name__ + ": " + str(e))
+                wait_for_dispatched()
+                succeeded = False
+            if not succeeded:
+                telegramHandlerMetrics.add_count("Errors")
+                failed_identifiers.append(item_identifier)
+
+        try:
+            if telegramHandler.SESSION_CACHE:
+                import telegramHandlerSessionCache
+                telegramHandlerSessionCache.flush_session_writes(chat_id)
+            telegramHandlerDBWriter.flush_coalesced_results(chat_id)
+            if telegramHandler.SESSION_CACHE:  # Its view state may have been written without a version
+                import telegramHandlerSessionCache
+                telegramHandlerSessionCache.invalidate_result(chat_id)
+        except Exception as e:  # The last state of the chat is lost, retry its last update
+            logger.exception("Unable to write " + str(chat_id) + "'s results: " + str(e))
+            if not failed_identifiers:
+                failed_identifiers.append(identified_updates[-1][0])
+    return failed_identifiers
+
+
+# Entry point for a batch of updates, e.g. from an SQS queue with ReportBatchItemFailures enabled
+# Chats are processed concurrently, the updates of each chat in turn and in the order of the batch, and the cached
+# result of each chat is read once and written once. Returns the updates to retry in the SQS batchItemFailures format.
+@telegramHandlerMetrics.instrumented_handler
+@telegramHandlerProfile.profiled_handler(get_batch_chat_ids)
+def batch_handler(event, context):
+    logger.info("Starting Batch Handler")
+    chats = OrderedDict()  # Chat id to its (item identifier, update), in the order of the batch
+
+    for item_identifier, update in parse_batch_event(event):
+        try:
+            update = json.loads(update) if not isinstance(update, dict) else update
+            chats.setdefault(get_chat_id(update), []).append((item_identifier, update))
+        except (ValueError, KeyError, TypeError) as e:  # Retrying would not help, like lambda_handler it is only logged
+            logger.error("Skipping update " + item_identifier + ", it is not a message or callback query: " + str(e))
+    telegramHandlerMetrics.set_property("MessageType", "batch")
+    telegramHandlerMetrics.put_size("BatchSize", sum(len(identified_updates) for identified_updates in chats.values()))
+    telegramHandlerMetrics.put_size("BatchChats", len(chats))
+
+    prime_user_cache([update for identified_updates in chats.values() for item_identifier, update in identified_updates])
+
+    metrics_record = telegramHandlerMetrics.get_current_record()
+    profile_session = telegramHandlerProfile.get_current_session()
+    if BATCH_CHAT_CONCURRENCY > 0 and len(chats) > 1:
+        chat_failures = _get_pool().map(lambda chat: telegramHandlerProfile.run_in_session(
+            profile_session, process_chat_updates, chat[0], chat[1], metrics_record), chats.items())
+    else:
+        chat_failures = [process_chat_updates(chat_id, identified_updates, metrics_record)
+                         for chat_id, identified_updates in chats.items()]
+
+    if telegramHandler.TELEGRAM_SCHEDULER:  # The edits of the chats are still being sent
+        import telegramHandlerOutbound
+        telegramHandlerOutbound.wait_for_sent()
+    failed_identifiers = [item_identifier for failures in chat_failures for item_identifier in failures]
+    logger.info("Terminating Batch Handler, " + str(len(failed_identifiers)) + " updates failed")
+    return {"batchItemFailures": [{"itemIdentifier": item_identifier} for item_identifier in failed_identifiers]}
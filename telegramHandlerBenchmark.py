@@ -0,0 +1,1228 @@
+import argparse
+import io
+import json
+import logging
+import math
+import os
+import random
+import re
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import timeit
+
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urlparse import parse_qs
+except ImportError:  # Python 3
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import parse_qs
+
+# The handler modules read their configurations from the environment on import, the fakes stand in for these backends
+BENCHMARK_ENVIRONMENT = {'LOGGING_LEVEL': "40", 'TELEGRAM_BOT_TOKEN': "benchmark", 'CHEAPO_CHAT_ID': "1",
+                         'REGISTRATION_PASSPHRASE': "benchmark", 'AWS_DB_TYPE': "dynamodb",
+                         'AWS_DB_REGION': "ap-southeast-1", 'CACHE_TABLE_NAME': "ResultCache",
+                         'USER_TABLE_NAME': "UserTable"}
+for environment_name, environment_value in BENCHMARK_ENVIRONMENT.items():
+    os.environ.setdefault(environment_name, environment_value)
+
+import telegramHandlerHelper
+import telegramHandlerDistance
+import telegramHandlerCodec
+import telegramHandlerRender
+
+# Benchmark configurations
+SEARCH_CENTER = {"latitude": 1.2838, "longitude": 103.8591}  # Marina Bay
+SEARCH_RADIUS = 5000
+MERCHANT_SET_SIZES = [100, 1000, 10000]
+OFFER_DESCRIPTIONS = ["Get SGD10 return voucher with min. spend", "15% off total bill", "SGD5 off a la carte menu",
+                      "1-for-1 main courses", "Complimentary dessert with every main course ordered during dinner "
+                                              "on weekdays, not valid with other promotions or on public holidays"]
+
+
+# Create num_merchants merchants in the dynamodb format returned by queryGeoDatabase, spread around the center
+def create_synthetic_merchants(num_merchants, center_lat_lng=SEARCH_CENTER, radius=SEARCH_RADIUS, seed=0):
+    generator = random.Random(seed)
+    degree_radius = radius / 111320.0
+    merchants = []
+    for i in range(num_merchants):
+        latitude = center_lat_lng['latitude'] + generator.uniform(-degree_radius, degree_radius)
+        longitude = center_lat_lng['longitude'] + generator.uniform(-degree_radius, degree_radius)
+        additional_details = {"SourceWebsite": "https://example.com/merchant/" + str(i),
+                              "OfferDetails": generator.choice(OFFER_DESCRIPTIONS)}
+        merchants.append({'Name': {'S': "Merchant " + str(i)},
+                          'Type': {'N': str(generator.choice([1, 1, 1, 2]))},
+                          'Source': {'N': str(generator.randint(1, 3))},
+                          'geoJson': {'S': json.dumps({"type": "Point", "coordinates": [longitude, latitude]})},
+                          'AdditionalDetails': {'S': json.dumps(additional_details)}})
+    return {'searchRadius': radius, 'locations': merchants}
+
+
+# Return the best time in milliseconds of running function, after repeating it the given number of times
+def time_function(function, repeat=5, number=1):
+    return min(timeit.repeat(function, repeat=repeat, number=number)) / number * 1000.0
+
+
+def print_result(benchmark, size, variant, milliseconds):
+    print("{:<12} {:>7} {:<34} {:>10.3f} ms".format(benchmark, size, variant, milliseconds))
+
+
+# A. Distance Benchmarks #########
+
+# The sorting path before batching: one geopy geodesic call per merchant
+def _sort_results_by_distance_scalar(json_response, center_lat_lng):
+    location_temp_arr = []
+    for merchant in json_response['locations']:
+        coordinates = json.loads(str(merchant['geoJson']['S']))
+        distance = telegramHandlerHelper.compute_distance(coordinates['coordinates'][1], coordinates['coordinates'][0],
+                                                          center_lat_lng['latitude'], center_lat_lng['longitude'])
+        location_temp_arr.append((distance, merchant))
+    location_temp_arr.sort(key=lambda tup: tup[0])
+    return [merchant for distance, merchant in location_temp_arr]
+
+
+def benchmark_distance(sizes):
+    for size in sizes:
+        merchants = create_synthetic_merchants(size)['locations']
+        coordinates = [json.loads(merchant['geoJson']['S'])['coordinates'] for merchant in merchants]
+        latitudes, longitudes = [c[1] for c in coordinates], [c[0] for c in coordinates]
+        center_latitude, center_longitude = SEARCH_CENTER['latitude'], SEARCH_CENTER['longitude']
+
+        print_result("distance", size, "scalar geodesic + sort", time_function(
+            lambda: _sort_results_by_distance_scalar({'locations': merchants}, SEARCH_CENTER), repeat=3))
+        for mode in telegramHandlerDistance.DISTANCE_MODES:
+            print_result("distance", size, mode + " + full sort", time_function(
+                lambda: telegramHandlerDistance.order_by_distance(telegramHandlerDistance.compute_distances(
+                    latitudes, longitudes, center_latitude, center_longitude, mode)), repeat=3))
+        distances = telegramHandlerDistance.compute_distances(latitudes, longitudes, center_latitude, center_longitude,
+                                                              "haversine")
+        print_result("distance", size, "order only, full sort", time_function(
+            lambda: telegramHandlerDistance.order_by_distance(distances)))
+        print_result("distance", size, "order only, first page", time_function(
+            lambda: telegramHandlerDistance.order_by_distance(distances, top_k=telegramHandlerHelper.MAX_NUM_RESULTS_PER_PAGE)))
+
+
+# B. Cache Benchmarks #########
+
+# Create the result that update_result_cache would cache for a new search over size merchants
+def create_cached_result(size):
+    json_response = telegramHandlerHelper.normalise_results(create_synthetic_merchants(size))
+    json_response, sources_available = telegramHandlerHelper.filter_merchant_source_and_category(json_response)
+    json_response = telegramHandlerHelper.sort_results_by_distance(json_response, SEARCH_CENTER)
+    return telegramHandlerHelper.update_source_filters(json_response, sources_available, sources_available)
+
+
+CACHE_FORMATS = [("legacy json", telegramHandlerCodec.LEGACY_RESULT_FORMAT, None),
+                 ("compact", telegramHandlerCodec.COMPACT_RESULT_FORMAT, "none"),
+                 ("compact + zlib", telegramHandlerCodec.COMPACT_RESULT_FORMAT, "zlib")]
+
+
+def benchmark_cache(sizes):
+    for size in sizes:
+        json_response = create_cached_result(size)
+
+        for variant, result_format, compression in CACHE_FORMATS:
+            item = telegramHandlerCodec.encode_result(json_response, result_format, compression)
+            result = item['Result']
+            print("{:<12} {:>7} {:<34} {:>10} bytes".format("cache", size, variant, len(getattr(result, 'value', result))))
+            print_result("cache", size, variant + " encode", time_function(
+                lambda: telegramHandlerCodec.encode_result(json_response, result_format, compression)))
+            print_result("cache", size, variant + " decode", time_function(
+                lambda: telegramHandlerCodec.decode_result(item)))
+
+
+# C. Callback Benchmarks #########
+
+# The pagination before the single pass, the page of the whole filtered and sorted result
+def _paginate_results(json_response, page_number):
+    json_result = {'searchRadius': json_response['searchRadius'],
+                   'searchCenterLatitude': json_response['searchCenterLatitude'],
+                   'searchCenterLongitude': json_response['searchCenterLongitude']}
+    start_index = min((page_number-1)*telegramHandlerHelper.MAX_NUM_RESULTS_PER_PAGE, len(json_response['locations']))
+    end_index = min(page_number*telegramHandlerHelper.MAX_NUM_RESULTS_PER_PAGE, len(json_response['locations']))
+
+    if start_index == end_index and start_index == len(json_response['locations']):
+        json_result['locations'] = []
+        json_result['totalItems'] = 0
+    else:
+        json_result['locations'] = json_response['locations'][start_index:end_index]
+        json_result['startItemNumber'] = start_index + 1
+        json_result['endItemNumber'] = end_index
+        json_result['totalItems'] = len(json_response['locations'])
+    return json_result
+
+
+# The callback path before the single pass: filter, sort and paginate the whole result in sequence
+def _select_results_page_chained(json_response, page_number, sources_filter=None, center_lat_lng=SEARCH_CENTER):
+    json_response, sources_available = telegramHandlerHelper.filter_merchant_source_and_category(json_response, sources_filter)
+    json_response = telegramHandlerHelper.sort_results_by_distance(json_response, center_lat_lng)
+    return _paginate_results(json_response, page_number), sources_available
+
+
+# Filter, sort, paginate and format a page the way process_callback_query did before the single pass
+def _render_page(json_response, page_number):
+    return telegramHandlerHelper.format_json_response(_select_results_page_chained(
+        json_response, page_number, json_response['sourcesFilter'])[0])
+
+
+def benchmark_callback(sizes):
+    for size in sizes:
+        raw_response = create_synthetic_merchants(size)
+        json_response = create_cached_result(size)
+
+        print_result("callback", size, "normalise once per search", time_function(
+            lambda: telegramHandlerHelper.normalise_results(raw_response)))
+        print_result("callback", size, "page render, re-parsing merchants", time_function(
+            lambda: _render_page(dict(json_response, locations=telegramHandlerHelper.normalise_results(
+                raw_response)['locations']), 2)))
+        print_result("callback", size, "page render, merchant records", time_function(
+            lambda: _render_page(json_response, 2)))
+        print_result("callback", size, "page render, single pass", time_function(
+            lambda: telegramHandlerHelper.format_json_response(telegramHandlerHelper.select_results_page(
+                json_response, 2, json_response['sourcesFilter'], SEARCH_CENTER)[0])))
+
+
+# D. Render Benchmarks #########
+
+# The formatting before the render layer: repeated string concatenation for every merchant
+def _format_json_response_concatenated(json_response):
+    onemap_url = "https://developers.onemap.sg/commonapi/staticmap/getStaticImage?layerchosen=default&lat=" \
+                 + str(json_response['searchCenterLatitude']) + "&lng=" + str(json_response['searchCenterLongitude']) + "&zoom=15&height=512&width=512&points=[" \
+                 + str(json_response['searchCenterLatitude']) + "," + str(json_response['searchCenterLongitude']) + ",%22255,0,0%22]"
+    output_string = ""
+    counter = 'A'
+    for location in json_response['locations']:
+        onemap_url = onemap_url + "|[" + str(location['latitude']) + "," + str(location['longitude']) + ",%22" + telegramHandlerHelper.MARKER_COLOUR + "%22,%22" + counter + "%22]"
+        output_string = output_string + "*" + counter + ". " + str(location['name']) + "* [" + telegramHandlerHelper.location_emoji + "](" + location['mapUrl'] + ")"
+        output_string = output_string + "[(" + telegramHandlerHelper.SOURCE_NUM_FULLDESC_MAP.get(location['source']) + ")](" + str(location['website']) + ")"
+        if location['offer']:
+            output_string = output_string + " - " + location['offer']
+        output_string = output_string + "\n"
+        counter = chr(ord(counter) + 1)
+    return "*Cheapo found*[ ](" + onemap_url + ")*" + str(json_response['totalItems']) + " results in a " + str(json_response['searchRadius']) + "m radius!*\nDisplaying results " + str(json_response['startItemNumber']) + " to " + str(json_response['endItemNumber']) + "\n\n" + output_string
+
+
+def benchmark_render(sizes):
+    for size in sizes:
+        json_response = create_cached_result(size)
+        json_response['searchId'] = "benchmark"
+        page = telegramHandlerHelper.select_results_page(json_response, 1, json_response['sourcesFilter'])[0]
+        telegramHandlerRender.reset_render_cache()
+        telegramHandlerRender.render_page(page)
+
+        print_result("render", size, "concatenated", time_function(lambda: _format_json_response_concatenated(page), number=100))
+        print_result("render", size, "joined", time_function(lambda: telegramHandlerHelper.format_json_response(page), number=100))
+        print_result("render", size, "cached page", time_function(lambda: telegramHandlerRender.render_page(page), number=100))
+
+
+# E. Fake Backends #########
+
+BENCHMARK_TELEGRAM_ID = 42
+
+
+class FakeConditionalCheckFailed(Exception):  # Carries the error code of the botocore ClientError of a failed condition
+    response = {'Error': {'Code': "ConditionalCheckFailedException"}}
+
+
+# Return the size of a dynamodb item, which a write is billed on, from the lengths of its attribute names and values
+def get_item_size(item):
+    return sum(len(name) + len(getattr(value, 'value', value) if not isinstance(value, (int, float)) else str(value))
+               for name, value in item.items())
+
+
+# Read capacity units of an eventually consistent read of the item, billed on its full size whatever is projected
+def get_read_units(item):
+    return math.ceil(get_item_size(item) / 4096.0) / 2.0
+
+
+# Return a copy of the item with only the attributes of the projection expression, e.g. "ChatID, #Version", if given
+def get_projected_item(item, projection_expression=None, expression_attribute_names=None):
+    if projection_expression is None:
+        return dict(item)
+    names = [(expression_attribute_names or {}).get(name.strip(), name.strip()) for name in projection_expression.split(",")]
+    return dict((name, item[name]) for name in names if name in item)
+
+
+class FakeTable(object):  # Same interface as the dynamodb Table for the calls made by telegramHandlerDBWriter
+    def __init__(self, key_name, items=()):
+        self.key_name = key_name
+        self.items = dict((item[key_name], item) for item in items)
+        self.calls = {'get_item': 0, 'projected_get_item': 0, 'put_item': 0, 'update_item': 0}
+        self.bytes_written = 0
+        self.read_units = 0.0
+
+    # Only the attributes of the ProjectionExpression are returned, a GetItem with one is counted apart
+    def get_item(self, Key, ProjectionExpression=None, ExpressionAttributeNames=None):
+        self.calls['get_item' if ProjectionExpression is None else 'projected_get_item'] += 1
+        item = self.items.get(Key[self.key_name])
+        self.read_units += get_read_units(item) if item is not None else 0.5
+        return {'Item': get_projected_item(item, ProjectionExpression, ExpressionAttributeNames)} if item is not None else {}
+
+    def put_item(self, Item):
+        self.calls['put_item'] += 1
+        self.bytes_written += get_item_size(Item)
+        self.items[Item[self.key_name]] = dict(Item)
+        return {}
+
+    # Supports the SET, ADD and REMOVE actions, the ConditionExpression and the ReturnValues of the UpdateItem calls of
+    # telegramHandlerDBWriter, with the attribute names given directly or as ExpressionAttributeNames
+    def update_item(self, Key, UpdateExpression, ExpressionAttributeValues, ConditionExpression=None,
+                    ExpressionAttributeNames=None, ReturnValues=None):
+        self.calls['update_item'] += 1
+        previous_item = self.items.get(Key[self.key_name], Key)
+        get_name = lambda name: (ExpressionAttributeNames or {}).get(name, name)
+        if ConditionExpression is not None:
+            condition = re.match(r"attribute_not_exists\(([#\w]+)\)$|([#\w]+) = (:\w+)$", ConditionExpression)
+            if (get_name(condition.group(1)) in previous_item) if condition.group(1) else \
+                    previous_item.get(get_name(condition.group(2))) != ExpressionAttributeValues[condition.group(3)]:
+                raise FakeConditionalCheckFailed()
+
+        item, updated_names = dict(previous_item), []
+        for action, assignments in re.findall(r"(SET|ADD|REMOVE) (.+?)(?= SET | ADD | REMOVE |$)", UpdateExpression):
+            if action == "REMOVE":
+                for name in re.findall(r"[#\w]+", assignments):
+                    item.pop(get_name(name), None)
+                continue
+            for name, value_name in re.findall(r"([#\w]+) =? ?(:\w+)", assignments):
+                value = ExpressionAttributeValues[value_name]
+                item[get_name(name)] = item.get(get_name(name), 0) + value if action == "ADD" else value
+                updated_names.append(get_name(name))
+        self.bytes_written += max(get_item_size(previous_item), get_item_size(item))  # Billed on the larger of the two
+        self.items[Key[self.key_name]] = item
+        if ReturnValues == "UPDATED_NEW":
+            return {'Attributes': dict((name, item[name]) for name in updated_names)}
+        return {}
+
+
+class FakeDatabaseResource(object):  # Same interface as the dynamodb resource for BatchGetItem over the fake tables
+    def __init__(self, tables):
+        self.tables = tables
+        self.calls = {'batch_get_item': 0}
+
+    def batch_get_item(self, RequestItems):
+        self.calls['batch_get_item'] += 1
+        responses = {}
+        for table_name, request in RequestItems.items():
+            table = self.tables[table_name]
+            table.read_units += sum(get_read_units(table.items[key[table.key_name]]) if key[table.key_name] in table.items
+                                    else 0.5 for key in request['Keys'])
+            responses[table_name] = [get_projected_item(table.items[key[table.key_name]], request.get('ProjectionExpression'),
+                                                        request.get('ExpressionAttributeNames'))
+                                     for key in request['Keys'] if key[table.key_name] in table.items]
+        return {'Responses': responses, 'UnprocessedKeys': {}}
+
+
+class FakeLambda(object):  # Answers queryGeoDatabase with synthetic merchants, generated once per search
+    def __init__(self, num_merchants, default_radius=SEARCH_RADIUS, latency=0):
+        self.num_merchants = num_merchants
+        self.default_radius = default_radius  # Radius of searches without a searchRadius
+        self.latency = latency  # Seconds every invoke takes, e.g. to measure what is saved by not invoking
+        self.payloads = {}
+        self.calls = {'invoke': 0}
+
+    def invoke(self, FunctionName, InvocationType, Payload):
+        self.calls['invoke'] += 1
+        time.sleep(self.latency)
+        if Payload not in self.payloads:
+            search_center_details = json.loads(Payload)
+            json_response = create_synthetic_merchants(self.num_merchants, search_center_details,
+                                                       search_center_details.get('searchRadius', self.default_radius))
+            self.payloads[Payload] = json.dumps(json_response).encode("utf8")
+        return {'Payload': io.BytesIO(self.payloads[Payload])}
+
+
+class FakeResponse(object):
+    status_code = 200
+    text = '{"ok":true}'
+
+    def json(self):
+        return json.loads(self.text)
+
+
+class FakeSession(object):  # Accepts every Telegram Bot API call
+    def __init__(self):
+        self.calls = {'post': 0}
+        self.posts = []  # (method, data) of every call, in the order they were made
+        self.lock = threading.Lock()  # The replies are posted from the dispatch pool
+
+    def post(self, url, data=None, **kwargs):
+        with self.lock:
+            self.calls['post'] += 1
+            self.posts.append((url.rsplit("/", 1)[-1], data))
+        return FakeResponse()
+
+    def close(self):
+        pass
+
+
+class _FakeBotApiRequestHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        method = self.path.rsplit("/", 1)[-1]
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        fields = parse_qs(body if str is bytes else body.decode("ascii"))  # Python 2 unquotes the utf8 bytes as they are
+        status_code, reply = self.server.bot_api.answer(method, dict(
+            (name, values[0].decode("utf8") if isinstance(values[0], bytes) else values[0]) for name, values in fields.items()))
+        body = json.dumps(reply).encode("utf8")
+        self.send_response(status_code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class FakeBotApiServer(object):  # Local Bot API over http, serving the given updates to getUpdates and recording the rest
+    def __init__(self, updates=(), chat_interval=0, retry_after=1):
+        self.updates = updates
+        self.chat_interval = chat_interval  # Seconds between the calls to a chat below which 429 is answered, as telegram does
+        self.retry_after = retry_after
+        self.requests = []  # (method, fields) of every call other than getUpdates that was accepted, in the order they arrived
+        self.last_call_times = {}  # Chat id to the time of the last call accepted
+        self.message_contents = {}  # (chat id, message id) to the text and keyboard it was last edited with
+        self.num_not_modified = 0
+        self.call_times = []  # (chat id, time, http status code) of every call other than getUpdates
+        self.num_throttled = 0
+        self.last_offset = None  # Offset of the last getUpdates call
+        self.lock = threading.Lock()
+        self.server = _ThreadingHTTPServer(("127.0.0.1", 0), _FakeBotApiRequestHandler)
+        self.server.bot_api = self
+        self.url = "http://127.0.0.1:" + str(self.server.server_address[1])
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    # Return the http status code and the reply to the call
+    def answer(self, method, fields):
+        if method != "getUpdates":
+            with self.lock:
+                chat_id, now = fields.get("chat_id"), time.time()
+                if self.chat_interval and chat_id is not None and now - self.last_call_times.get(chat_id, 0) < self.chat_interval:
+                    self.num_throttled += 1
+                    self.call_times.append((chat_id, now, 429))
+                    return 429, {'ok': False, 'error_code': 429, 'parameters': {'retry_after': self.retry_after},
+                                 'description': "Too Many Requests: retry after " + str(self.retry_after)}
+                self.last_call_times[chat_id] = now
+                if method == "editMessageText":  # As telegram does, an edit that changes nothing is an error
+                    content, message_key = (fields.get("text"), fields.get("reply_markup")), (chat_id, fields.get("message_id"))
+                    if self.message_contents.get(message_key) == content:
+                        self.num_not_modified += 1
+                        self.call_times.append((chat_id, now, 400))
+                        return 400, {'ok': False, 'error_code': 400, 'description': "Bad Request: message is not modified: "
+                                     "specified new message content and reply markup are exactly the same as a current content"}
+                    self.message_contents[message_key] = content
+                self.call_times.append((chat_id, now, 200))
+                self.requests.append((method, fields))
+                return 200, {'ok': True, 'result': {'message_id': len(self.requests)} if method == "sendMessage" else {}}
+        offset = int(fields.get("offset", 0))
+        self.last_offset = offset
+        pending_updates = [update for update in self.updates if update['update_id'] >= offset]
+        if len(pending_updates) == 0:
+            time.sleep(0.01)  # Stands in for the long poll, kept short so that the worker stops quickly
+        return 200, {'ok': True, 'result': pending_updates}
+
+    def shutdown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+# Register fakes for every backend with the client registry, so that no client is built and nothing leaves the process
+# Return the fakes by name, e.g. to count their calls
+def register_fake_clients(num_merchants, cached_items=(), telegram_ids=(BENCHMARK_TELEGRAM_ID,), fake_telegram=True):
+    import telegramHandlerClients
+    import telegramHandlerDBWriter
+    database_type, database_region = telegramHandlerDBWriter.database_type, telegramHandlerDBWriter.database_region
+    fakes = {'user_table': FakeTable('TelegramID', [{'TelegramID': telegram_id, 'UserName': "benchmark"}
+                                                    for telegram_id in telegram_ids]),
+             'cache_table': FakeTable('ChatID', cached_items), 'geo_cell_table': FakeTable('CellKey'),
+             'view_state_table': FakeTable('ChatID'),
+             'lambda': FakeLambda(num_merchants), 'telegram': FakeSession()}
+    table_names = {'user_table': telegramHandlerDBWriter.user_database_table,
+                   'cache_table': telegramHandlerDBWriter.cache_database_table,
+                   'geo_cell_table': telegramHandlerDBWriter.geo_cell_cache_database_table,
+                   'view_state_table': telegramHandlerDBWriter.view_state_database_table}
+
+    for fake_name, table_name in table_names.items():
+        if table_name is not None:
+            telegramHandlerClients.register_client(telegramHandlerClients.get_database_table_key(
+                database_type, database_region, table_name), fakes[fake_name])
+    fakes['database'] = FakeDatabaseResource(dict((table_name, fakes[fake_name])
+                                                  for fake_name, table_name in table_names.items() if table_name is not None))
+    telegramHandlerClients.register_client(telegramHandlerClients.get_database_resource_key(
+        database_type, database_region), fakes['database'])
+    telegramHandlerClients.register_client(telegramHandlerClients.LAMBDA_CLIENT_KEY, fakes['lambda'])
+    telegramHandlerClients.register_client(telegramHandlerClients.HTTP_SESSION_KEY,
+                                           fakes['telegram'] if fake_telegram else None)  # None builds a real session
+    return fakes
+
+
+MESSAGE_TYPE_CALLBACK_DATA = {"page turn": "2", "radius change": "1000", "source filter": "CITI"}
+MESSAGE_TYPES = ["text", "location", "page turn", "radius change", "source filter"]
+
+
+# Create the lambda event of a message type from MESSAGE_TYPES, sent by the telegram id in its private chat
+def create_event(message_type, telegram_id=BENCHMARK_TELEGRAM_ID, callback_data=None):
+    chat = {'id': telegram_id, 'type': "private"}
+    if message_type in MESSAGE_TYPE_CALLBACK_DATA:
+        callback_query = {'id': str(telegram_id), 'data': callback_data or MESSAGE_TYPE_CALLBACK_DATA[message_type],
+                          'message': {'message_id': 2, 'chat': chat}}
+        return {'body': json.dumps({'callback_query': callback_query})}
+    message = {'message_id': 1, 'from': {'id': telegram_id, 'first_name': "benchmark"}, 'chat': chat}
+    if message_type == "text":
+        message['text'] = "/hello"
+    else:
+        message['location'] = SEARCH_CENTER
+    return {'body': json.dumps({'message': message})}
+
+
+# Return the message type of a lambda event, with the same names as MESSAGE_TYPES
+def get_message_type(event):
+    update = json.loads(event['body'])
+    if "callback_query" in update:
+        callback_data = str(update['callback_query']['data'])
+        if not callback_data.isdigit():
+            return "source filter"
+        return "radius change" if int(callback_data) >= 250 else "page turn"
+    if "location" in update.get('message', {}):
+        return "location"
+    return "text" if "text" in update.get('message', {}) else "other"
+
+
+# F. Cold Start Benchmarks #########
+
+# Modules imported on their own by a fresh interpreter, the handler modules include what they import
+COLD_START_MODULES = ["boto3", "requests", "geopy.distance", "numpy", "multiprocessing.pool", "telegramHandlerDistance",
+                      "telegramHandlerHelper", "telegramHandlerCodec", "telegramHandlerClients",
+                      "telegramHandlerDBWriter", "telegramHandlerGeoCache", "telegramHandler"]
+COLD_START_DEPENDENCIES = ["boto3", "requests", "geopy", "numpy", "multiprocessing.pool"]
+COLD_START_REPEAT = 3
+
+# Run in a fresh interpreter: import the handler, register the fakes, then time its first invocation
+COLD_START_INVOCATION = """
+import json, sys, time
+start_time = time.time()
+import telegramHandler
+import_time = time.time()
+import telegramHandlerBenchmark
+fake_details = json.loads(sys.stdin.read())
+telegramHandlerBenchmark.register_fake_clients(fake_details['size'], [fake_details['cachedItem']])
+invocation_time = time.time()
+telegramHandler.lambda_handler(telegramHandlerBenchmark.create_event(sys.argv[1]), None)
+end_time = time.time()
+print(json.dumps({'import': (import_time - start_time) * 1000.0, 'invocation': (end_time - invocation_time) * 1000.0,
+                  'loaded': [name for name in telegramHandlerBenchmark.COLD_START_DEPENDENCIES if name in sys.modules]}))
+"""
+
+
+def _run_in_fresh_interpreter(arguments, input_string=""):
+    process = subprocess.Popen([sys.executable] + arguments, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                               cwd=os.path.dirname(os.path.abspath(__file__)), env=dict(os.environ))
+    output = process.communicate(input_string.encode("utf8"))[0]
+    if process.returncode != 0:
+        raise RuntimeError("Cold start run " + " ".join(arguments[-1:]) + " failed.")
+    return json.loads(output.decode("utf8").strip().splitlines()[-1])
+
+
+def benchmark_cold_start(sizes):
+    for module_name in COLD_START_MODULES:
+        import_statement = "import time; start_time = time.time(); import " + module_name \
+                           + "; print((time.time() - start_time) * 1000.0)"
+        print_result("import", "", module_name, min(_run_in_fresh_interpreter(["-c", import_statement])
+                                                    for _ in range(COLD_START_REPEAT)))
+
+    for size in sizes:
+        json_response = create_cached_result(size)
+        json_response['searchId'] = "benchmark"
+        cached_item = {'ChatID': BENCHMARK_TELEGRAM_ID}
+        cached_item.update(telegramHandlerCodec.encode_result(json_response, telegramHandlerCodec.COMPACT_RESULT_FORMAT, "none"))
+        fake_details = json.dumps({'size': size, 'cachedItem': cached_item})
+
+        for message_type in MESSAGE_TYPES:
+            runs = [_run_in_fresh_interpreter(["-c", COLD_START_INVOCATION, message_type], fake_details)
+                    for _ in range(COLD_START_REPEAT)]
+            print_result("cold start", size, message_type + " import", min(run['import'] for run in runs))
+            print("{:<12} {:>7} {:<34} {:>10.3f} ms  loads {}".format(
+                "cold start", size, message_type + " first invocation", min(run['invocation'] for run in runs),
+                ", ".join(runs[0]['loaded']) or "none"))
+
+
+# G. Replay Benchmarks #########
+
+REPLAY_ROUNDS = 20  # Number of synthetic sessions replayed per merchant set size
+REPLAY_SESSION = [("location", None), ("page turn", "2"), ("page turn", "3"), ("source filter", "CITI"),
+                  ("radius change", "1000"), ("page turn", "2"), ("source filter", "CITI"), ("radius change", "5000"),
+                  ("text", None)]
+REPLAY_PERCENTILES = [50, 90, 99]
+
+
+class _ErrorCounter(logging.Handler):  # lambda_handler logs its failures instead of raising them
+    def __init__(self):
+        logging.Handler.__init__(self, logging.ERROR)
+        self.num_errors = 0
+
+    def emit(self, record):
+        self.num_errors += 1
+
+
+# Return the percentile of the sorted values, using the nearest rank
+def get_percentile(sorted_values, percentile):
+    rank = int(math.ceil(percentile / 100.0 * len(sorted_values)))
+    return sorted_values[max(rank, 1) - 1]
+
+
+# Create the lambda events of rounds synthetic sessions, each one in its own chat
+def create_replay_events(rounds=REPLAY_ROUNDS):
+    return [create_event(message_type, BENCHMARK_TELEGRAM_ID + session, callback_data)
+            for session in range(rounds) for message_type, callback_data in REPLAY_SESSION]
+
+
+# Read recorded updates, one json per line, either the lambda event or the telegram update that is its body
+def read_replay_events(path):
+    events = []
+    with open(path) as updates_file:
+        for line in updates_file:
+            if line.strip():
+                update = json.loads(line)
+                events.append(update if 'body' in update else {'body': json.dumps(update)})
+    return events
+
+
+def _get_sender_id(event):
+    update = json.loads(event['body'])
+    if "callback_query" in update:
+        return update['callback_query']['message']['chat']['id']
+    return update['message']['from']['id']
+
+
+# Feed the events through lambda_handler against the fakes, and return the latencies in milliseconds per message type
+def replay_events(events, num_merchants):
+    import telegramHandler
+    fakes = register_fake_clients(num_merchants, telegram_ids=set(_get_sender_id(event) for event in events))
+    latencies = {}
+    error_counter = _ErrorCounter()
+    logging.getLogger().addHandler(error_counter)
+    start_time = time.time()
+    try:
+        for event in events:
+            event_start_time = time.time()
+            telegramHandler.lambda_handler(event, None)
+            latencies.setdefault(get_message_type(event), []).append((time.time() - event_start_time) * 1000.0)
+    finally:
+        logging.getLogger().removeHandler(error_counter)
+    return latencies, time.time() - start_time, error_counter.num_errors, fakes
+
+
+def benchmark_replay(sizes, updates_path=None):
+    events = read_replay_events(updates_path) if updates_path else create_replay_events()
+    for size in sizes:
+        latencies, elapsed, num_errors, fakes = replay_events(events, size)
+        print("{:<12} {:>7} {:<34} {:>10.1f} updates/s, {} errors".format(
+            "replay", size, "all " + str(len(events)) + " updates", len(events) / elapsed, num_errors))
+        for message_type in sorted(latencies):
+            sorted_latencies = sorted(latencies[message_type])
+            print("{:<12} {:>7} {:<34} ".format("replay", size, message_type + " x" + str(len(sorted_latencies)))
+                  + ", ".join("p" + str(percentile) + " {:.3f} ms".format(get_percentile(sorted_latencies, percentile))
+                              for percentile in REPLAY_PERCENTILES))
+
+
+# H. Batch Benchmarks #########
+
+BATCH_SIZE = 10  # Largest batch of the SQS event source
+BATCH_CONCURRENT_SESSIONS = 4  # Sessions interleaved with each other at a time
+
+
+# Create the events of rounds synthetic sessions, interleaved at random like concurrent chats, each in its own order
+def create_interleaved_events(rounds=REPLAY_ROUNDS, concurrent_sessions=BATCH_CONCURRENT_SESSIONS, seed=0):
+    generator = random.Random(seed)
+    sessions = [[create_event(message_type, BENCHMARK_TELEGRAM_ID + session, callback_data)
+                 for message_type, callback_data in REPLAY_SESSION] for session in range(rounds)]
+    events = []
+    for start in range(0, rounds, concurrent_sessions):
+        concurrent = sessions[start:start + concurrent_sessions]
+        while any(concurrent):
+            events.append(generator.choice([session for session in concurrent if session]).pop(0))
+    return events
+
+
+# Return the number of calls made to each backend by the fakes from register_fake_clients
+def count_backend_calls(fakes):
+    return {'dynamodb': sum(sum(fakes[name].calls.values())
+                            for name in ['user_table', 'cache_table', 'view_state_table', 'database']),
+            'lambda': fakes['lambda'].calls['invoke'], 'telegram': fakes['telegram'].calls['post']}
+
+
+def _reset_handler_caches():
+    import telegramHandlerGeoCache
+    import telegramHandlerPrefetch
+    import telegramHandlerSessionCache
+    import telegramHandlerUserCache
+    telegramHandlerUserCache.reset_user_cache()
+    telegramHandlerGeoCache.reset_geo_cell_cache()
+    telegramHandlerPrefetch.reset_prefetch_store()
+    telegramHandlerRender.reset_render_cache()
+    telegramHandlerSessionCache.reset_session_cache()
+
+
+# Return the Bot API calls of each chat as (replies in order, answerCallbackQuery calls), from the (method, data) of the
+# calls to a FakeSession or a FakeBotApiServer. answerCallbackQuery is sent concurrently with the reply of its update, so
+# only their numbers are compared. The values are compared as text, as the Bot API receives them.
+def get_chat_posts(posts):
+    chat_posts = {}
+    for method, data in posts:
+        data = dict((name, value.decode("utf8") if isinstance(value, bytes) else u"{}".format(value))
+                    for name, value in data.items())
+        if method == "answerCallbackQuery":
+            chat_id = int(data['callback_query_id'])  # The sender of the callback in the events of create_event
+            chat_posts.setdefault(chat_id, ([], []))[1].append(method)
+        else:
+            chat_posts.setdefault(int(data['chat_id']), ([], []))[0].append((method, data))
+    return chat_posts
+
+
+# Return the decoded result cached for each chat, without its searchId which is random
+def get_cached_results(cache_table):
+    cached_results = {}
+    for chat_id, item in cache_table.items.items():
+        cached_results[chat_id] = telegramHandlerCodec.decode_result(dict(item))
+        cached_results[chat_id].pop('searchId', None)
+    return cached_results
+
+
+def benchmark_batch(sizes):
+    import telegramHandler
+    import telegramHandlerBatch
+    events = create_interleaved_events()
+    telegram_ids = set(_get_sender_id(event) for event in events)
+    batches = [{'Records': [{'messageId': str(start + index), 'body': event['body']}
+                            for index, event in enumerate(events[start:start + BATCH_SIZE])]}
+               for start in range(0, len(events), BATCH_SIZE)]
+    variants = [("one update per invocation", lambda: [telegramHandler.lambda_handler(event, None) for event in events]),
+                ("batches of " + str(BATCH_SIZE), lambda: [telegramHandlerBatch.batch_handler(batch, None) for batch in batches])]
+
+    for size in sizes:
+        reference = None  # Backend calls, posts and cached results of one update per invocation
+        for variant, replay_function in variants:
+            _reset_handler_caches()
+            fakes = register_fake_clients(size, telegram_ids=telegram_ids)
+            start_time = time.time()
+            replay_function()
+            elapsed = (time.time() - start_time) * 1000.0
+            backend_calls = count_backend_calls(fakes)
+            print("{:<12} {:>7} {:<34} {:>10.3f} ms, ".format("batch", size, variant, elapsed)
+                  + ", ".join(name + " " + str(backend_calls[name]) for name in sorted(backend_calls)) + " calls")
+
+            outcome = (backend_calls, get_chat_posts(fakes['telegram'].posts), get_cached_results(fakes['cache_table']))
+            if reference is None:
+                reference = outcome
+                continue
+            if outcome[1] != reference[1] or outcome[2] != reference[2]:
+                raise AssertionError("The batches did not send the same replies or cache the same results.")
+            if outcome[0]['dynamodb'] >= reference[0]['dynamodb'] or \
+                    any(outcome[0][name] > reference[0][name] for name in reference[0]):
+                raise AssertionError("The batches did not make fewer backend calls: " + str(outcome[0]))
+            print("{:<12} {:>7} {:<34}".format("batch", size, "same replies and cached results"))
+
+
+# I. Worker Benchmarks #########
+
+# Poll the interleaved updates from a local fake Bot API with the long polling worker, until they are all processed
+# The replies of each chat must be those of the updates replayed one per invocation, in the same order
+def benchmark_worker(sizes):
+    import telegramHandler
+    import telegramHandlerWorker
+    events = create_interleaved_events()
+    updates = [dict(json.loads(event['body']), update_id=1000 + index) for index, event in enumerate(events)]
+    telegram_ids = set(_get_sender_id(event) for event in events)
+    offset_path = os.path.join(tempfile.mkdtemp(), "worker.offset")
+
+    for size in sizes:
+        _reset_handler_caches()
+        fakes = register_fake_clients(size, telegram_ids=telegram_ids)
+        for event in events:
+            telegramHandler.lambda_handler(event, None)
+        expected_chat_posts = get_chat_posts(fakes['telegram'].posts)
+
+        _reset_handler_caches()
+        register_fake_clients(size, telegram_ids=telegram_ids, fake_telegram=False)
+        bot_api = FakeBotApiServer(updates)
+        telegramHandler.BASE_URL = bot_api.url + "/bot" + telegramHandler.TOKEN
+        if os.path.exists(offset_path):
+            os.remove(offset_path)
+        stop_event = threading.Event()
+        worker_thread = threading.Thread(target=telegramHandlerWorker.run_worker,
+                                         kwargs={'stop_event': stop_event, 'offset_path': offset_path})
+        start_time = time.time()
+        worker_thread.start()
+        while bot_api.last_offset != updates[-1]['update_id'] + 1:  # Every update was processed and confirmed
+            time.sleep(0.005)
+        elapsed = time.time() - start_time
+        stop_event.set()
+        worker_thread.join()
+        bot_api.shutdown()
+        print("{:<12} {:>7} {:<34} {:>10.1f} updates/s, {} telegram calls, offset {}".format(
+            "worker", size, str(len(updates)) + " updates", len(updates) / elapsed, len(bot_api.requests),
+            telegramHandlerWorker.read_offset(offset_path)))
+
+        if get_chat_posts(bot_api.requests) != expected_chat_posts:
+            raise AssertionError("The worker did not send the replies of each chat in the order of its updates.")
+        if telegramHandlerWorker.read_offset(offset_path) != updates[-1]['update_id'] + 1:
+            raise AssertionError("The worker did not save the offset after the last update.")
+        print("{:<12} {:>7} {:<34}".format("worker", size, "same replies in order, offset saved"))
+
+
+# J. Spatial Index Benchmarks #########
+
+SPATIAL_INDEX_CATALOGUE_RADIUS = 20000  # The catalogue is spread over about the size of Singapore
+SPATIAL_INDEX_QUERY_RADII = [1000, telegramHandlerHelper.MAX_SEARCH_RADIUS]
+
+
+# The merchants within radius of the center, closest first, the way a search over the whole catalogue finds them
+def _query_linear(records, latitudes, longitudes, center_lat_lng, radius):
+    distances = telegramHandlerDistance.compute_distances(latitudes, longitudes, center_lat_lng['latitude'],
+                                                          center_lat_lng['longitude'])
+    within_radius = [(record, float(distance)) for record, distance in zip(records, distances) if distance <= radius]
+    order = telegramHandlerDistance.order_by_distance([distance for record, distance in within_radius])
+    return [dict(within_radius[i][0], distance=within_radius[i][1]) for i in order]
+
+
+def benchmark_spatial_index(sizes):
+    import telegramHandlerSpatialIndex
+    snapshot_path = os.path.join(tempfile.mkdtemp(), "merchants.snapshot")
+
+    for size in sizes:
+        merchants = create_synthetic_merchants(size, radius=SPATIAL_INDEX_CATALOGUE_RADIUS)['locations']
+        records = [telegramHandlerHelper.normalise_merchant(merchant) for merchant in merchants]
+        latitudes, longitudes = [record['latitude'] for record in records], [record['longitude'] for record in records]
+        telegramHandlerSpatialIndex.write_spatial_index_snapshot(merchants, snapshot_path)
+        print("{:<12} {:>7} {:<34} {:>10} bytes".format("spatial", size, "snapshot", os.path.getsize(snapshot_path)))
+        print_result("spatial", size, "map snapshot", time_function(
+            lambda: telegramHandlerSpatialIndex.SpatialIndex(snapshot_path).close()))
+        spatial_index = telegramHandlerSpatialIndex.SpatialIndex(snapshot_path)
+
+        for radius in SPATIAL_INDEX_QUERY_RADII:
+            linear_names = [record['name'] for record in _query_linear(records, latitudes, longitudes, SEARCH_CENTER, radius)]
+            index_names = [record['name'] for record in spatial_index.query(SEARCH_CENTER['latitude'],
+                                                                            SEARCH_CENTER['longitude'], radius)]
+            if index_names != linear_names:
+                raise AssertionError("The spatial index and the linear scan disagree within " + str(radius) + "m.")
+            print_result("spatial", size, "linear scan, " + str(radius) + "m, " + str(len(index_names)) + " found",
+                         time_function(lambda: _query_linear(records, latitudes, longitudes, SEARCH_CENTER, radius), repeat=3))
+            print_result("spatial", size, "spatial index, " + str(radius) + "m", time_function(
+                lambda: spatial_index.query(SEARCH_CENTER['latitude'], SEARCH_CENTER['longitude'], radius), repeat=3))
+        spatial_index.close()
+
+
+# K. First Reply Benchmarks #########
+
+# Run a new search up to the markdown of its first page, the way update_result_cache and process_update do
+def _render_first_reply(json_response, top_k=None):
+    json_response = telegramHandlerHelper.normalise_results(json_response)
+    json_response, sources_available = telegramHandlerHelper.filter_merchant_source_and_category(json_response)
+    json_response = telegramHandlerHelper.sort_results_by_distance(json_response, SEARCH_CENTER, top_k=top_k)
+    json_response = telegramHandlerHelper.update_source_filters(json_response, sources_available, sources_available)
+    first_page = telegramHandlerHelper.select_results_page(json_response, 1)[0]
+    return json_response, first_page, telegramHandlerHelper.format_json_response(first_page)
+
+
+# Time from a geo query result to the first reply, with every merchant sorted or only the first page
+def benchmark_first_reply(sizes):
+    for size in sizes:
+        json_response = create_synthetic_merchants(size)
+        sorted_response, sorted_page, sorted_reply = _render_first_reply(json_response)
+        lazy_response, lazy_page, lazy_reply = _render_first_reply(json_response, telegramHandlerHelper.MAX_NUM_RESULTS_PER_PAGE)
+        completed_response = telegramHandlerHelper.complete_sort_by_distance(lazy_response)
+        if lazy_reply != sorted_reply or lazy_page['totalItems'] != sorted_page['totalItems'] or \
+                [merchant['name'] for merchant in completed_response['locations']] != \
+                [merchant['name'] for merchant in sorted_response['locations']]:
+            raise AssertionError("The lazy sort does not give the same first reply and cached order.")
+
+        print_result("first-reply", size, "full sort", time_function(lambda: _render_first_reply(json_response), repeat=3))
+        print_result("first-reply", size, "top " + str(telegramHandlerHelper.MAX_NUM_RESULTS_PER_PAGE) + ", rest deferred",
+                     time_function(lambda: _render_first_reply(json_response, telegramHandlerHelper.MAX_NUM_RESULTS_PER_PAGE), repeat=3))
+        print_result("first-reply", size, "deferred sort, in the cache write", time_function(
+            lambda: telegramHandlerHelper.complete_sort_by_distance(lazy_response)))
+
+
+# L. View State Benchmarks #########
+
+VIEW_STATE_TOGGLES = 10  # Source filter taps after each search
+VIEW_STATE_BENCHMARK_TABLE_NAME = "ViewState"
+
+
+# Return the view state the chat's cached result is read with
+def _read_view_state(chat_id):
+    import telegramHandlerDBWriter
+    json_response = telegramHandlerCodec.decode_result(telegramHandlerDBWriter.get_from_result_cache(chat_id))
+    return dict((key, sorted(value) if isinstance(value, list) else value)
+                for key, value in json_response.items() if key in telegramHandlerCodec.VIEW_STATE_KEYS)
+
+
+# Bytes written per source filter toggle, with the whole result rewritten or only its view state item updated
+def benchmark_view_state(sizes):
+    import telegramHandler
+    import telegramHandlerDBWriter
+    configured_table_name = telegramHandlerDBWriter.view_state_database_table
+    variants = [("result rewrite", None), ("view state update", VIEW_STATE_BENCHMARK_TABLE_NAME)]
+    toggle_events = [create_event("source filter", callback_data=source) for source in ["CITI", "OCBC"] * (VIEW_STATE_TOGGLES // 2)]
+
+    try:
+        for size in sizes:
+            view_states = []
+            for variant, table_name in variants:
+                telegramHandlerDBWriter.view_state_database_table = table_name
+                telegramHandler.VIEW_STATE_UPDATES = table_name is not None
+                _reset_handler_caches()
+                fakes = register_fake_clients(size)
+                telegramHandler.lambda_handler(create_event("location"), None)
+                bytes_before = fakes['cache_table'].bytes_written + fakes['view_state_table'].bytes_written
+                for event in toggle_events:
+                    telegramHandler.lambda_handler(event, None)
+                bytes_per_toggle = (fakes['cache_table'].bytes_written + fakes['view_state_table'].bytes_written
+                                    - bytes_before) / float(len(toggle_events))
+                print("{:<12} {:>7} {:<34} {:>10.0f} bytes, {} write units per toggle".format(
+                    "view-state", size, variant, bytes_per_toggle, int(math.ceil(bytes_per_toggle / 1024.0))))
+                view_states.append(_read_view_state(BENCHMARK_TELEGRAM_ID))
+            if view_states[0] != view_states[1]:
+                raise AssertionError("The view state updates do not give the same view state: " + str(view_states))
+
+            # Two taps read the same version, the second one to write fails its version check
+            racing_responses = [telegramHandlerCodec.decode_result(
+                telegramHandlerDBWriter.get_from_result_cache(BENCHMARK_TELEGRAM_ID)) for _ in range(2)]
+            telegramHandlerDBWriter.write_view_state_to_results_cache(BENCHMARK_TELEGRAM_ID, racing_responses[0])
+            try:
+                telegramHandlerDBWriter.write_view_state_to_results_cache(BENCHMARK_TELEGRAM_ID, racing_responses[1])
+                raise AssertionError("The racing view state update was not rejected.")
+            except FakeConditionalCheckFailed:
+                print("{:<12} {:>7} {:<34}".format("view-state", size, "racing tap rejected"))
+    finally:
+        telegramHandlerDBWriter.view_state_database_table = configured_table_name
+        telegramHandler.VIEW_STATE_UPDATES = configured_table_name is not None
+
+
+# M. Prefetch Benchmarks #########
+
+PREFETCH_SESSION = [("location", None), ("page turn", "2"), ("page turn", "3"), ("radius change", "1250"),
+                    ("page turn", "2"), ("radius change", "1500"), ("source filter", "CITI"), ("page turn", "2")]
+PREFETCH_ROUNDS = 5
+PREFETCH_DEFAULT_RADIUS = 1000  # Radius of the location searches, so that there are radius steps left to prefetch
+PREFETCH_INVOKE_LATENCY = 0.1  # Seconds per queryGeoDatabase invoke
+PREFETCH_THINK_TIME = 0.2  # Seconds the user reads a reply before the next tap
+
+
+# Latency of the taps after a reply, with and without prefetching while the user reads the reply
+# The updates are handled the way the long polling worker does, the only entry point that prefetches
+def benchmark_prefetch(sizes):
+    import telegramHandler
+    import telegramHandlerPrefetch
+    import telegramHandlerWorker
+    events = [create_event(message_type, BENCHMARK_TELEGRAM_ID + session, callback_data)
+              for session in range(PREFETCH_ROUNDS) for message_type, callback_data in PREFETCH_SESSION]
+    configured_prefetch = telegramHandler.PREFETCH
+
+    try:
+        for size in sizes:
+            for variant, prefetch in [("no prefetch", False), ("prefetch", True)]:
+                telegramHandler.PREFETCH = prefetch
+                _reset_handler_caches()
+                fakes = register_fake_clients(size, telegram_ids=set(_get_sender_id(event) for event in events))
+                fakes['lambda'].default_radius, fakes['lambda'].latency = PREFETCH_DEFAULT_RADIUS, PREFETCH_INVOKE_LATENCY
+                latencies = {}
+                for event in events:
+                    event_start_time = time.time()
+                    telegramHandlerWorker.handle_update(json.loads(event['body']))
+                    latencies.setdefault(get_message_type(event), []).append((time.time() - event_start_time) * 1000.0)
+                    time.sleep(PREFETCH_THINK_TIME)
+
+                for message_type in ["page turn", "radius change"]:
+                    sorted_latencies = sorted(latencies[message_type])
+                    print("{:<12} {:>7} {:<34} ".format("prefetch", size, variant + ", " + message_type)
+                          + ", ".join("p" + str(percentile) + " {:.3f} ms".format(get_percentile(sorted_latencies, percentile))
+                                      for percentile in REPLAY_PERCENTILES))
+                print("{:<12} {:>7} {:<34} {} lambda invokes, {}".format(
+                    "prefetch", size, variant, fakes['lambda'].calls['invoke'],
+                    ", ".join(name + " " + str(telegramHandlerPrefetch.prefetch_counters[name])
+                              for name in sorted(telegramHandlerPrefetch.prefetch_counters))))
+    finally:
+        telegramHandler.PREFETCH = configured_prefetch
+
+
+# N. Payload Benchmarks #########
+
+PAYLOAD_VARIANTS = ["whole payload", "streaming"]
+
+# Run in a fresh interpreter: parse the payload file into the filtered merchant records and print the peak memory added
+# The peak is read from VmHWM, ru_maxrss would include the peak of the benchmark process the interpreter was forked from
+PAYLOAD_MEMORY_RUN = """
+import io, json, re, sys
+import telegramHandlerHelper, telegramHandlerPayload
+def get_peak_memory():
+    with open("/proc/self/status") as status_file:
+        return int(re.search(r"VmHWM:\\s*(\\d+) kB", status_file.read()).group(1))
+start_memory = get_peak_memory()
+with io.open(sys.argv[1], "rb") as payload_file:
+    if sys.argv[2] == "streaming":
+        json_response = telegramHandlerPayload.parse_geo_payload(payload_file)
+    else:
+        json_response = telegramHandlerHelper.filter_merchant_source_and_category(
+            telegramHandlerHelper.normalise_results(json.loads(payload_file.read())))[0]
+end_memory = get_peak_memory()
+print(json.dumps({'memory': (end_memory - start_memory) / 1024.0, 'merchants': len(json_response['locations'])}))
+"""
+
+
+# The payload parsed whole, then normalised and filtered, as invoke_lambda_function and update_result_cache do
+def _parse_whole_payload(payload):
+    return telegramHandlerHelper.filter_merchant_source_and_category(
+        telegramHandlerHelper.normalise_results(json.loads(io.BytesIO(payload).read())))[0]
+
+
+# Time and peak memory of parsing queryGeoDatabase payloads into the filtered merchant records, whole or streamed
+def benchmark_payload(sizes):
+    import telegramHandlerPayload
+    for size in sizes:
+        payload = json.dumps(create_synthetic_merchants(size)).encode("utf8")
+        print("{:<12} {:>7} {:<34} {:>10.3f} MB".format("payload", size, "payload size", len(payload) / 1048576.0))
+        print_result("payload", size, "whole payload", time_function(lambda: _parse_whole_payload(payload)))
+        print_result("payload", size, "streaming", time_function(
+            lambda: telegramHandlerPayload.parse_geo_payload(io.BytesIO(payload))))
+
+        payload_file = tempfile.NamedTemporaryFile(suffix=".json", delete=False)
+        try:
+            payload_file.write(payload)
+            payload_file.close()
+            for variant in PAYLOAD_VARIANTS:
+                run = _run_in_fresh_interpreter(["-c", PAYLOAD_MEMORY_RUN, payload_file.name, variant.split()[0]])
+                print("{:<12} {:>7} {:<34} {:>10.3f} MB peak, {} merchants kept".format(
+                    "payload", size, variant + " memory", run['memory'], run['merchants']))
+        finally:
+            os.remove(payload_file.name)
+
+
+# O. Outbound Benchmarks #########
+
+OUTBOUND_CHATS = 5
+OUTBOUND_TAPS = ["2", "3", "2", "2", "3", "3", "3"]  # Page taps in quick succession after the reply to a location
+OUTBOUND_CHAT_INTERVAL = 0.5  # Seconds between the calls to a chat below which the fake Bot API answers 429
+
+
+# Return the text of the last accepted edit of every chat, i.e. the page the user is left with
+def _get_last_edits(bot_api):
+    return dict((fields['chat_id'], fields['text']) for method, fields in bot_api.requests if method == "editMessageText")
+
+
+# Return the number of calls to a chat that arrived within retry_after of a 429 to the chat
+def _count_calls_before_retry_after(bot_api):
+    return sum(1 for chat_id, throttled_time, status_code in bot_api.call_times if status_code == 429
+               for other_chat_id, call_time, other_status_code in bot_api.call_times
+               if other_chat_id == chat_id and throttled_time < call_time < throttled_time + bot_api.retry_after)
+
+
+# Tap through pages faster than a local fake Bot API accepts, and compare the pages the users are left with when the
+# calls are posted directly, ignoring the 429s, and when they are sent through the outbound scheduler, which has to
+# leave every chat on its last page without calling a chat again before the retry_after of its 429
+def benchmark_outbound(sizes):
+    import telegramHandler
+    import telegramHandlerOutbound
+    import telegramHandlerWorker
+    updates = [json.loads(create_event("location", BENCHMARK_TELEGRAM_ID + chat)['body']) for chat in range(OUTBOUND_CHATS)]
+    updates += [json.loads(create_event("page turn", BENCHMARK_TELEGRAM_ID + chat, tap)['body'])
+                for tap in OUTBOUND_TAPS for chat in range(OUTBOUND_CHATS)]
+    telegram_ids = set(BENCHMARK_TELEGRAM_ID + chat for chat in range(OUTBOUND_CHATS))
+    configured_scheduler, configured_base_url = telegramHandler.TELEGRAM_SCHEDULER, telegramHandler.BASE_URL
+    variants = [("reference", False, 0), ("direct", False, OUTBOUND_CHAT_INTERVAL),
+                ("scheduler", True, OUTBOUND_CHAT_INTERVAL)]
+
+    try:
+        for size in sizes:
+            expected_edits = None
+            for variant, scheduler, chat_interval in variants:
+                telegramHandler.TELEGRAM_SCHEDULER = scheduler
+                telegramHandlerOutbound.reset_scheduler()
+                _reset_handler_caches()
+                register_fake_clients(size, telegram_ids=telegram_ids, fake_telegram=False)
+                bot_api = FakeBotApiServer(chat_interval=chat_interval)
+                telegramHandler.BASE_URL = bot_api.url + "/bot" + telegramHandler.TOKEN
+                start_time = time.time()
+                for update in updates:  # Each update as the worker processes it, its edits are not waited for
+                    telegramHandlerWorker.handle_update(update)
+                telegramHandlerOutbound.wait_for_sent(60)
+                elapsed = time.time() - start_time
+                bot_api.shutdown()
+
+                last_edits = _get_last_edits(bot_api)
+                expected_edits = expected_edits or last_edits
+                counters = telegramHandlerOutbound._scheduler.counters if scheduler else {}
+                num_last_pages = sum(1 for chat_id, text in expected_edits.items() if last_edits.get(chat_id) == text)
+                num_early_calls = _count_calls_before_retry_after(bot_api)
+                print("{:<12} {:>7} {:<34} {:>8.2f} s, {} calls accepted, {} answered 429, {} not modified, {} before retry_after, {}/{} chats left on their last page{}".format(
+                    "outbound", size, variant, elapsed, len(bot_api.requests), bot_api.num_throttled, bot_api.num_not_modified,
+                    num_early_calls, num_last_pages, len(expected_edits),
+                    "".join(", " + name + " " + str(counters[name]) for name in sorted(counters))))
+                if scheduler and (num_last_pages != len(expected_edits) or len(expected_edits) != OUTBOUND_CHATS):
+                    raise AssertionError("The scheduler left " + str(len(expected_edits) - num_last_pages) +
+                                         " chats on another page than the reference")
+                if scheduler and num_early_calls > 0:
+                    raise AssertionError("The scheduler called a chat " + str(num_early_calls) +
+                                         " times before the retry_after of its 429")
+    finally:
+        telegramHandler.TELEGRAM_SCHEDULER, telegramHandler.BASE_URL = configured_scheduler, configured_base_url
+        telegramHandlerOutbound.reset_scheduler()
+
+
+# P. Session Cache Benchmarks #########
+
+SESSION_CACHE_CHATS = 5
+SESSION_CACHE_VERIFY_INTERVAL = 5  # Seconds, longer than the taps of the benchmark take
+SESSION_CACHE_TAPS = [("page turn", "2"), ("page turn", "3"), ("source filter", "CITI"), ("page turn", "2"),
+                      ("radius change", "1000"), ("page turn", "2"), ("source filter", "OCBC"), ("page turn", "3")]
+
+
+# Latency of the taps and the cached result reads from dynamodb, with the results of the chats read back from
+# dynamodb on every tap or kept by the session cache of the warm container
+def benchmark_session_cache(sizes):
+    import telegramHandler
+    import telegramHandlerDBWriter
+    import telegramHandlerSessionCache
+    events = [create_event("location", BENCHMARK_TELEGRAM_ID + chat) for chat in range(SESSION_CACHE_CHATS)]
+    events += [create_event(message_type, BENCHMARK_TELEGRAM_ID + chat, callback_data)
+               for message_type, callback_data in SESSION_CACHE_TAPS for chat in range(SESSION_CACHE_CHATS)]
+    configured_session_cache = telegramHandler.SESSION_CACHE
+    configured_verify_interval = telegramHandlerSessionCache.SESSION_CACHE_VERIFY_INTERVAL
+    variants = [("dynamodb reads", False, 0), ("session cache", True, 0),
+                ("session cache, verified every " + str(SESSION_CACHE_VERIFY_INTERVAL) + "s", True, SESSION_CACHE_VERIFY_INTERVAL)]
+
+    try:
+        for size in sizes:
+            for variant, session_cache, verify_interval in variants:
+                telegramHandler.SESSION_CACHE = session_cache
+                telegramHandlerSessionCache.SESSION_CACHE_VERIFY_INTERVAL = verify_interval
+                _reset_handler_caches()
+                fakes = register_fake_clients(size, telegram_ids=set(_get_sender_id(event) for event in events))
+                latencies = []
+                for event in events:
+                    event_start_time = time.time()
+                    telegramHandler.lambda_handler(event, None)
+                    if get_message_type(event) != "location":
+                        latencies.append((time.time() - event_start_time) * 1000.0)
+
+                sorted_latencies = sorted(latencies)
+                print("{:<12} {:>7} {:<34} ".format("session", size, variant)
+                      + ", ".join("p" + str(percentile) + " {:.3f} ms".format(get_percentile(sorted_latencies, percentile))
+                                  for percentile in REPLAY_PERCENTILES)
+                      + ", {} result reads, {} version reads, {:g} read units, {} result writes".format(
+                          fakes['cache_table'].calls['get_item'], fakes['cache_table'].calls['projected_get_item'],
+                          fakes['cache_table'].read_units,
+                          fakes['cache_table'].calls['put_item'] + fakes['cache_table'].calls['update_item']))
+                counters = telegramHandlerSessionCache.session_cache_counters
+                if session_cache:
+                    print("{:<12} {:>7} {:<34} {}".format("session", size, "session cache counters",
+                                                          ", ".join(name + " " + str(counters[name]) for name in sorted(counters))))
+            telegramHandlerSessionCache.SESSION_CACHE_VERIFY_INTERVAL = 0
+
+            # Another container writes a new search of the chat, the page turn that follows finds the chat's item at
+            # another version and reads the new search from dynamodb instead of serving the one in memory
+            other_result = telegramHandlerCodec.decode_result(
+                telegramHandlerDBWriter.get_from_result_cache(BENCHMARK_TELEGRAM_ID))
+            other_result['searchId'] = "other container"
+            telegramHandlerDBWriter.write_versioned_result_to_results_cache(BENCHMARK_TELEGRAM_ID, other_result,
+                                                                            other_result['resultVersion'])
+            reads_before, stale_before = fakes['cache_table'].calls['get_item'], counters['stale']
+            telegramHandler.lambda_handler(create_event("page turn", BENCHMARK_TELEGRAM_ID, "2"), None)
+            kept_result = telegramHandlerSessionCache._entries[BENCHMARK_TELEGRAM_ID].json_response
+            if counters['stale'] != stale_before + 1 or fakes['cache_table'].calls['get_item'] != reads_before + 1 or \
+                    kept_result['searchId'] != other_result['searchId']:
+                raise AssertionError("The write of the other container was not detected: " + str(counters))
+            print("{:<12} {:>7} {:<34}".format("session", size, "other container's write detected"))
+    finally:
+        telegramHandler.SESSION_CACHE = configured_session_cache
+        telegramHandlerSessionCache.SESSION_CACHE_VERIFY_INTERVAL = configured_verify_interval
+        telegramHandlerSessionCache.reset_session_cache()
+
+
+# Q. Profile Benchmarks #########
+
+PROFILE_TAPS = [("page turn", "2"), ("page turn", "3"), ("source filter", "CITI"), ("source filter", "OCBC")]
+PROFILE_SHOWN_FUNCTIONS = 8
+
+
+class _CapturedOutput(object):  # Stands in for stdout to collect the profile log lines
+    def __init__(self):
+        self.lines = []
+
+    def write(self, text):
+        self.lines.extend(line for line in text.splitlines() if line.startswith('{"profile"'))
+
+    def flush(self):
+        pass
+
+
+# Latency of the taps with lambda_handler as is, decorated but profiling another chat, and profiling every invocation,
+# and the functions with the most cumulative time in the profile of a new search and of a tap
+def benchmark_profile(sizes):
+    import telegramHandler
+    import telegramHandlerProfile
+    taps = [create_event(message_type, BENCHMARK_TELEGRAM_ID, callback_data) for message_type, callback_data in PROFILE_TAPS]
+    configured = (telegramHandlerProfile.PROFILE_SAMPLE_RATE, telegramHandlerProfile.PROFILE_CHAT_IDS,
+                  telegramHandlerProfile.PROFILE_ENABLED)
+    variants = [("profiling disabled", 0, set()), ("profiling another chat", 0, set([BENCHMARK_TELEGRAM_ID + 1])),
+                ("profiling every invocation", 1, set())]
+    captured_output, stdout = _CapturedOutput(), sys.stdout
+
+    try:
+        for size in sizes:
+            for variant, sample_rate, chat_ids in variants:
+                telegramHandlerProfile.PROFILE_SAMPLE_RATE, telegramHandlerProfile.PROFILE_CHAT_IDS = sample_rate, chat_ids
+                telegramHandlerProfile.PROFILE_ENABLED = sample_rate > 0 or len(chat_ids) > 0
+                handler = telegramHandlerProfile.profiled_handler(telegramHandler.get_webhook_chat_ids)(telegramHandler.lambda_handler)
+                _reset_handler_caches()
+                register_fake_clients(size)
+                del captured_output.lines[:]
+                sys.stdout = captured_output
+                try:
+                    handler(create_event("location"), None)
+                    tap_time = time_function(lambda: [handler(event, None) for event in taps]) / len(taps)
+                finally:
+                    sys.stdout = stdout
+                print_result("profile", size, variant, tap_time)
+
+            for message_type, line in [("location", captured_output.lines[0]), ("page turn", captured_output.lines[1])]:
+                profile_record = json.loads(line)
+                print("{:<12} {:>7} {:<34} {:>10.3f} ms, {} stages".format(
+                    "profile", size, message_type + " profile", profile_record['duration'], profile_record['stages']))
+                for function in profile_record['top'][:PROFILE_SHOWN_FUNCTIONS]:
+                    print("{:<12} {:>7}   {:<60} {:>10.3f} ms cumulative, {:>8.3f} ms own, {} calls".format(
+                        "", "", function['function'][:60], function['cumulative'], function['own'], function['calls']))
+    finally:
+        (telegramHandlerProfile.PROFILE_SAMPLE_RATE, telegramHandlerProfile.PROFILE_CHAT_IDS,
+         telegramHandlerProfile.PROFILE_ENABLED) = configured
+
+
+BENCHMARKS = {"distance": benchmark_distance, "cache": benchmark_cache, "callback": benchmark_callback,
+              "render": benchmark_render, "cold-start": benchmark_cold_start, "replay": benchmark_replay,
+              "batch": benchmark_batch, "worker": benchmark_worker, "spatial-index": benchmark_spatial_index,
+              "first-reply": benchmark_first_reply, "view-state": benchmark_view_state,
+              "prefetch": benchmark_prefetch, "payload": benchmark_payload, "outbound": benchmark_outbound,
+              "session-cache": benchmark_session_cache, "profile": benchmark_profile}
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmarks for the telegramHandler hot paths.")
+    parser.add_argument("benchmarks", nargs="*", help="Benchmarks to run, from " + ", ".join(sorted(BENCHMARKS.keys())))
+    parser.add_argument("--sizes", type=int, nargs="+", default=MERCHANT_SET_SIZES, help="Merchant set sizes to run")
+    parser.add_argument("--updates", help="Recorded updates for the replay benchmark, one json per line")
+    arguments = parser.parse_args()
+    for benchmark_name in arguments.benchmarks or sorted(BENCHMARKS.keys()):
+        if benchmark_name not in BENCHMARKS:
+            parser.error("unknown benchmark " + benchmark_name)
+        if benchmark_name == "replay":
+            benchmark_replay(arguments.sizes, arguments.updates)
+        else:
+            BENCHMARKS[benchmark_name](arguments.sizes)
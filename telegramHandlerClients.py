@@ -0,0 +1,127 @@
+import os
+import threading
+import logging
+
+# Connection pool configurations for the keep-alive session to the Telegram Bot API
+HTTP_POOL_CONNECTIONS = int(os.environ.get('HTTP_POOL_CONNECTIONS', 2))  # Number of hosts to keep pools for
+HTTP_POOL_MAXSIZE = int(os.environ.get('HTTP_POOL_MAXSIZE', 8))  # Number of connections kept alive per host
+HTTP_MAX_RETRIES = int(os.environ.get('HTTP_MAX_RETRIES', 1))  # Retries on connection errors only
+LAMBDA_CLIENT_KEY = "lambda.client"
+HTTP_SESSION_KEY = "http.session"
+
+logger = logging.getLogger()
+
+# Clients are kept at module level so that they are reused across invocations on a warm container
+_client_registry = {}
+_client_registry_lock = threading.Lock()
+client_counters = {}  # Number of times each client was built or reused, e.g. {'lambda': {'built': 1, 'reused': 9}}
+# boto3 clients are thread safe and shared, resources and their tables are not, so every thread that uses them, e.g.
+# those of the dispatch pool, builds its own from a session of its own. Replaced on reset, dropping those of every thread.
+_thread_resources = threading.local()
+
+
+# Called with the lock held, the clients are handed out to the dispatch pool threads as well
+def _increment_counter(key, event):
+    counters = client_counters.setdefault(key, {'built': 0, 'reused': 0})
+    counters[event] += 1
+
+
+# Return the client registered under key, building it with the builder function on first use
+def _get_or_build_client(key, builder):
+    client = _client_registry.get(key)
+    if client is None:
+        with _client_registry_lock:
+            client = _client_registry.get(key)
+            if client is None:  # Check again as another thread could have built it while waiting for the lock
+                client = builder()
+                _client_registry[key] = client
+                _increment_counter(key, 'built')
+                logger.debug("Built client " + key + ".")
+                return client
+    with _client_registry_lock:
+        _increment_counter(key, 'reused')
+    return client
+
+
+# Return the resource registered under key, e.g. a fake, or else the one this thread built with the builder function
+def _get_or_build_thread_resource(key, builder):
+    resource = _client_registry.get(key)
+    thread_resources = _thread_resources.__dict__.setdefault('resources', {})
+    event = 'reused'
+    if resource is None:
+        resource = thread_resources.get(key)
+    if resource is None:
+        resource = builder()
+        thread_resources[key] = resource
+        event = 'built'
+        logger.debug("Built resource " + key + " for thread " + threading.current_thread().name + ".")
+    with _client_registry_lock:
+        _increment_counter(key, event)
+    return resource
+
+
+def get_database_resource_key(database_type, database_region):
+    return database_type + ".resource:" + str(database_region)
+
+
+# boto3 and requests are imported by the builders, so that they are only loaded by the invocations that use them
+def _import_boto3():
+    import boto3
+    return boto3
+
+
+def get_database_resource(database_type, database_region):
+    return _get_or_build_thread_resource(get_database_resource_key(database_type, database_region),
+                                         lambda: _import_boto3().session.Session().resource(database_type,
+                                                                                            region_name=database_region))
+
+
+def get_database_client(database_type):
+    return _get_or_build_client(database_type + ".client", lambda: _import_boto3().client(database_type))
+
+
+def get_database_table_key(database_type, database_region, table_name):
+    return database_type + ".table:" + str(database_region) + ":" + table_name
+
+
+def get_database_table(database_type, database_region, table_name):
+    return _get_or_build_thread_resource(get_database_table_key(database_type, database_region, table_name),
+                                         lambda: get_database_resource(database_type, database_region).Table(table_name))
+
+
+def get_lambda_client():
+    return _get_or_build_client(LAMBDA_CLIENT_KEY, lambda: _import_boto3().client('lambda'))
+
+
+def _build_http_session():
+    import requests
+    from requests.adapters import HTTPAdapter
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=HTTP_POOL_CONNECTIONS, pool_maxsize=HTTP_POOL_MAXSIZE,
+                          max_retries=HTTP_MAX_RETRIES)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+# Keep-alive session so that consecutive Telegram calls reuse the same TLS connection
+def get_http_session():
+    return _get_or_build_client(HTTP_SESSION_KEY, _build_http_session)
+
+
+# Register client under key in place of the one that would be built, e.g. a fake in the benchmarks, None builds it again
+def register_client(key, client):
+    with _client_registry_lock:
+        _client_registry[key] = client
+
+
+# Drop every registered client and reset the counters, e.g. between tests or when credentials change
+def reset_clients():
+    global _thread_resources
+    with _client_registry_lock:
+        _thread_resources = threading.local()
+        http_session = _client_registry.get(HTTP_SESSION_KEY)
+        if http_session is not None:
+            http_session.close()
+        _client_registry.clear()
+        client_counters.clear()
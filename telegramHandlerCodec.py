@@ -0,0 +1,105 @@
+import json
+import os
+import zlib
+
+from telegramHandlerHelper import create_merchant_record, normalise_results
+from telegramHandlerMetrics import timed
+
+# Cache format configurations
+LEGACY_RESULT_FORMAT = 1  # Raw json.dumps of the merchant list, items without a ResultFormat attribute
+COMPACT_RESULT_FORMAT = 2  # Columnar layout of the merchant record fields
+RESULT_FORMAT = int(os.environ.get('CACHE_RESULT_FORMAT', COMPACT_RESULT_FORMAT))  # Format used for new writes, both are read. Neither is readable by containers older than the merchant records
+RESULT_COMPRESSION = os.environ.get('CACHE_RESULT_COMPRESSION', "zlib")  # Either "zlib" or "none"
+ZLIB_COMPRESSION_LEVEL = 6
+COMPACT_COLUMNS = ["lat", "lng", "source", "type", "name", "offer", "url", "distance"]
+VIEW_STATE_KEYS = ["searchRadius", "sourcesFilter", "sourcesAvailable"]  # Changed by callbacks without a new search
+VERSION_KEYS = ["viewVersion", "resultVersion"]  # Versions of the items the result was read from, not part of the result
+
+
+# Return the ResultCache attributes holding json_response, in the configured format
+@timed("encode_result")
+def encode_result(json_response, result_format=None, compression=None):
+    result_format = result_format or RESULT_FORMAT
+    compression = compression or RESULT_COMPRESSION
+    if any(key in json_response for key in VERSION_KEYS):  # Read with the result, they are not part of it
+        json_response = dict((key, value) for key, value in json_response.items() if key not in VERSION_KEYS)
+
+    if result_format == LEGACY_RESULT_FORMAT:
+        return {'Result': json.dumps(json_response)}
+    if result_format != COMPACT_RESULT_FORMAT:
+        raise ValueError("Unknown cache result format " + str(result_format) + ".")
+
+    encoded = json.dumps(_to_columns(json_response), separators=(',', ':'))
+    if compression == "zlib":
+        from boto3.dynamodb.types import Binary  # Imports boto3, which is only needed once the result is written
+        return {'Result': Binary(zlib.compress(encoded.encode("utf8"), ZLIB_COMPRESSION_LEVEL)),
+                'ResultFormat': COMPACT_RESULT_FORMAT, 'ResultCompression': compression}
+    if compression != "none":
+        raise ValueError("Unknown cache result compression " + str(compression) + ".")
+    return {'Result': encoded, 'ResultFormat': COMPACT_RESULT_FORMAT, 'ResultCompression': compression}
+
+
+# Return the json_response stored in a ResultCache item, in either the legacy or the compact format
+@timed("decode_result")
+def decode_result(item):
+    result_format = int(item.get('ResultFormat', LEGACY_RESULT_FORMAT))
+    if result_format == LEGACY_RESULT_FORMAT:
+        json_response = json.loads(item['Result'])
+        if len(json_response['locations']) > 0 and 'geoJson' in json_response['locations'][0]:
+            json_response = normalise_results(json_response)  # Written before merchant records were introduced
+        return _apply_versions(json_response, item)
+    if result_format != COMPACT_RESULT_FORMAT:
+        raise ValueError("Unknown cache result format " + str(result_format) + ".")
+
+    encoded = item['Result']
+    if item.get('ResultCompression') == "zlib":
+        encoded = zlib.decompress(getattr(encoded, 'value', encoded)).decode("utf8")  # Binary wraps the raw bytes
+    return _apply_versions(_from_columns(json.loads(encoded)), item)
+
+
+# Return the ViewState attribute of json_response, the part of the cached result that callbacks change
+def encode_view_state(json_response):
+    return json.dumps(dict((key, json_response[key]) for key in VIEW_STATE_KEYS), separators=(',', ':'))
+
+
+# Replace the view state in the result header with the one of the view state item read with it, if it belongs to the
+# same search. The version read is kept as viewVersion, for the conditional update of the next view state.
+def _apply_view_state(json_response, item):
+    if 'ViewState' in item:
+        json_response['viewVersion'] = int(item.get('ViewVersion', 0))
+        if item.get('ViewSearchId') == json_response.get('searchId'):  # Otherwise written for a previous search
+            json_response.update(json.loads(item['ViewState']))
+    return json_response
+
+
+# Apply the view state, and keep the Version of an item written with one as resultVersion, for its conditional write
+def _apply_versions(json_response, item):
+    if 'Version' in item:
+        json_response['resultVersion'] = int(item['Version'])
+    return _apply_view_state(json_response, item)
+
+
+def _to_columns(json_response):
+    columns = dict((column, []) for column in COMPACT_COLUMNS)
+
+    for merchant in json_response['locations']:
+        columns["lat"].append(merchant['latitude'])
+        columns["lng"].append(merchant['longitude'])
+        columns["source"].append(merchant['source'])
+        columns["type"].append(merchant['category'])
+        columns["name"].append(merchant['name'])
+        columns["offer"].append(merchant['offer'])
+        columns["url"].append(merchant['website'])
+        columns["distance"].append(merchant['distance'])
+
+    header = dict((key, value) for key, value in json_response.items() if key != 'locations')
+    return {'v': COMPACT_RESULT_FORMAT, 'header': header, 'columns': columns}
+
+
+def _from_columns(compact_result):
+    json_response = compact_result['header']
+    columns = compact_result['columns']
+    json_response['locations'] = [create_merchant_record(name, lat, lng, source, merchant_type, offer, url, distance)
+                                  for lat, lng, source, merchant_type, name, offer, url, distance
+                                  in zip(*[columns[column] for column in COMPACT_COLUMNS])]
+    return json_response
@@ -1,20 +1,36 @@
-import boto3
 import os
 import json
+import threading
+import time
 import logging
 
+import telegramHandlerClients
+import telegramHandlerCodec
+import telegramHandlerMetrics
+import telegramHandlerUserCache
+from telegramHandlerMetrics import timed
+
 # Database configuration parameters
 database_type = os.environ['AWS_DB_TYPE']  # Default = 'dynamodb'
 database_region = os.environ['AWS_DB_REGION']  # Default = 'ap-southeast-1'
 cache_database_table = os.environ['CACHE_TABLE_NAME']  # Default = 'ResultCache'
 user_database_table = os.environ['USER_TABLE_NAME']
-logging_level = int(os.environ['LOGGING_LEVEL'])
+geo_cell_cache_database_table = os.environ.get('GEO_CELL_CACHE_TABLE_NAME')  # Optional, shared geo query results
+view_state_database_table = os.environ.get('VIEW_STATE_TABLE_NAME')  # Optional, the view state of the chats apart from their results
+VIEW_STATE_ATTRIBUTES = ['ViewState', 'ViewVersion', 'ViewSearchId']  # Added to a result cache item from its view state item
+RESULT_ATTRIBUTES = ['Result', 'ResultFormat', 'ResultCompression']  # Written by telegramHandlerCodec.encode_result
+BATCH_GET_MAX_KEYS = 100  # Limit of a dynamodb BatchGetItem request
+BATCH_GET_MAX_ATTEMPTS = 3  # Attempts for the keys left unprocessed by dynamodb
+
+logger = logging.getLogger()  # Configured by telegramHandler
 
-logger = logging.getLogger()
-logger.setLevel(logging_level)
+# Result cache items of the chats being coalesced, chat id to (item, result written since read, view state written since
+# read), or None before the first read
+_coalesced_results = {}
+_coalesced_results_lock = threading.Lock()
 
 def check_if_cache_table_exists():
-    database_client = boto3.client(database_type)
+    database_client = telegramHandlerClients.get_database_client(database_type)
     try:
         response = database_client.create_table(
             AttributeDefinitions=[
@@ -48,7 +64,7 @@ def check_if_cache_table_exists():
 
 
 def check_if_user_table_exists():
-    database_client = boto3.client(database_type)
+    database_client = telegramHandlerClients.get_database_client(database_type)
     try:
         response = database_client.create_table(
             AttributeDefinitions=[
@@ -81,9 +97,71 @@ def check_if_user_table_exists():
     return
 
 
+# Serve the result cache of the chat from memory until flush_coalesced_results is called, e.g. while a batch of its
+# updates is processed in turn, so that only its first read and its last write reach dynamodb
+def coalesce_results(chat_id):
+    with _coalesced_results_lock:
+        _coalesced_results.setdefault(int(chat_id), None)
+
+
+def _get_coalesced_result(chat_id):
+    with _coalesced_results_lock:
+        coalesced_result = _coalesced_results.get(int(chat_id))
+    return dict(coalesced_result[0]) if coalesced_result is not None else None
+
+
+# Return True if the item is kept in memory instead of being read or written, i.e. the chat is being coalesced
+# The view state coalesced since the last read is dropped, unless is_view_state_kept, e.g. for a result written after it
+def _set_coalesced_result(chat_id, item, is_written, is_view_state_kept=False):
+    with _coalesced_results_lock:
+        if int(chat_id) not in _coalesced_results:
+            return False
+        coalesced_result = _coalesced_results[int(chat_id)]
+        item, is_view_written = dict(item), False
+        if is_view_state_kept and coalesced_result is not None and coalesced_result[2]:
+            item.update((name, coalesced_result[0][name]) for name in VIEW_STATE_ATTRIBUTES if name in coalesced_result[0])
+            is_view_written = True
+        _coalesced_results[int(chat_id)] = (item, is_written, is_view_written)
+        return True
+
+
+# Return True if the view state is kept in memory instead of being written, i.e. the chat is being coalesced
+def _set_coalesced_view_state(chat_id, view_attributes):
+    with _coalesced_results_lock:
+        coalesced_result = _coalesced_results.get(int(chat_id))
+        if coalesced_result is None:
+            return False
+        item = dict(coalesced_result[0])
+        item.update(view_attributes)
+        _coalesced_results[int(chat_id)] = (item, coalesced_result[1], True)
+        return True
+
+
+# Stop coalescing the chat and write its last cached result, return True if there was one to write
+def flush_coalesced_results(chat_id):
+    with _coalesced_results_lock:
+        coalesced_result = _coalesced_results.pop(int(chat_id), None)
+    if coalesced_result is None or not (coalesced_result[1] or coalesced_result[2]):
+        return False
+    item, is_written, is_view_written = coalesced_result
+    if is_written:
+        table = telegramHandlerClients.get_database_table(database_type, database_region, cache_database_table)
+        table.put_item(Item=dict((name, value) for name, value in item.items() if name not in VIEW_STATE_ATTRIBUTES))
+    if is_view_written:  # The updates of the chat in the batch ran in turn, there is no racing update to check for
+        _update_view_state_item(chat_id, item['ViewSearchId'], item['ViewState'])
+    logger.debug("Flushed " + str(chat_id) + "'s coalesced results to " + str(database_type) + "-" + str(cache_database_table) + ".")
+    return True
+
+
+@timed("dynamodb_get_result_cache")
 def get_from_result_cache(chat_id):
-    database = boto3.resource(database_type, region_name=database_region)
-    table = database.Table(cache_database_table)
+    coalesced_item = _get_coalesced_result(chat_id)
+    if coalesced_item is not None:
+        return coalesced_item
+    if view_state_database_table is not None:
+        return _get_from_result_cache_with_view_state(chat_id)
+
+    table = telegramHandlerClients.get_database_table(database_type, database_region, cache_database_table)
 
     response = table.get_item(
         Key={
@@ -91,14 +169,84 @@ def get_from_result_cache(chat_id):
         }
     )
 
+    if "Item" not in response:
+        logger.info(str(chat_id) + " not found in result cache.")
+        return None
     logger.debug("Retrieved Item from Result Cache.")
     logger.debug(response['Item'])
+    telegramHandlerMetrics.put_size("CachedResultBytesRead", len(getattr(response['Item']['Result'], 'value', response['Item']['Result'])), "Bytes")
+    _set_coalesced_result(chat_id, response['Item'], False)
     return response['Item']
 
 
+# Return the result cache item of the chat with the attributes of its view state item, both read with one BatchGetItem
+def _get_from_result_cache_with_view_state(chat_id):
+    items = _batch_get_chat_items(chat_id, {cache_database_table: {'Keys': [{'ChatID': chat_id}]},
+                                            view_state_database_table: {'Keys': [{'ChatID': chat_id}]}})
+    item = items.get(cache_database_table)
+    if item is None:
+        logger.info(str(chat_id) + " not found in result cache.")
+        return None
+    view_state_item = items.get(view_state_database_table)
+    if view_state_item is not None:
+        item.update({'ViewState': view_state_item['ViewState'], 'ViewVersion': view_state_item['ViewVersion'],
+                     'ViewSearchId': view_state_item['SearchId']})
+    logger.debug("Retrieved Item and View State from Result Cache.")
+    telegramHandlerMetrics.put_size("CachedResultBytesRead", len(getattr(item['Result'], 'value', item['Result'])), "Bytes")
+    _set_coalesced_result(chat_id, item, False)
+    return item
+
+
+# Return the items of the chat found by the BatchGetItem request_items, by table name
+def _batch_get_chat_items(chat_id, request_items):
+    database_resource = telegramHandlerClients.get_database_resource(database_type, database_region)
+    items = {}
+
+    for attempt in range(BATCH_GET_MAX_ATTEMPTS):
+        if attempt > 0:
+            time.sleep(0.05 * 2 ** attempt)  # Unprocessed keys are returned when the table is throttled
+        response = database_resource.batch_get_item(RequestItems=request_items)
+        for table_name, table_items in response['Responses'].items():
+            if len(table_items) > 0:
+                items[table_name] = table_items[0]
+        request_items = response.get('UnprocessedKeys')
+        if not request_items:
+            break
+    if request_items:
+        raise RuntimeError("Unable to read " + str(chat_id) + "'s cached result, the batch read was throttled.")
+    return items
+
+
+# Return the versions of the chat's cached result, as resultVersion and, with the view state table, viewVersion, read
+# without the result itself, e.g. to check that a result kept in memory is still the latest one. Returns None if the
+# chat has no cached result.
+@timed("dynamodb_get_result_versions")
+def get_result_cache_versions(chat_id):
+    projection = {'ProjectionExpression': "ChatID, #Version",  # ChatID is returned for an item without a Version
+                  'ExpressionAttributeNames': {'#Version': "Version"}}
+    item = _get_coalesced_result(chat_id)
+    if item is None and view_state_database_table is not None:
+        items = _batch_get_chat_items(chat_id, {cache_database_table: dict(projection, Keys=[{'ChatID': chat_id}]),
+                                                view_state_database_table: {'Keys': [{'ChatID': chat_id}],
+                                                                            'ProjectionExpression': "ViewVersion"}})
+        item = items.get(cache_database_table)
+        if item is not None and view_state_database_table in items:
+            item['ViewVersion'] = items[view_state_database_table].get('ViewVersion', 0)
+    elif item is None:
+        table = telegramHandlerClients.get_database_table(database_type, database_region, cache_database_table)
+        item = table.get_item(Key={'ChatID': chat_id}, **projection).get('Item')
+    if item is None:
+        return None
+
+    versions = {'resultVersion': int(item.get('Version', 0))}
+    if view_state_database_table is not None:
+        versions['viewVersion'] = int(item.get('ViewVersion', 0))
+    return versions
+
+
+@timed("dynamodb_get_user")
 def get_from_user_table(telegram_id):
-    database = boto3.resource(database_type, region_name=database_region)
-    table = database.Table(user_database_table)
+    table = telegramHandlerClients.get_database_table(database_type, database_region, user_database_table)
 
     response = table.get_item(
         Key={
@@ -116,17 +264,21 @@ def get_from_user_table(telegram_id):
 
 
 # Input a list of merchants object to be written to the database
+@timed("dynamodb_put_result_cache")
 def write_to_results_cache(chat_id, json_response):
 
     # check_if_cache_table_exists()
 
-    database = boto3.resource(database_type, region_name=database_region)
-    table = database.Table(cache_database_table)
+    table = telegramHandlerClients.get_database_table(database_type, database_region, cache_database_table)
 
     item = {
-        'ChatID': int(chat_id),
-        'Result': json.dumps(json_response)
+        'ChatID': int(chat_id)
     }
+    item.update(telegramHandlerCodec.encode_result(json_response))
+    telegramHandlerMetrics.put_size("CachedResultBytesWritten", len(getattr(item['Result'], 'value', item['Result'])), "Bytes")
+    if _set_coalesced_result(chat_id, item, True):
+        logger.debug("Coalesced " + str(chat_id) + "'s details.")
+        return True
 
     response = table.put_item(Item=item)
 
@@ -134,13 +286,95 @@ def write_to_results_cache(chat_id, json_response):
     return True
 
 
+# Write the chat's cached result with an UpdateItem that increments its Version, and return the new Version. If
+# expected_version is given, the result is written only if its Version is still expected_version, 0 for an item written
+# without one, so that a result changed by another container since it was read fails with a ConditionalCheckFailedException.
+@timed("dynamodb_update_result_cache")
+def write_versioned_result_to_results_cache(chat_id, json_response, expected_version=None):
+    table = telegramHandlerClients.get_database_table(database_type, database_region, cache_database_table)
+    encoded_item = telegramHandlerCodec.encode_result(json_response)
+    telegramHandlerMetrics.put_size("CachedResultBytesWritten", len(getattr(encoded_item['Result'], 'value', encoded_item['Result'])), "Bytes")
+
+    written_names = [name for name in RESULT_ATTRIBUTES if name in encoded_item]
+    update_expression = "SET " + ", ".join("#" + name + " = :" + name for name in written_names) + " ADD #Version :one"
+    removed_names = [name for name in RESULT_ATTRIBUTES if name not in encoded_item]  # e.g. written in another format before
+    if removed_names:
+        update_expression += " REMOVE " + ", ".join("#" + name for name in removed_names)
+    update_arguments = {'Key': {'ChatID': int(chat_id)}, 'UpdateExpression': update_expression,
+                        'ExpressionAttributeNames': dict(("#" + name, name) for name in RESULT_ATTRIBUTES + ['Version']),
+                        'ExpressionAttributeValues': dict((":" + name, encoded_item[name]) for name in written_names),
+                        'ReturnValues': "UPDATED_NEW"}
+    update_arguments['ExpressionAttributeValues'][':one'] = 1
+    if expected_version == 0:
+        update_arguments['ConditionExpression'] = "attribute_not_exists(#Version)"
+    elif expected_version is not None:
+        update_arguments['ConditionExpression'] = "#Version = :expected_version"
+        update_arguments['ExpressionAttributeValues'][':expected_version'] = expected_version
+
+    try:
+        response = table.update_item(**update_arguments)
+    except Exception as e:
+        if getattr(e, 'response', {}).get('Error', {}).get('Code') == "ConditionalCheckFailedException":
+            telegramHandlerMetrics.add_count("ResultConflicts")
+            logger.warning(str(chat_id) + "'s cached result was changed since version " + str(expected_version) + ".")
+        raise
+
+    version = int(response['Attributes']['Version'])
+    item = {'ChatID': int(chat_id), 'Version': version}
+    item.update(encoded_item)
+    _set_coalesced_result(chat_id, item, False, True)  # Already written, a write behind may come after a view state change
+    logger.debug("Successfully cached " + str(chat_id) + "'s details to " + str(database_type) + "-" + str(cache_database_table) + ".")
+    return version
+
+
+# Write the view state of the chat's cached result, e.g. after a source filter toggle, to the view state table with a
+# small conditional UpdateItem instead of rewriting the result. If the view state was written since json_response was
+# read, e.g. by a racing tap, the update fails with a ConditionalCheckFailedException.
+# Returns the new ViewVersion, or None if the view state is kept in memory until the chat's results are flushed.
+@timed("dynamodb_update_view_state")
+def write_view_state_to_results_cache(chat_id, json_response):
+    view_state = telegramHandlerCodec.encode_view_state(json_response)
+    telegramHandlerMetrics.put_size("ViewStateBytesWritten", len(view_state), "Bytes")
+    if _set_coalesced_view_state(chat_id, {'ViewState': view_state, 'ViewSearchId': json_response['searchId']}):
+        logger.debug("Coalesced " + str(chat_id) + "'s view state.")
+        return None
+
+    try:
+        view_version = _update_view_state_item(chat_id, json_response['searchId'], view_state, json_response.get('viewVersion', 0))
+    except Exception as e:
+        if getattr(e, 'response', {}).get('Error', {}).get('Code') == "ConditionalCheckFailedException":
+            telegramHandlerMetrics.add_count("ViewStateConflicts")
+            logger.warning(str(chat_id) + "'s view state was changed since it was read, version " +
+                           str(json_response.get('viewVersion', 0)) + ".")
+        raise
+
+    logger.debug("Successfully updated " + str(chat_id) + "'s view state in " + str(database_type) + "-" + str(view_state_database_table) + ".")
+    return view_version
+
+
+# Set the view state of the chat and increment its ViewVersion, if expected_version is given only if the ViewVersion is
+# still expected_version, 0 for a chat without a view state item. Returns the new ViewVersion.
+def _update_view_state_item(chat_id, search_id, view_state, expected_version=None):
+    table = telegramHandlerClients.get_database_table(database_type, database_region, view_state_database_table)
+    update_arguments = {'Key': {'ChatID': int(chat_id)},
+                        'UpdateExpression': "SET ViewState = :view_state, SearchId = :search_id ADD ViewVersion :one",
+                        'ExpressionAttributeValues': {':view_state': view_state, ':search_id': search_id, ':one': 1},
+                        'ReturnValues': "UPDATED_NEW"}
+    if expected_version == 0:
+        update_arguments['ConditionExpression'] = "attribute_not_exists(ViewVersion)"
+    elif expected_version is not None:
+        update_arguments['ConditionExpression'] = "ViewVersion = :expected_version"
+        update_arguments['ExpressionAttributeValues'][':expected_version'] = expected_version
+    return int(table.update_item(**update_arguments)['Attributes']['ViewVersion'])
+
+
 # Input a list of merchants object to be written to the database
+@timed("dynamodb_put_user")
 def write_to_user_table(telegram_id, name):
 
     # check_if_user_table_exists()
 
-    database = boto3.resource(database_type, region_name=database_region)
-    table = database.Table(user_database_table)
+    table = telegramHandlerClients.get_database_table(database_type, database_region, user_database_table)
 
     item = {
         'TelegramID': int(telegram_id),
@@ -148,15 +382,59 @@ def write_to_user_table(telegram_id, name):
     }
 
     response = table.put_item(Item=item)
+    telegramHandlerUserCache.mark_user_registered(int(telegram_id))
 
     logger.debug("Successfully wrote " + str(telegram_id) + " " + name + "'s details to " + str(database_type) + "-" + str(user_database_table) + ".")
     return True
 
 
+# Return the user table items found for the telegram ids, by telegram id, and the telegram ids left unprocessed by
+# dynamodb, using BatchGetItem instead of a GetItem per user
+@timed("dynamodb_batch_get_users")
+def batch_get_from_user_table(telegram_ids):
+    database_resource = telegramHandlerClients.get_database_resource(database_type, database_region)
+    telegram_ids = sorted(set(int(telegram_id) for telegram_id in telegram_ids))
+    items, unprocessed_ids = {}, []
+
+    for start in range(0, len(telegram_ids), BATCH_GET_MAX_KEYS):
+        request_items = {user_database_table: {'Keys': [{'TelegramID': telegram_id} for telegram_id in
+                                                        telegram_ids[start:start + BATCH_GET_MAX_KEYS]]}}
+        for attempt in range(BATCH_GET_MAX_ATTEMPTS):
+            if attempt > 0:
+                time.sleep(0.05 * 2 ** attempt)  # Unprocessed keys are returned when the table is throttled
+            response = database_resource.batch_get_item(RequestItems=request_items)
+            for item in response['Responses'].get(user_database_table, []):
+                items[int(item['TelegramID'])] = item
+            request_items = response.get('UnprocessedKeys')
+            if not request_items:
+                break
+        if request_items:
+            unprocessed_ids.extend(int(key['TelegramID']) for key in request_items[user_database_table]['Keys'])
+
+    logger.debug("Retrieved " + str(len(items)) + " of " + str(len(telegram_ids)) + " users from User Table.")
+    return items, unprocessed_ids
+
+
+# Return the telegram ids of every registered user, e.g. to create the bloom snapshot of the user cache
+def scan_user_table_ids():
+    table = telegramHandlerClients.get_database_table(database_type, database_region, user_database_table)
+    telegram_ids = []
+    scan_arguments = {'ProjectionExpression': 'TelegramID'}
+
+    while True:
+        response = table.scan(**scan_arguments)
+        telegram_ids.extend(int(item['TelegramID']) for item in response['Items'])
+        if 'LastEvaluatedKey' not in response:
+            break
+        scan_arguments['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+    logger.info("Scanned " + str(len(telegram_ids)) + " users from " + str(database_type) + "-" + str(user_database_table) + ".")
+    return telegram_ids
+
+
 def remove_from_results_cache(chat_id):
 
-    database = boto3.resource(database_type, region_name=database_region)
-    table = database.Table(cache_database_table)
+    table = telegramHandlerClients.get_database_table(database_type, database_region, cache_database_table)
 
     response = table.delete_item(
         Key={
@@ -166,4 +444,38 @@ def remove_from_results_cache(chat_id):
 
     logger.debug("Removed " + str(chat_id) + "'s results from cache")
     logger.debug(json.dumps(response))
-    return True
\ No newline at end of file
+    return True
+
+
+@timed("dynamodb_get_geo_cell")
+def get_from_geo_cell_cache(cell_key):
+    table = telegramHandlerClients.get_database_table(database_type, database_region, geo_cell_cache_database_table)
+
+    response = table.get_item(
+        Key={
+            'CellKey': cell_key
+        }
+    )
+
+    if "Item" in response:
+        logger.debug("Retrieved " + cell_key + " from Geo Cell Cache.")
+        return response['Item']
+    return None
+
+
+# Input the zlib compressed search result of a geo cell, the item is removed by the dynamodb TTL on ExpiresAt
+@timed("dynamodb_put_geo_cell")
+def write_to_geo_cell_cache(cell_key, compressed_result, expires_at):
+    from boto3.dynamodb.types import Binary
+    table = telegramHandlerClients.get_database_table(database_type, database_region, geo_cell_cache_database_table)
+
+    item = {
+        'CellKey': cell_key,
+        'Result': Binary(compressed_result),
+        'ExpiresAt': int(expires_at)
+    }
+
+    response = table.put_item(Item=item)
+
+    logger.debug("Successfully cached " + cell_key + " to " + str(database_type) + "-" + str(geo_cell_cache_database_table) + ".")
+    return True
@@ -0,0 +1,112 @@
+import os
+import threading
+import time
+import logging
+
+import telegramHandlerMetrics
+import telegramHandlerProfile
+
+# Dispatch configurations
+DISPATCH_POOL_SIZE = int(os.environ.get('DISPATCH_POOL_SIZE', 4))  # 0 runs every dispatched stage inline
+DISPATCH_TIMEOUT = float(os.environ.get('DISPATCH_TIMEOUT', 10))  # Seconds to wait for a dispatched stage
+
+logger = logging.getLogger()
+
+# The pool is kept at module level so that its threads are reused across invocations on a warm container
+_pool = None
+_pool_lock = threading.Lock()
+_pending = threading.local()  # Stages dispatched by the current thread that have not been waited for
+
+
+def _get_pool():
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                from multiprocessing.pool import ThreadPool
+                _pool = ThreadPool(DISPATCH_POOL_SIZE)
+    return _pool
+
+
+def _get_pending_stages():
+    if not hasattr(_pending, 'stages'):
+        _pending.stages = []
+    return _pending.stages
+
+
+# Run the function and return its result together with the time it took in milliseconds, and set done once it ended
+# The spans of the function are recorded into the metrics record of the invocation that dispatched it, and its calls
+# into the profile of the invocation if it is being profiled
+def _run_timed(function, args, kwargs, done, metrics_record=None, profile_session=None):
+    try:
+        with telegramHandlerMetrics.use_record(metrics_record):
+            start_time = time.time()
+            if profile_session is not None:
+                result = profile_session.run(function, args, kwargs)
+            else:
+                result = function(*args, **kwargs)
+            return result, (time.time() - start_time) * 1000.0
+    finally:
+        done.set()
+
+
+class _InlineResult(object):  # Same interface as the AsyncResult of the pool, for stages run inline
+    def __init__(self, function, args, kwargs, done):
+        self._result, self._exception = None, None
+        try:
+            self._result = _run_timed(function, args, kwargs, done)
+        except Exception as e:
+            self._exception = e
+
+    def get(self, timeout=None):
+        if self._exception is not None:
+            raise self._exception
+        return self._result
+
+
+# Run the function in the background, the stage is waited for by the next call of wait_for_dispatched in this thread
+# Stages dispatched by the same thread may run in any order, dispatch them together only if they are independent
+def dispatch(stage_name, function, *args, **kwargs):
+    done = threading.Event()  # Waited for by the stages dispatched after it, an AsyncResult only wakes one of its waiters
+    if DISPATCH_POOL_SIZE > 0:
+        async_result = _get_pool().apply_async(_run_timed, (function, args, kwargs, done,
+                                                            telegramHandlerMetrics.get_current_record(),
+                                                            telegramHandlerProfile.get_current_session()))
+    else:
+        async_result = _InlineResult(function, args, kwargs, done)
+    _get_pending_stages().append((stage_name, async_result, done))
+    logger.debug("Dispatched " + stage_name + ".")
+
+
+# Like dispatch, but the function only starts once the stages this thread dispatched under previous_stage_names are done,
+# e.g. a reply sent once the cache write the next tap reads is made. The pool runs the stages in the order they were
+# dispatched, so the stages waited for are already running and cannot be held up by the one waiting for them.
+def dispatch_after(previous_stage_names, stage_name, function, *args, **kwargs):
+    previous_stages_done = [done for pending_stage_name, async_result, done in _get_pending_stages()
+                            if pending_stage_name in previous_stage_names]
+    dispatch(stage_name, _run_after, previous_stages_done, function, args, kwargs)
+
+
+# The stages waited for may have failed, wait_for_dispatched logs them and the function runs regardless
+def _run_after(previous_stages_done, function, args, kwargs):
+    for done in previous_stages_done:
+        done.wait(DISPATCH_TIMEOUT)
+    return function(*args, **kwargs)
+
+
+# Wait for every stage dispatched by this thread, log their latency and errors, and return True if all of them succeeded
+def wait_for_dispatched():
+    pending_stages = _get_pending_stages()
+    all_succeeded = True
+
+    while pending_stages:
+        stage_name, async_result, done = pending_stages.pop(0)
+        try:
+            result, elapsed = async_result.get(DISPATCH_TIMEOUT)
+            logger.info("Stage " + stage_name + " completed in " + "{:.1f}".format(elapsed) + "ms.")
+            telegramHandlerMetrics.add_duration(stage_name, elapsed)
+        except Exception as e:
+            logger.error("Stage " + stage_name + " failed: " + type(e).__name__ + ": " + str(e))
+            telegramHandlerMetrics.add_count("FailedStages")
+            all_succeeded = False
+    return all_succeeded
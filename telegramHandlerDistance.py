@@ -0,0 +1,93 @@
+import heapq
+import math
+import os
+
+# Distance configurations
+EARTH_RADIUS = 6371008.8  # Mean earth radius in metres
+DISTANCE_MODES = ["geodesic", "haversine", "equirectangular"]
+DISTANCE_MODE = os.environ.get('DISTANCE_MODE', "geodesic")  # Approximations are within 0.5% of geodesic at <= 5km
+
+_numpy = None  # Imported on first use, False if it is not installed
+
+
+# Return the numpy module, or None if it is not installed
+def _get_numpy():
+    global _numpy
+    if _numpy is None:
+        try:
+            import numpy
+            _numpy = numpy
+        except ImportError:  # NumPy is optional, the pure python path gives the same results, only slower
+            _numpy = False
+    return _numpy or None
+
+
+# Compute the distance in metres between the center and every pair of coordinates in one call
+def compute_distances(latitudes, longitudes, center_latitude, center_longitude, mode=None):
+    mode = mode or DISTANCE_MODE
+    if mode not in DISTANCE_MODES:
+        raise ValueError("Unknown distance mode " + str(mode) + ".")
+    if len(latitudes) == 0:
+        return []
+
+    if mode == "geodesic":  # Karney's method is iterative and cannot be vectorised
+        from geopy.distance import geodesic
+        center = (center_latitude, center_longitude)
+        return [geodesic((latitude, longitude), center).meters for latitude, longitude in zip(latitudes, longitudes)]
+    if _get_numpy() is not None:
+        return _compute_distances_numpy(latitudes, longitudes, center_latitude, center_longitude, mode)
+    return _compute_distances_python(latitudes, longitudes, center_latitude, center_longitude, mode)
+
+
+def _compute_distances_numpy(latitudes, longitudes, center_latitude, center_longitude, mode):
+    numpy = _get_numpy()
+    latitudes = numpy.radians(numpy.asarray(latitudes, dtype=numpy.float64))
+    longitudes = numpy.radians(numpy.asarray(longitudes, dtype=numpy.float64))
+    center_latitude, center_longitude = math.radians(center_latitude), math.radians(center_longitude)
+
+    if mode == "haversine":
+        a = numpy.sin((latitudes - center_latitude) / 2.0) ** 2 \
+            + math.cos(center_latitude) * numpy.cos(latitudes) * numpy.sin((longitudes - center_longitude) / 2.0) ** 2
+        return 2.0 * EARTH_RADIUS * numpy.arcsin(numpy.sqrt(numpy.minimum(a, 1.0)))
+
+    x = (longitudes - center_longitude) * numpy.cos((latitudes + center_latitude) / 2.0)
+    y = latitudes - center_latitude
+    return EARTH_RADIUS * numpy.hypot(x, y)
+
+
+def _compute_distances_python(latitudes, longitudes, center_latitude, center_longitude, mode):
+    center_latitude, center_longitude = math.radians(center_latitude), math.radians(center_longitude)
+    cos_center_latitude = math.cos(center_latitude)
+    distances = []
+
+    for latitude, longitude in zip(latitudes, longitudes):
+        latitude, longitude = math.radians(latitude), math.radians(longitude)
+        if mode == "haversine":
+            a = math.sin((latitude - center_latitude) / 2.0) ** 2 \
+                + cos_center_latitude * math.cos(latitude) * math.sin((longitude - center_longitude) / 2.0) ** 2
+            distances.append(2.0 * EARTH_RADIUS * math.asin(math.sqrt(min(a, 1.0))))
+        else:
+            x = (longitude - center_longitude) * math.cos((latitude + center_latitude) / 2.0)
+            distances.append(EARTH_RADIUS * math.hypot(x, latitude - center_latitude))
+    return distances
+
+
+# Return the indices of the distances in ascending order, ties keep their original order like a stable sort
+# If top_k is given, only the indices of the top_k closest are returned, using a partial sort
+def order_by_distance(distances, top_k=None):
+    num_distances = len(distances)
+    numpy = _numpy or None  # Only if compute_distances loaded it, importing numpy costs more than sorting a list
+    if top_k is not None and top_k < num_distances:
+        if top_k <= 0:
+            return []
+        if numpy is not None:
+            distances = numpy.asarray(distances, dtype=numpy.float64)
+            kth_distance = distances[numpy.argpartition(distances, top_k - 1)[top_k - 1]]
+            candidates = numpy.flatnonzero(distances <= kth_distance)  # Includes every tie at the boundary
+            candidates = candidates[numpy.lexsort((candidates, distances[candidates]))]
+            return candidates[:top_k].tolist()
+        return heapq.nsmallest(top_k, range(num_distances), key=distances.__getitem__)
+
+    if numpy is not None:
+        return numpy.argsort(numpy.asarray(distances, dtype=numpy.float64), kind="mergesort").tolist()
+    return sorted(range(num_distances), key=distances.__getitem__)
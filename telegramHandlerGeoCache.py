@@ -0,0 +1,173 @@
+from collections import OrderedDict
+import json
+import math
+import os
+import threading
+import time
+import zlib
+import logging
+
+import telegramHandlerDBWriter
+from telegramHandlerDistance import compute_distances
+from telegramHandlerHelper import MAX_SEARCH_RADIUS
+
+# Geo cell cache configurations
+GEO_CELL_PRECISION = int(os.environ.get('GEO_CELL_PRECISION', 6))  # Geohash length, 6 is a cell of about 1.2km x 0.6km
+GEO_CELL_CACHE_TTL = int(os.environ.get('GEO_CELL_CACHE_TTL', 3600))  # Seconds, the merchant catalogue changes rarely
+GEO_CELL_CACHE_SIZE = int(os.environ.get('GEO_CELL_CACHE_SIZE', 64))  # Number of cells kept in memory
+GEO_CELL_CACHE_DYNAMODB = telegramHandlerDBWriter.geo_cell_cache_database_table is not None
+GEOHASH_ALPHABET = "0123456789bcdefghjkmnpqrstuvwxyz"
+METRES_PER_DEGREE = 111320.0
+
+logger = logging.getLogger()
+
+# The cells are kept at module level so that they are shared by every chat served by a warm container
+_cells = OrderedDict()  # Cell key to (expiry time, search result), least recently used first
+_cells_lock = threading.Lock()
+_default_search_radius = None  # Radius used by the geo database for queries without a searchRadius, learnt from its reply
+geo_cell_cache_counters = {'hits': 0, 'dynamodb_hits': 0, 'misses': 0, 'evictions': 0, 'bypasses': 0}
+
+
+# Encode the coordinates into a geohash of the given precision
+def encode_geohash(latitude, longitude, precision=GEO_CELL_PRECISION):
+    latitude_range, longitude_range = [-90.0, 90.0], [-180.0, 180.0]
+    geohash, bits, num_bits, is_longitude_bit = [], 0, 0, True
+
+    while len(geohash) < precision:
+        coordinate_range, coordinate = (longitude_range, longitude) if is_longitude_bit else (latitude_range, latitude)
+        middle = (coordinate_range[0] + coordinate_range[1]) / 2.0
+        bits <<= 1
+        if coordinate >= middle:
+            bits |= 1
+            coordinate_range[0] = middle
+        else:
+            coordinate_range[1] = middle
+        is_longitude_bit = not is_longitude_bit
+        num_bits += 1
+        if num_bits == 5:
+            geohash.append(GEOHASH_ALPHABET[bits])
+            bits, num_bits = 0, 0
+    return "".join(geohash)
+
+
+# Return the center of the geohash cell, and the distance in metres from the center to its furthest corner
+def decode_geohash_cell(geohash):
+    latitude_range, longitude_range = [-90.0, 90.0], [-180.0, 180.0]
+    is_longitude_bit = True
+
+    for character in geohash:
+        bits = GEOHASH_ALPHABET.index(character)
+        for shift in range(4, -1, -1):
+            coordinate_range = longitude_range if is_longitude_bit else latitude_range
+            middle = (coordinate_range[0] + coordinate_range[1]) / 2.0
+            if (bits >> shift) & 1:
+                coordinate_range[0] = middle
+            else:
+                coordinate_range[1] = middle
+            is_longitude_bit = not is_longitude_bit
+
+    half_height = (latitude_range[1] - latitude_range[0]) / 2.0 * METRES_PER_DEGREE
+    half_width = (longitude_range[1] - longitude_range[0]) / 2.0 * METRES_PER_DEGREE  # Upper bound, at the equator
+    center = ((latitude_range[0] + latitude_range[1]) / 2.0, (longitude_range[0] + longitude_range[1]) / 2.0)
+    return center, math.hypot(half_height, half_width)
+
+
+def _get_from_memory(cell_key):
+    with _cells_lock:
+        cell = _cells.get(cell_key)
+        if cell is None:
+            return None
+        if cell[0] < time.time():
+            del _cells[cell_key]
+            return None
+        _cells[cell_key] = _cells.pop(cell_key)  # Move to the most recently used end
+        return cell[1]
+
+
+def _write_to_memory(cell_key, expires_at, json_response):
+    with _cells_lock:
+        _cells.pop(cell_key, None)
+        _cells[cell_key] = (expires_at, json_response)
+        while len(_cells) > GEO_CELL_CACHE_SIZE:
+            _cells.popitem(last=False)
+            geo_cell_cache_counters['evictions'] += 1
+
+
+def _get_from_dynamodb(cell_key):
+    try:
+        item = telegramHandlerDBWriter.get_from_geo_cell_cache(cell_key)
+    except Exception as e:  # The shared tier is best effort, fall back to querying the geo database
+        logger.warning("Unable to read " + cell_key + " from the geo cell cache: " + str(e))
+        return None
+    if item is None or int(item['ExpiresAt']) < time.time():  # The dynamodb TTL only removes expired items eventually
+        return None
+    json_response = json.loads(zlib.decompress(getattr(item['Result'], 'value', item['Result'])).decode("utf8"))
+    _write_to_memory(cell_key, int(item['ExpiresAt']), json_response)
+    return json_response
+
+
+# Return the geo database result for the search center, shared with every search in the same geohash cell and radius
+# The cell is queried once from its center with a radius grown by the cell size, so that it covers any search in the cell.
+# The result therefore contains merchants further than the searchRadius, up to the complete fetchedRadius of the search.
+# The geo database searches up to MAX_SEARCH_RADIUS, a search that the cell result cannot cover, e.g. one near
+# MAX_SEARCH_RADIUS away from the cell center, is queried directly instead.
+def query_with_geo_cell_cache(search_center_details, query_function):
+    global _default_search_radius
+    search_radius = search_center_details.get('searchRadius', _default_search_radius)
+    if search_radius is None:  # The default radius of the geo database is not known yet, learn it from this query
+        json_response = query_function(search_center_details)
+        _default_search_radius = json_response['searchRadius']
+        return json_response
+
+    geohash = encode_geohash(search_center_details['latitude'], search_center_details['longitude'])
+    (cell_latitude, cell_longitude), cell_radius = decode_geohash_cell(geohash)
+    cell_key = geohash + ":" + str(search_radius)
+    cell_query_radius = min(int(math.ceil(search_radius + cell_radius)), MAX_SEARCH_RADIUS)
+    distance_to_cell = float(compute_distances([search_center_details['latitude']], [search_center_details['longitude']],
+                                               cell_latitude, cell_longitude, "haversine")[0])
+    if cell_query_radius - distance_to_cell < search_radius:
+        geo_cell_cache_counters['bypasses'] += 1
+        return query_function(search_center_details)
+
+    cell_response = _get_from_memory(cell_key)
+    if cell_response is not None:
+        geo_cell_cache_counters['hits'] += 1
+    elif GEO_CELL_CACHE_DYNAMODB:
+        cell_response = _get_from_dynamodb(cell_key)
+        if cell_response is not None:
+            geo_cell_cache_counters['dynamodb_hits'] += 1
+
+    if cell_response is None:
+        geo_cell_cache_counters['misses'] += 1
+        cell_query = dict(search_center_details, latitude=cell_latitude, longitude=cell_longitude,
+                          searchRadius=cell_query_radius)
+        cell_response = query_function(cell_query)
+        expires_at = int(time.time()) + GEO_CELL_CACHE_TTL
+        _write_to_memory(cell_key, expires_at, cell_response)
+        if GEO_CELL_CACHE_DYNAMODB:
+            try:
+                telegramHandlerDBWriter.write_to_geo_cell_cache(cell_key, zlib.compress(json.dumps(cell_response).encode("utf8")),
+                                                                expires_at)
+            except Exception as e:  # The shared tier is best effort, e.g. results over the dynamodb item size limit
+                logger.warning("Unable to write " + cell_key + " to the geo cell cache: " + str(e))
+    logger.debug("Geo cell cache " + str(geo_cell_cache_counters) + ".")
+
+    # Only what the geo database actually searched is complete, it may have searched less than the cell query asked for
+    fetched_radius = float(cell_response['searchRadius']) - distance_to_cell
+    if fetched_radius < search_radius:
+        geo_cell_cache_counters['bypasses'] += 1
+        return query_function(search_center_details)
+
+    # The merchants are shared between searches, only the radii of this search are set on the returned copy
+    json_response = dict(cell_response, searchRadius=search_radius)
+    json_response['fetchedRadius'] = fetched_radius
+    return json_response
+
+
+def reset_geo_cell_cache():
+    global _default_search_radius
+    with _cells_lock:
+        _cells.clear()
+    _default_search_radius = None
+    for counter in geo_cell_cache_counters:
+        geo_cell_cache_counters[counter] = 0
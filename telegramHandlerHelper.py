@@ -1,9 +1,11 @@
-from geopy.distance import geodesic
+import itertools
 import json
 import re
-import os
 import logging
 
+from telegramHandlerDistance import compute_distances, order_by_distance
+from telegramHandlerMetrics import timed
+
 APPROVED_CATEGORIES = [1]
 MAX_NUM_RESULTS_PER_PAGE = 20  # Max permited is 26, the number of letters in the alphabets
 RADIUS_CHANGE = 250  # Increasing or decreasing the radius changes it by 250 each time
@@ -11,17 +13,22 @@ MAX_SEARCH_RADIUS = 5000
 SOURCE_DESC_NUM_MAP = {"ENTR": 1, "CITI": 2, "OCBC": 3}
 SOURCE_NUM_DESC_MAP = {1: "ENTR", 2: "CITI", 3: "OCBC"}
 SOURCE_NUM_FULLDESC_MAP = {1: "Entertainer", 2: "Citi", 3: "OCBC"}
+MAX_OFFER_DESCRIPTION_LENGTH = 100  # Longer offer descriptions are not displayed
+GOOGLE_MAPS_URL = "http://maps.google.com/maps?q=loc:"
 
-# Logging configurations
-LOGGING_LEVEL = int(os.environ['LOGGING_LEVEL'])
-logger = logging.getLogger()
-logger.setLevel(LOGGING_LEVEL)
+logger = logging.getLogger()  # Configured by telegramHandler
 
 # Emojis
 location_emoji = u'\U0001F4CD'  # Location pin
 check_mark_emoji = u'\U00002705'  # check mark for filter
 cross_mark_emoji = u'\U0000274E'  # cross mark for cancel filter
 red_cross_mark_emoji = u'\U0000274C'  # RED cross mark for result not available
+MARKER_COLOUR = "144,238,144"  # Light green colour of the merchant markers on the onemap
+
+# Offer description patterns
+return_voucher_pattern = re.compile("SGD\d+ return voucher")
+percentage_off_pattern = re.compile("\d+% off")
+amount_off_pattern = re.compile("SGD\d+ off")
 
 
 # A. Distance Related Methods #########
@@ -29,39 +36,90 @@ red_cross_mark_emoji = u'\U0000274C'  # RED cross mark for result not available
 
 # Compute the distance between two pairs of coordinates
 def compute_distance(latitude_A, longitude_A, latitude_B, longitude_B):
+    from geopy.distance import geodesic
     location_A = (latitude_A, longitude_A)
     location_B = (latitude_B, longitude_B)
     return geodesic(location_A, location_B).meters
 
 
 # Filter merchant details based on the top_N closest merchant from the center
-def sort_results_by_distance(json_response, center_lat_lng):
+# If top_k is given, only the top_k closest are sorted, the others follow in their original order and sortedCount is set
+@timed("sort_results_by_distance")
+def sort_results_by_distance(json_response, center_lat_lng, top_k=None):
     logger.debug("Sorting results by distance")
     json_result = {'searchRadius': json_response['searchRadius'],
                     'searchCenterLatitude': center_lat_lng['latitude'],
                     'searchCenterLongitude': center_lat_lng['longitude']}
-    json_location_sorted_arr = []
-    location_temp_arr = []
-    center_latitude, center_longitude = center_lat_lng['latitude'], center_lat_lng['longitude']
-
-    # Compute the distance for each merchant and update the merchant json information with the distance
-    for merchant in json_response['locations']:
-        coordinates = json.loads(str(merchant['geoJson']['S']))
-        latitude, longitude = coordinates['coordinates'][1], coordinates['coordinates'][0]
-        distance = compute_distance(latitude, longitude, center_latitude, center_longitude)
-        merchant['stadinceFromCenter'] = distance
-        location_temp_arr.append((distance, merchant))
-    location_temp_arr.sort(key=lambda tup: tup[0])  # Sort the merchants by distance
-
-    # Add the sorted merchant list back into the array
-    for i in range(len(location_temp_arr)):
-        json_location_sorted_arr.append(location_temp_arr[i][1])
-
-    json_result['locations'] = json_location_sorted_arr
+    merchants = json_response['locations']
+    latitudes, longitudes = [], []
+
+    for merchant in merchants:
+        latitudes.append(merchant['latitude'])
+        longitudes.append(merchant['longitude'])
+
+    # Compute the distance of every merchant in one batch and set it on a copy of the merchant record, the records may be
+    # shared, e.g. by the searches served from one geo cell or by the cached result being sorted for another center
+    distances = compute_distances(latitudes, longitudes, center_lat_lng['latitude'], center_lat_lng['longitude'])
+    merchants = [dict(merchant, distance=float(distance)) for merchant, distance in zip(merchants, distances)]
+
+    if top_k is not None and top_k < len(merchants):  # Only the first page is needed for the reply
+        top_indices = order_by_distance(distances, top_k=top_k)
+        top_indices_set = set(top_indices)
+        json_result['locations'] = [merchants[i] for i in top_indices] + \
+                                   [merchant for i, merchant in enumerate(merchants) if i not in top_indices_set]
+        json_result['sortedCount'] = len(top_indices)
+    else:
+        json_result['locations'] = [merchants[i] for i in order_by_distance(distances)]  # Sort the merchants by distance
+    if 'fetchedRadius' in json_response:
+        json_result['fetchedRadius'] = json_response['fetchedRadius']
     logger.debug("Sort by distance successful")
     return json_result
 
 
+# Return a copy of the result with every merchant sorted, the same order as a full sort_results_by_distance
+# The merchants after the sortedCount closest are stably sorted, their ties keep their original order as in a full sort
+@timed("complete_sort_by_distance")
+def complete_sort_by_distance(json_response):
+    sorted_count = json_response.get('sortedCount')
+    if sorted_count is None:
+        return json_response
+    json_result = dict((key, value) for key, value in json_response.items() if key != 'sortedCount')
+    locations = json_response['locations']
+    json_result['locations'] = locations[:sorted_count] + sorted(locations[sorted_count:], key=lambda merchant: merchant['distance'])
+    return json_result
+
+
+# Return True if the merchants up to end_index after filtering are all among the sortedCount already sorted
+def is_sorted_up_to(json_response, end_index, sources_filter=None):
+    sorted_locations = itertools.islice(json_response['locations'], json_response['sortedCount'])
+    if 'fetchedRadius' in json_response:
+        sorted_locations = (merchant for merchant in sorted_locations if merchant['distance'] <= json_response['searchRadius'])
+    num_sorted = sum(1 for _ in itertools.islice(iterate_filtered_merchants(sorted_locations, sources_filter), end_index))
+    return num_sorted >= end_index
+
+
+# Return the number of merchants, sorted by distance, that are within the radius, using a binary search
+def count_results_within_radius(locations, radius):
+    low, high = 0, len(locations)
+    while low < high:
+        middle = (low + high) // 2
+        if locations[middle]['distance'] <= radius:
+            low = middle + 1
+        else:
+            high = middle
+    return low
+
+
+# Iterate over the sorted merchants within the search radius, if the cached merchants were fetched for a larger radius
+def iterate_results_within_radius(json_response):
+    locations = json_response['locations']
+    if 'fetchedRadius' in json_response:
+        if 'sortedCount' in json_response:  # Partly sorted, the merchants after the sorted ones are all further away
+            return (merchant for merchant in locations if merchant['distance'] <= json_response['searchRadius'])
+        return itertools.islice(locations, count_results_within_radius(locations, json_response['searchRadius']))
+    return iter(locations)
+
+
 # B. Filter Related Methods #########
 
 # Filter the merchant categories to that listed in the APPROVED_CATEGORY variable, and return the merchant sources that contains it
@@ -71,8 +129,8 @@ def filter_merchant_source_and_category(json_response, sources_filter=None):  #
     sources_available = set()
 
     for merchant in json_response['locations']:
-        merchant_category = int(merchant['Type']['N'])
-        data_source_num = int(merchant['Source']['N'])
+        merchant_category = merchant['category']
+        data_source_num = merchant['source']
         # if merchant_category in APPROVED_CATEGORIES and data_source_num in data_sources:
         if merchant_category in APPROVED_CATEGORIES:
             if sources_filter is None or data_source_num in sources_filter:
@@ -83,46 +141,72 @@ def filter_merchant_source_and_category(json_response, sources_filter=None):  #
     return json_result, list(sources_available)
 
 
-# Obtain the results for a given page number from the entire result set
-def paginate_results(json_response, page_number):
-    logger.debug("Paginating results.")
+# Yield the merchants in the approved categories, further filtered by sources if sources_filter is given
+def iterate_filtered_merchants(locations, sources_filter=None):
+    for merchant in locations:
+        if merchant['category'] in APPROVED_CATEGORIES:
+            if sources_filter is None or merchant['source'] in sources_filter:
+                yield merchant
+
+
+# Filter, sort and paginate in a single pass, same result as filtering the whole result with filter_merchant_source_and_category,
+# sorting it with sort_results_by_distance and slicing out the page, but only the merchants on the requested page (starting from 1) are kept
+@timed("select_results_page")
+def select_results_page(json_response, page_number, sources_filter=None, center_lat_lng=None):
+    logger.debug("Selecting results page.")
+    if center_lat_lng is not None and (json_response.get('searchCenterLatitude') != center_lat_lng['latitude'] or
+                                       json_response.get('searchCenterLongitude') != center_lat_lng['longitude']):
+        json_response = sort_results_by_distance(json_response, center_lat_lng)  # Not yet sorted for this search center
+
+    start_index, end_index = (page_number-1)*MAX_NUM_RESULTS_PER_PAGE, page_number*MAX_NUM_RESULTS_PER_PAGE
+    if 'sortedCount' in json_response and not is_sorted_up_to(json_response, end_index, sources_filter):
+        json_response = complete_sort_by_distance(json_response)  # The page reaches past the merchants already sorted
+
     json_result = {'searchRadius': json_response['searchRadius'],
-                    'searchCenterLatitude': json_response['searchCenterLatitude'],
-                    'searchCenterLongitude': json_response['searchCenterLongitude']}
-    json_location_temp_arr = []
+                   'searchCenterLatitude': json_response['searchCenterLatitude'],
+                   'searchCenterLongitude': json_response['searchCenterLongitude']}
+    if json_response.get('searchId') is not None:  # Identifies the page for the render cache
+        json_result['searchId'] = json_response['searchId']
+        json_result['sourcesFilter'] = sources_filter
+    json_location_page_arr = []
+    sources_available = set()
+    total_items = 0
 
-    start_index = min((page_number-1)*MAX_NUM_RESULTS_PER_PAGE, len(json_response['locations']))  # Index starts from 0
-    end_index = min(page_number*MAX_NUM_RESULTS_PER_PAGE, len(json_response['locations']))  # Index ends at length-1
+    for merchant in iterate_filtered_merchants(iterate_results_within_radius(json_response), sources_filter):
+        if start_index <= total_items < end_index:
+            json_location_page_arr.append(merchant)
+        sources_available.add(merchant['source'])
+        total_items += 1
 
-    if (start_index == end_index and start_index == len(json_response['locations'])):
+    if start_index >= total_items:
         json_result['locations'] = []
         json_result['totalItems'] = 0
         logger.debug("No contents for this page")
     else:
-        for i in range(start_index, end_index):
-            json_location_temp_arr.append(json_response['locations'][i])
-        json_result['locations'] = json_location_temp_arr
+        json_result['locations'] = json_location_page_arr
         json_result['startItemNumber'] = start_index + 1
-        json_result['endItemNumber'] = end_index
-        json_result['totalItems'] = len(json_response['locations'])
-        logger.debug("Paginating completed.")
-    print json_result
-    return json_result
+        json_result['endItemNumber'] = min(end_index, total_items)
+        json_result['totalItems'] = total_items
+        logger.debug("Selecting results page completed.")
+    return json_result, list(sources_available)
 
 
 # C. JSON Formatting Related Method
 
 # Summarize offer details
 def condense_offer_description(text):
-    if re.search("SGD\d+ return voucher", text) is not None:
-        text = re.search("SGD\d+ return voucher", text).group()
+    match = return_voucher_pattern.search(text)
+    if match is not None:
+        text = match.group()
         text = text.replace('SGD', '$', 1).replace('return ', '', 1).strip()
         return text.strip()
-    if re.search("\d+% off", text) is not None:
-        text = re.search("\d+% off", text).group()
+    match = percentage_off_pattern.search(text)
+    if match is not None:
+        text = match.group()
         return text.strip()
-    if re.search("SGD\d+ off", text) is not None:
-        text = re.search("SGD\d+ off", text).group().replace('SGD', '$', 1). strip()
+    match = amount_off_pattern.search(text)
+    if match is not None:
+        text = match.group().replace('SGD', '$', 1). strip()
     return text.strip()
 
 
@@ -133,51 +217,41 @@ def update_source_filters(json_response, sources_filter, sources_available):
     return json_response
 
 
-# Convert a json_reply from dynamodb into a telegram markdown reply
+# Format the markdown line and the onemap marker of a merchant displayed with the given letter label
+def format_location_fragments(location, label):
+    marker = "|[" + str(location['latitude']) + "," + str(location['longitude']) + ",%22" + MARKER_COLOUR + "%22,%22" + label + "%22]"
+    line_parts = ["*", label, ". ", str(location['name']), "* [", location_emoji, "](", location['mapUrl'], ")",
+                  "[(", SOURCE_NUM_FULLDESC_MAP.get(location['source']), ")](", str(location['website']), ")"]  # Print the data source
+    if location['offer']:  # Print additional info about discount/deal, the offer is already condensed during normalisation
+        line_parts.extend([" - ", location['offer']])
+    line_parts.append("\n")
+    return "".join(line_parts), marker
+
+
+# Convert a page of merchant records into a telegram markdown reply
+@timed("format_json_response")
 def format_json_response(json_response):
     logger.debug("Formatting JSON response.")
     if json_response is None or len(json_response['locations']) == 0:
         logger.debug("Sorry, there are no results to format.")
         return "Sorry, there are no results :("
 
-    locations = json_response
-
     # Format the onemap_url with the centerpoint
-    onemap_url = "https://developers.onemap.sg/commonapi/staticmap/getStaticImage?layerchosen=default&lat=" \
-                 + str(json_response['searchCenterLatitude']) + "&lng=" + str(json_response['searchCenterLongitude']) + "&zoom=15&height=512&width=512&points=[" \
-                 + str(json_response['searchCenterLatitude']) + "," + str(json_response['searchCenterLongitude']) + ",%22255,0,0%22]"
-
-    output_string = ""
-    counter = 'A'
-    marker_colour = "144,238,144"  # Light green colour
-
-    for location in locations['locations']:
+    center = str(json_response['searchCenterLatitude']) + "," + str(json_response['searchCenterLongitude'])
+    onemap_url_parts = ["https://developers.onemap.sg/commonapi/staticmap/getStaticImage?layerchosen=default&lat=",
+                        str(json_response['searchCenterLatitude']), "&lng=", str(json_response['searchCenterLongitude']),
+                        "&zoom=15&height=512&width=512&points=[", center, ",%22255,0,0%22]"]
+    output_parts = []
 
-        # Insert the coordinate of the current merchant into the onemap_url
-        coordinates = json.loads(str(location['geoJson']['S']))
-        longitude = coordinates['coordinates'][0]
-        latitude = coordinates['coordinates'][1]
-        onemap_url = onemap_url + "|[" + str(latitude) + "," + str(longitude) + ",%22" + marker_colour + "%22,%22" + counter + "%22]"
-
-        # Output the remaining details
-        output_string = output_string + "*" + counter + ". " + str(location['Name']['S']) + "* ["+ location_emoji + "](http://maps.google.com/maps?q=loc:" + str(latitude) + "," + str(longitude) + ")"
-
-        data_source = int(location['Source']['N'])
-        additional_details = json.loads(str(location['AdditionalDetails']['S']))
-
-        # Print the data source
-        output_string = output_string + "[(" + SOURCE_NUM_FULLDESC_MAP.get(data_source) + ")](" + str(additional_details['SourceWebsite']) + ")"
-
-        # Print additional info about discount/deal
-        if additional_details.get('OfferDetails') and len(str(additional_details['OfferDetails'])) < 100:
-            output_string = output_string + " - " + condense_offer_description(str(additional_details['OfferDetails']))
-        output_string = output_string + "\n"
-        counter = chr(ord(counter)+1) # Increment to the next alphabet
+    for index, location in enumerate(json_response['locations']):
+        line, marker = format_location_fragments(location, chr(ord('A') + index))  # Label the merchants alphabetically
+        output_parts.append(line)
+        onemap_url_parts.append(marker)  # Insert the coordinate of the current merchant into the onemap_url
 
     # Add in the onemap_url
-    output_string = "*Cheapo found*[ ](" + onemap_url + ")*" + str(json_response['totalItems']) + " results in a " + str(json_response['searchRadius']) + "m radius!*\nDisplaying results " + str(json_response['startItemNumber']) + " to " + str(json_response['endItemNumber']) + "\n\n" + output_string
+    header = "*Cheapo found*[ ](" + "".join(onemap_url_parts) + ")*" + str(json_response['totalItems']) + " results in a " + str(json_response['searchRadius']) + "m radius!*\nDisplaying results " + str(json_response['startItemNumber']) + " to " + str(json_response['endItemNumber']) + "\n\n"
     logger.debug("Formatting JSON response completed.")
-    return output_string
+    return header + "".join(output_parts)
 
 
 # D. Keyboard Formatting Related Methods
@@ -222,4 +296,44 @@ def create_reply_keyboard_page_markup(current_page, max_page, cur_radius, source
 
 
 def create_inline_keyboard_button(button_data, callback_data):
-    return {"text": button_data, "callback_data": callback_data}
\ No newline at end of file
+    return {"text": button_data, "callback_data": callback_data}
+
+
+# E. Normalisation Related Methods
+
+# Create the record that the helper methods use for a merchant, all fields are parsed from the raw merchant once
+def create_merchant_record(name, latitude, longitude, source, category, offer, website, distance=None):
+    return {'name': name,
+            'latitude': latitude,
+            'longitude': longitude,
+            'source': source,
+            'category': category,
+            'offer': offer,
+            'website': website,
+            'mapUrl': GOOGLE_MAPS_URL + str(latitude) + "," + str(longitude),
+            'distance': distance}
+
+
+# Convert a merchant in the dynamodb format returned by queryGeoDatabase into a merchant record
+def normalise_merchant(merchant):
+    coordinates = json.loads(str(merchant['geoJson']['S']))
+    additional_details = json.loads(str(merchant['AdditionalDetails']['S']))
+
+    offer_details = additional_details.get('OfferDetails')
+    if offer_details and len(str(offer_details)) < MAX_OFFER_DESCRIPTION_LENGTH:
+        offer_details = condense_offer_description(str(offer_details))
+    else:
+        offer_details = ""
+
+    return create_merchant_record(merchant['Name']['S'], coordinates['coordinates'][1], coordinates['coordinates'][0],
+                                  int(merchant['Source']['N']), int(merchant['Type']['N']), offer_details,
+                                  additional_details['SourceWebsite'], merchant.get('stadinceFromCenter'))
+
+
+# Convert every merchant of a new search result into a merchant record, the records of the spatial index already are
+@timed("normalise_results")
+def normalise_results(json_response):
+    json_result = dict((key, value) for key, value in json_response.items() if key != 'locations')
+    json_result['locations'] = [normalise_merchant(merchant) if 'geoJson' in merchant else merchant
+                                for merchant in json_response['locations']]
+    return json_result
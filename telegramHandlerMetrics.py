@@ -0,0 +1,177 @@
+from collections import OrderedDict
+import functools
+import json
+import os
+import sys
+import threading
+import time
+import logging
+
+# Metrics configurations
+METRICS_ENABLED = os.environ.get('METRICS_ENABLED', "false").lower() == "true"  # Emit one metrics record per invocation
+METRICS_NAMESPACE = os.environ.get('METRICS_NAMESPACE', "Cheapo")  # CloudWatch namespace of the embedded metrics
+METRICS_DIMENSIONS = [["MessageType"], ["MessageType", "ColdStart"]]
+
+logger = logging.getLogger()
+
+_current = threading.local()  # Record of the invocation being served by this thread, or by the thread that dispatched a stage
+_is_cold_start = True  # Only the first invocation of a container is a cold start
+
+
+class _InvocationRecord(object):  # Durations, sizes and properties collected during one invocation
+    def __init__(self):
+        self.start_time = time.time()
+        self.metrics = OrderedDict()  # Metric name to [value, unit], in the order they were first recorded
+        self.properties = {}
+        self.lock = threading.Lock()  # Dispatched stages record from the pool threads
+
+    def add(self, name, value, unit):
+        with self.lock:
+            if name in self.metrics:
+                self.metrics[name][0] += value
+            else:
+                self.metrics[name] = [value, unit]
+
+    def put(self, name, value, unit):
+        with self.lock:
+            self.metrics[name] = [value, unit]
+
+
+class _NullContext(object):  # Returned when there is nothing to record, so that the with statement costs a call only
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exception_type, exception, traceback):
+        return False
+
+
+_NULL_CONTEXT = _NullContext()
+
+
+class _Span(object):
+    def __init__(self, record, stage_name):
+        self.record, self.stage_name = record, stage_name
+
+    def __enter__(self):
+        self.start_time = time.time()
+        return self
+
+    def __exit__(self, exception_type, exception, traceback):
+        self.record.add(self.stage_name, (time.time() - self.start_time) * 1000.0, "Milliseconds")
+        return False
+
+
+class _UseRecord(object):
+    def __init__(self, record):
+        self.record = record
+
+    def __enter__(self):
+        self.previous_record = getattr(_current, 'record', None)
+        _current.record = self.record
+        return self
+
+    def __exit__(self, exception_type, exception, traceback):
+        _current.record = self.previous_record
+        return False
+
+
+def get_current_record():
+    return getattr(_current, 'record', None)
+
+
+# Record into the given invocation record within the with block, e.g. in the pool thread running a dispatched stage
+def use_record(record):
+    if record is None:
+        return _NULL_CONTEXT
+    return _UseRecord(record)
+
+
+# Time the with block as stage_name of the current invocation, the durations of repeated stages are added up
+def span(stage_name):
+    record = getattr(_current, 'record', None)
+    if record is None:
+        return _NULL_CONTEXT
+    return _Span(record, stage_name)
+
+
+# Decorator timing every call of the function as stage_name, the function is left as is when the metrics are disabled
+def timed(stage_name):
+    def decorator(function):
+        if not METRICS_ENABLED:
+            return function
+
+        @functools.wraps(function)
+        def timed_function(*args, **kwargs):
+            with span(stage_name):
+                return function(*args, **kwargs)
+        return timed_function
+    return decorator
+
+
+def add_duration(stage_name, milliseconds):
+    record = getattr(_current, 'record', None)
+    if record is not None:
+        record.add(stage_name, milliseconds, "Milliseconds")
+
+
+# Add value to the metric, e.g. the number of failed stages
+def add_count(name, value=1):
+    record = getattr(_current, 'record', None)
+    if record is not None:
+        record.add(name, value, "Count")
+
+
+# Set the metric, e.g. put_size("CachedResultBytes", 2048, "Bytes") or put_size("MerchantCount", 120)
+def put_size(name, value, unit="Count"):
+    record = getattr(_current, 'record', None)
+    if record is not None:
+        record.put(name, value, unit)
+
+
+# Set a property of the record, MessageType is also the dimension of every metric
+def set_property(name, value):
+    record = getattr(_current, 'record', None)
+    if record is not None:
+        record.properties[name] = value
+
+
+# Return the record as a CloudWatch embedded metric format log line
+def format_record(record, end_time=None):
+    end_time = end_time or time.time()
+    properties = {'MessageType': "unknown"}
+    properties.update(record.properties)
+    metric_definitions = [{'Name': "Duration", 'Unit': "Milliseconds"}]
+    emf_record = {'Duration': (end_time - record.start_time) * 1000.0}
+
+    for name, (value, unit) in record.metrics.items():
+        metric_definitions.append({'Name': name, 'Unit': unit})
+        emf_record[name] = value
+    emf_record.update(properties)
+    emf_record['_aws'] = {'Timestamp': int(end_time * 1000),
+                          'CloudWatchMetrics': [{'Namespace': METRICS_NAMESPACE, 'Dimensions': METRICS_DIMENSIONS,
+                                                 'Metrics': metric_definitions}]}
+    return json.dumps(emf_record, default=str)
+
+
+# Decorator for the lambda handlers, records the invocation and writes its record to stdout, where lambda forwards the
+# embedded metrics to cloudwatch. The handler is left as is when the metrics are disabled.
+def instrumented_handler(handler):
+    if not METRICS_ENABLED:
+        return handler
+
+    @functools.wraps(handler)
+    def instrumented(event, context=None):
+        global _is_cold_start
+        record = _InvocationRecord()
+        record.properties['ColdStart'] = "true" if _is_cold_start else "false"
+        _is_cold_start = False
+        with use_record(record):
+            try:
+                return handler(event, context)
+            finally:
+                try:
+                    sys.stdout.write(format_record(record) + "\n")
+                    sys.stdout.flush()
+                except Exception:  # Metrics never fail the invocation
+                    logger.exception("Unable to write the metrics record.")
+    return instrumented
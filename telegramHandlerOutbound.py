@@ -0,0 +1,358 @@
+from collections import OrderedDict, deque
+import hashlib
+import heapq
+import itertools
+import os
+import threading
+import time
+import logging
+
+try:
+    import Queue as queue
+except ImportError:  # Python 3
+    import queue
+
+import telegramHandlerMetrics
+
+# Outbound configurations
+TELEGRAM_GLOBAL_RATE = float(os.environ.get('TELEGRAM_GLOBAL_RATE', 30))  # Calls per second to the Bot API across every chat
+TELEGRAM_GLOBAL_BURST = float(os.environ.get('TELEGRAM_GLOBAL_BURST', 30))  # Calls sent at once before the global rate applies
+TELEGRAM_CHAT_RATE = float(os.environ.get('TELEGRAM_CHAT_RATE', 1))  # Calls per second to a single chat
+TELEGRAM_CHAT_BURST = float(os.environ.get('TELEGRAM_CHAT_BURST', 3))  # Calls sent at once to a chat before its rate applies
+TELEGRAM_MAX_RETRIES = int(os.environ.get('TELEGRAM_MAX_RETRIES', 3))  # Retries on 429, 5xx and connection errors
+TELEGRAM_RETRY_DELAY = float(os.environ.get('TELEGRAM_RETRY_DELAY', 0.5))  # Seconds before the first retry without retry_after, doubled per retry
+TELEGRAM_SENDER_THREADS = int(os.environ.get('TELEGRAM_SENDER_THREADS', 4))  # Chats sent to at the same time
+TELEGRAM_SEND_TIMEOUT = float(os.environ.get('TELEGRAM_SEND_TIMEOUT', 10))  # Seconds to wait for a call to be sent
+TELEGRAM_CHAT_STATES = int(os.environ.get('TELEGRAM_CHAT_STATES', 1000))  # Chats whose rate and last sent messages are kept
+TELEGRAM_SENT_MESSAGES = 10  # Messages per chat whose last sent content is kept
+EDIT_FUNCTION_NAME = "/editMessageText"
+SEND_FUNCTION_NAME = "/sendMessage"
+CONTENT_FIELDS = ["text", "parse_mode", "reply_markup", "disable_web_page_preview"]
+NOT_MODIFIED_DESCRIPTION = "message is not modified"  # Of the 400 answered to an edit identical to the message
+
+logger = logging.getLogger()  # Configured by telegramHandler
+
+# The scheduler is kept at module level so that the rates and the last sent messages carry across invocations
+_scheduler = None
+_scheduler_lock = threading.Lock()
+
+
+class TokenBucket(object):  # Allows rate calls per second on average, and up to burst calls at once
+    def __init__(self, rate, burst, now):
+        self.rate, self.burst = rate, burst
+        self.tokens = burst
+        self.updated_at = now
+
+    # Take a token and return the seconds to wait before using it, taking ahead of time makes later callers wait longer
+    def reserve(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+        self.tokens -= 1
+        return max(0.0, -self.tokens / self.rate)
+
+
+class _ChatState(object):  # Rate and last sent messages of a chat
+    def __init__(self, now):
+        self.bucket = TokenBucket(TELEGRAM_CHAT_RATE, TELEGRAM_CHAT_BURST, now)
+        self.blocked_until = 0  # Set from the retry_after of a 429
+        self.sent_hashes = OrderedDict()  # Message id to the hash of the content it was last sent or edited with
+
+
+class _OutboundRequest(object):  # A Bot API call, done once it is sent, skipped or superseded by a later edit
+    def __init__(self, function_name, data, post_function):
+        self.function_name, self.data, self.post_function = function_name, data, post_function
+        self.chat_id = data.get("chat_id")
+        self.message_id = data.get("message_id") if function_name == EDIT_FUNCTION_NAME else None
+        self.metrics_record = telegramHandlerMetrics.get_current_record()
+        self.is_superseded = False
+        self.attempt = 0
+        self.retry_delay = TELEGRAM_RETRY_DELAY
+        self.blocked_until = 0  # Set from a retry delay, or from the retry_after of a 429 to a call without a chat
+        self.send_at = None  # Time the tokens taken for the next attempt can be used, None until they are taken
+        self.done = threading.Event()
+        self.response, self.exception = None, None
+
+    def get_edit_key(self):
+        return (self.chat_id, self.message_id) if self.message_id is not None else None
+
+    def finish(self, response=None, exception=None):
+        self.response, self.exception = response, exception
+        self.done.set()
+
+    # Return the response, or None if the call was not sent as it was superseded or identical to the last one
+    def wait(self, timeout=TELEGRAM_SEND_TIMEOUT):
+        if not self.done.wait(timeout):
+            raise RuntimeError("Timed out sending " + self.function_name + " to " + str(self.chat_id) + ".")
+        if self.exception is not None:
+            raise self.exception
+        return self.response
+
+
+# Return the hash of what the user sees of a message sent or edited with data
+def get_content_hash(data):
+    return hashlib.sha1(repr([data.get(field) for field in CONTENT_FIELDS]).encode("utf8")).hexdigest()
+
+
+def _is_not_modified(response):
+    return response.status_code == 400 and NOT_MODIFIED_DESCRIPTION in (getattr(response, "text", "") or "")
+
+
+def _get_retry_after(response):
+    try:
+        return float(response.json().get("parameters", {}).get("retry_after", 0))
+    except (ValueError, TypeError, AttributeError):
+        return 0
+
+
+class TelegramScheduler(object):  # Sends the Bot API calls of each chat in order, within the per chat and global rates
+    def __init__(self, num_threads=TELEGRAM_SENDER_THREADS, clock=time.time):
+        self.clock = clock
+        self.global_bucket = TokenBucket(TELEGRAM_GLOBAL_RATE, TELEGRAM_GLOBAL_BURST, clock())
+        self.chat_states = OrderedDict()  # Chat id to its _ChatState, least recently used first
+        self.lanes = {}  # Lane key to its requests waiting to be sent, kept while one of its requests is being sent
+        self.latest_edits = {}  # (chat id, message id) to the last edit submitted for the message, until it is done
+        self.ready_lanes = queue.Queue()  # Lanes whose next request can be sent, None stops a thread
+        self.delayed_lanes = []  # Heap of (ready at, sequence, lane key) of the lanes waiting for their rate or a retry
+        self.delayed_lane_sequence = itertools.count()  # Orders the lanes ready at the same time, lane keys are not comparable
+        self.is_stopped = False
+        self.lock = threading.Lock()
+        self.progress = threading.Condition(self.lock)  # Notified whenever a request is done
+        self.delayed_lanes_changed = threading.Condition(self.lock)
+        self.counters = {'sent': 0, 'retried': 0, 'throttled': 0, 'coalesced': 0, 'skipped': 0, 'unmodified': 0,
+                         'failed': 0}  # Updated with the lock held
+        self.threads = [threading.Thread(target=self._run_lanes, name="telegram-" + str(i)) for i in range(num_threads)]
+        self.threads.append(threading.Thread(target=self._run_delayed_lanes, name="telegram-delayed"))
+        for thread in self.threads:
+            thread.daemon = True
+            thread.start()
+
+    # Queue the call, a pending edit of the same message that is not sent yet is dropped in favour of this one
+    def submit(self, function_name, data, post_function):
+        request = _OutboundRequest(function_name, data, post_function)
+        lane_key = request.chat_id if request.chat_id is not None else ("request", id(request))  # e.g. answerCallbackQuery
+        with self.lock:
+            edit_key = request.get_edit_key()
+            previous_edit = self.latest_edits.get(edit_key) if edit_key is not None else None
+            if previous_edit is not None:
+                previous_edit.is_superseded = True  # Checked again by the thread if it is waiting for its rate
+                if previous_edit in self.lanes.get(lane_key, ()):
+                    self.lanes[lane_key].remove(previous_edit)
+                    self._finish_superseded(previous_edit)
+            if edit_key is not None:
+                self.latest_edits[edit_key] = request
+            if lane_key in self.lanes:  # Sent after the calls to the chat before it
+                self.lanes[lane_key].append(request)
+            else:
+                self.lanes[lane_key] = deque([request])
+                self.ready_lanes.put(lane_key)
+        return request
+
+    # A request that has to wait, for its rate or before a retry, is put back at the head of its lane and the lane is
+    # made ready again once the wait is over, the thread sends to the other chats in the meantime
+    def _run_lanes(self):
+        while True:
+            lane_key = self.ready_lanes.get()
+            if lane_key is None:
+                return
+            with self.lock:
+                request = self.lanes[lane_key].popleft() if self.lanes[lane_key] else None
+            delay = None
+            try:
+                if request is not None:
+                    with telegramHandlerMetrics.use_record(request.metrics_record):
+                        delay = self._send(request)
+            except Exception as e:
+                logger.error("Unable to send " + request.function_name + " to " + str(request.chat_id) + ": " +
+                             type(e).__name__ + ": " + str(e))
+                self._count('failed')
+                telegramHandlerMetrics.add_count("TelegramFailedCalls")
+                request.finish(exception=e)
+            finally:
+                with self.lock:
+                    if delay is not None:  # Later requests of the lane are kept behind it
+                        self.lanes[lane_key].appendleft(request)
+                        heapq.heappush(self.delayed_lanes, (self.clock() + delay, next(self.delayed_lane_sequence), lane_key))
+                        self.delayed_lanes_changed.notify()
+                    else:
+                        if request is not None and self.latest_edits.get(request.get_edit_key()) is request:
+                            del self.latest_edits[request.get_edit_key()]
+                        if self.lanes[lane_key]:
+                            self.ready_lanes.put(lane_key)
+                        else:
+                            del self.lanes[lane_key]
+                        self.progress.notify_all()
+
+    # Make the delayed lanes ready once their wait is over
+    def _run_delayed_lanes(self):
+        with self.lock:
+            while not self.is_stopped:
+                now = self.clock()
+                while self.delayed_lanes and self.delayed_lanes[0][0] <= now:
+                    self.ready_lanes.put(heapq.heappop(self.delayed_lanes)[2])
+                self.delayed_lanes_changed.wait(self.delayed_lanes[0][0] - now if self.delayed_lanes else None)
+
+    # Stop the threads, the requests not sent yet are dropped
+    def stop(self):
+        with self.lock:
+            self.is_stopped = True
+            self.delayed_lanes_changed.notify()
+        for _ in range(len(self.threads) - 1):
+            self.ready_lanes.put(None)
+
+    # The counters are incremented by every sender thread
+    def _count(self, counter):
+        with self.lock:
+            self.counters[counter] += 1
+
+    # Called with the lock held
+    def _finish_superseded(self, request):
+        self.counters['coalesced'] += 1
+        request.finish()
+
+    def _get_chat_state(self, chat_id):
+        chat_state = self.chat_states.pop(chat_id, None) or _ChatState(self.clock())
+        self.chat_states[chat_id] = chat_state
+        while len(self.chat_states) > TELEGRAM_CHAT_STATES:
+            self.chat_states.popitem(last=False)
+        return chat_state
+
+    # Take the tokens of the request and return the seconds to wait before sending it, at least until blocked_until
+    def _reserve(self, chat_state, blocked_until=0):
+        with self.lock:
+            now = self.clock()
+            delay = max(blocked_until - now, self.global_bucket.reserve(now))
+            if chat_state is not None:
+                delay = max(delay, chat_state.blocked_until - now, chat_state.bucket.reserve(now))
+            return delay
+
+    # Make the next attempt of the request, return the seconds to wait before the attempt after it, or None once done
+    def _send(self, request):
+        with self.lock:
+            chat_state = self._get_chat_state(request.chat_id) if request.chat_id is not None else None
+        content_hash = get_content_hash(request.data)
+
+        # The last sent contents are forgotten by wait_for_sent at the end of every invocation, another container
+        # may edit the message afterwards. Only the worker, the one process sending to the chats, keeps them.
+        if request.message_id is not None and chat_state is not None and \
+                chat_state.sent_hashes.get(request.message_id) == content_hash:
+            self._count('skipped')
+            telegramHandlerMetrics.add_count("TelegramSkippedEdits")
+            return request.finish()
+        if request.send_at is None:
+            request.send_at = self.clock() + self._reserve(chat_state, request.blocked_until)
+        if request.send_at > self.clock():
+            return request.send_at - self.clock()
+        request.send_at = None  # Every attempt takes its own tokens
+        if request.is_superseded:  # A later edit of the message was submitted while waiting
+            with self.lock:
+                return self._finish_superseded(request)
+
+        response = None
+        try:
+            response = request.post_function(request.function_name, request.data)
+        except Exception as e:  # e.g. a connection error
+            if request.attempt == TELEGRAM_MAX_RETRIES:
+                raise
+            logger.warning("Retrying " + request.function_name + " in " + str(request.retry_delay) + "s: " + str(e))
+        else:
+            if _is_not_modified(response):  # Already showing the content, e.g. edited by another container
+                self._count('unmodified')
+                self._record_sent(request, chat_state, content_hash, response)
+                return request.finish(response)
+            if response.status_code != 429 and response.status_code < 500:
+                self._count('sent')
+                self._record_sent(request, chat_state, content_hash, response)
+                return request.finish(response)
+            if request.attempt == TELEGRAM_MAX_RETRIES:
+                self._count('failed')
+                telegramHandlerMetrics.add_count("TelegramFailedCalls")
+                return request.finish(response)
+            if response.status_code == 429:  # Nothing is sent to the chat, or by this call, until retry_after has passed
+                self._count('throttled')
+                telegramHandlerMetrics.add_count("TelegramThrottledCalls")
+                blocked_until = self.clock() + max(_get_retry_after(response), request.retry_delay)
+                if chat_state is not None:
+                    with self.lock:
+                        chat_state.blocked_until = max(chat_state.blocked_until, blocked_until)
+                else:  # The other chats are not held up by it
+                    request.blocked_until = blocked_until
+                logger.warning("Throttled sending " + request.function_name + " to " + str(request.chat_id) +
+                               ", retrying after " + "{:.1f}".format(blocked_until - self.clock()) + "s.")
+            else:
+                logger.warning("Retrying " + request.function_name + " in " + str(request.retry_delay) + "s: HTTP " +
+                               str(response.status_code))
+        self._count('retried')
+        if response is None or response.status_code != 429:
+            request.blocked_until = self.clock() + request.retry_delay
+        request.attempt += 1
+        request.retry_delay *= 2
+        return 0  # Waits in the lane for its tokens, like a new request
+
+    # Keep the content of the message the call sent or edited, so that an identical edit of it is skipped
+    def _record_sent(self, request, chat_state, content_hash, response):
+        if chat_state is None or not (response.status_code == 200 or _is_not_modified(response)):
+            return
+        message_id = request.message_id
+        if request.function_name == SEND_FUNCTION_NAME:
+            try:
+                message_id = response.json().get("result", {}).get("message_id")
+            except (ValueError, AttributeError):  # The reply is then never skipped
+                message_id = None
+        if message_id is not None:
+            with self.lock:
+                chat_state.sent_hashes.pop(message_id, None)
+                chat_state.sent_hashes[message_id] = content_hash
+                while len(chat_state.sent_hashes) > TELEGRAM_SENT_MESSAGES:
+                    chat_state.sent_hashes.popitem(last=False)
+
+    # Wait up to timeout seconds for every submitted request to be done, and return True if they all are
+    def wait_for_sent(self, timeout=TELEGRAM_SEND_TIMEOUT):
+        deadline = time.time() + timeout
+        with self.lock:
+            while self.lanes and time.time() < deadline:
+                self.progress.wait(deadline - time.time())
+            return not self.lanes
+
+    # Forget the last sent content of every message, the rates and retry_after of the chats are kept
+    def forget_sent_messages(self):
+        with self.lock:
+            for chat_state in self.chat_states.values():
+                chat_state.sent_hashes.clear()
+
+
+def get_scheduler():
+    global _scheduler
+    if _scheduler is None:
+        with _scheduler_lock:
+            if _scheduler is None:
+                _scheduler = TelegramScheduler()
+    return _scheduler
+
+
+# Send a Bot API call through the scheduler with post_function(function_name, data), and return its response
+# Edits are not waited for, so that a later edit of the same message can supersede them while they wait for their rate
+def send(function_name, data, post_function):
+    request = get_scheduler().submit(function_name, data, post_function)
+    if function_name == EDIT_FUNCTION_NAME:
+        return None
+    return request.wait()
+
+
+# Wait for the calls still being sent, e.g. before the container is frozen at the end of an invocation
+# The last sent contents are then forgotten, the messages may be edited by other containers until the next invocation
+def wait_for_sent(timeout=TELEGRAM_SEND_TIMEOUT):
+    if _scheduler is None:
+        return True
+    all_sent = _scheduler.wait_for_sent(timeout)
+    _scheduler.forget_sent_messages()
+    if not all_sent:
+        logger.warning("Timed out waiting for the telegram calls still being sent.")
+    return all_sent
+
+
+def reset_scheduler():
+    global _scheduler
+    with _scheduler_lock:
+        if _scheduler is not None:
+            _scheduler.stop()
+        _scheduler = None
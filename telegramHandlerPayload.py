@@ -0,0 +1,120 @@
+import codecs
+import json
+import os
+import logging
+
+from telegramHandlerHelper import normalise_merchant, APPROVED_CATEGORIES
+from telegramHandlerMetrics import timed
+
+# Payload configurations
+PAYLOAD_CHUNK_SIZE = int(os.environ.get('PAYLOAD_CHUNK_SIZE', 65536))  # Bytes read from the payload stream at a time
+WHITESPACE = " \t\n\r"
+NUMBER_CHARACTERS = "-+.0123456789eE"
+
+logger = logging.getLogger()  # Configured by telegramHandler
+
+_decoder = json.JSONDecoder()
+
+
+class _PayloadReader(object):  # Decodes json values one at a time from a stream, holding only the text not decoded yet
+    def __init__(self, stream, chunk_size):
+        self.stream = stream
+        self.chunk_size = chunk_size
+        self.text_decoder = codecs.getincrementaldecoder("utf8")()  # A chunk may end within a multibyte character
+        self.buffer = u""
+        self.position = 0
+        self.is_exhausted = False
+
+    # Append the next chunk of the stream to the buffer, returns False at the end of the stream
+    def _read_chunk(self):
+        if self.is_exhausted:
+            return False
+        chunk = self.stream.read(self.chunk_size)
+        self.is_exhausted = not chunk
+        self.buffer = self.buffer[self.position:] + self.text_decoder.decode(chunk or b"", final=self.is_exhausted)
+        self.position = 0
+        return not self.is_exhausted or len(self.buffer) > 0
+
+    # Return the next character that is not whitespace, without consuming it, or None at the end of the stream
+    def peek(self):
+        while True:
+            while self.position < len(self.buffer) and self.buffer[self.position] in WHITESPACE:
+                self.position += 1
+            if self.position < len(self.buffer):
+                return self.buffer[self.position]
+            if not self._read_chunk():
+                return None
+
+    def expect(self, characters):
+        character = self.peek()
+        if character is None or character not in characters:
+            raise ValueError("Expected one of " + repr(characters) + " in the payload, found " + repr(character) + ".")
+        self.position += 1
+        return character
+
+    # Return True if the number that starts at the position is followed by another character in the buffer
+    def _is_number_complete(self):
+        end = self.position
+        while end < len(self.buffer) and self.buffer[end] in NUMBER_CHARACTERS:
+            end += 1
+        return end < len(self.buffer)
+
+    # Decode the value that starts at the next character, reading chunks until the value is complete
+    def decode_value(self):
+        if self.peek() in NUMBER_CHARACTERS:  # A prefix of a number decodes too, e.g. "1" of "1.5" or "1e" of "1e5"
+            while not self._is_number_complete() and self._read_chunk():
+                pass
+        while True:
+            try:
+                value, end = _decoder.raw_decode(self.buffer, self.position)
+            except ValueError:
+                if self.is_exhausted or not self._read_chunk():
+                    raise
+                continue
+            self.position = end
+            return value
+
+
+# Yield the values of the array that starts at the next character of the reader
+def _iterate_array(reader):
+    reader.expect("[")
+    if reader.peek() == "]":
+        reader.position += 1
+        return
+    while True:
+        yield reader.decode_value()
+        if reader.expect(",]") == "]":
+            return
+
+
+# Return True if the merchant, in the dynamodb format, is of an approved category, without parsing its other attributes
+def is_approved_merchant(merchant):
+    return int(merchant['Type']['N']) in APPROVED_CATEGORIES
+
+
+# Parse the queryGeoDatabase payload from its stream, keeping only the merchant records of the approved categories
+# Each merchant is converted into a record and its raw attributes dropped as soon as it is decoded, so that neither the
+# whole payload nor all the raw merchants are held in memory at once. The other keys, e.g. searchRadius, are kept as is.
+@timed("parse_geo_payload")
+def parse_geo_payload(stream, chunk_size=PAYLOAD_CHUNK_SIZE):
+    reader = _PayloadReader(stream, chunk_size)
+    json_response = {}
+    num_merchants = 0
+    reader.expect("{")
+    if reader.peek() == "}":
+        return json_response
+    while True:
+        key = reader.decode_value()
+        reader.expect(":")
+        if key == "locations" and reader.peek() == "[":
+            json_response['locations'] = []
+            for merchant in _iterate_array(reader):
+                num_merchants += 1
+                if is_approved_merchant(merchant):
+                    json_response['locations'].append(normalise_merchant(merchant))
+        else:
+            json_response[key] = reader.decode_value()
+        if reader.expect(",}") == "}":
+            break
+    logger.debug("Parsed " + str(len(json_response.get('locations', []))) + " of " + str(num_merchants) + " merchants.")
+    return json_response
@@ -0,0 +1,164 @@
+from collections import OrderedDict
+import os
+import threading
+import time
+import logging
+
+import telegramHandlerMetrics
+import telegramHandlerRender
+from telegramHandlerHelper import select_results_page
+
+# Prefetch configurations
+PREFETCH_MAX_PENDING = int(os.environ.get('PREFETCH_MAX_PENDING', 2))  # Prefetches queued or running at a time, others are skipped
+PREFETCH_STORE_SIZE = int(os.environ.get('PREFETCH_STORE_SIZE', 100))  # Number of prefetched results kept
+PREFETCH_TTL = int(os.environ.get('PREFETCH_TTL', 60))  # Seconds a prefetched result is served, the user may have moved on
+PREFETCH_WAIT_TIMEOUT = float(os.environ.get('PREFETCH_WAIT_TIMEOUT', 3))  # Seconds a callback waits for a prefetch still running
+
+logger = logging.getLogger()  # Configured by telegramHandler
+
+# The store is kept at module level so that a prefetch started for one update is served to the next one of the chat, the
+# prefetches run while the user reads the reply, which only the long polling worker keeps running for
+_entries = OrderedDict()  # Prefetch key to its _PrefetchEntry, least recently scheduled first
+_prefetch_lock = threading.Lock()
+_num_pending = 0
+_pool = None
+prefetch_counters = {'scheduled': 0, 'skipped': 0, 'cancelled': 0, 'failed': 0,
+                     'page_hits': 0, 'page_misses': 0, 'search_hits': 0, 'search_misses': 0}
+
+
+class _PrefetchEntry(object):  # The result of a prefetch of a chat, ready once the prefetch finished
+    def __init__(self, chat_id):
+        self.chat_id = chat_id
+        self.expires_at = time.time() + PREFETCH_TTL
+        self.ready = threading.Event()
+        self.is_cancelled = False
+        self.result = None
+
+
+def _get_pool():
+    global _pool
+    if _pool is None:
+        with _prefetch_lock:
+            if _pool is None:
+                from multiprocessing.pool import ThreadPool
+                _pool = ThreadPool(PREFETCH_MAX_PENDING)
+    return _pool
+
+
+def _get_page_key(json_response, page_number, sources_filter):
+    return ("page", json_response.get('searchId'), json_response['searchRadius'],
+            tuple(sorted(sources_filter)) if sources_filter is not None else None, page_number)
+
+
+def _get_search_key(search_center_details):
+    return ("search", float(search_center_details['latitude']), float(search_center_details['longitude']),
+            search_center_details.get('searchRadius'))
+
+
+# A. Scheduling Related Methods #########
+
+# Run function(*args) in the background and keep its result under key, unless the budget of pending prefetches is spent
+def _schedule(chat_id, key, function, args):
+    global _num_pending
+    with _prefetch_lock:
+        if key in _entries:  # Already prefetched or being prefetched
+            return False
+        if _num_pending >= PREFETCH_MAX_PENDING:
+            prefetch_counters['skipped'] += 1
+            return False
+        entry = _PrefetchEntry(chat_id)
+        _entries[key] = entry
+        while len(_entries) > PREFETCH_STORE_SIZE:
+            _entries.popitem(last=False)
+        _num_pending += 1
+        prefetch_counters['scheduled'] += 1
+    _get_pool().apply_async(_run_prefetch, (key, entry, function, args))
+    return True
+
+
+def _run_prefetch(key, entry, function, args):
+    global _num_pending
+    result = None
+    try:
+        if not entry.is_cancelled:
+            result = function(*args)
+    except Exception as e:  # The callback does the work itself, as without prefetching
+        logger.warning("Unable to prefetch " + str(key) + ": " + type(e).__name__ + ": " + str(e))
+        prefetch_counters['failed'] += 1
+    finally:
+        with _prefetch_lock:
+            _num_pending -= 1
+            if entry.is_cancelled:
+                prefetch_counters['cancelled'] += 1
+            else:
+                entry.result = result
+            if entry.result is None and _entries.get(key) is entry:
+                del _entries[key]
+        entry.ready.set()
+
+
+# Prefetch the page after current_page of the cached result of the chat, and the search of next_search_center_details,
+# e.g. the next radius step, with search_function. Called right after the reply is dispatched, returns immediately.
+def prefetch_next_steps(chat_id, json_response, current_page, next_search_center_details, search_function):
+    sources_filter = json_response.get('sourcesFilter')
+    _schedule(chat_id, _get_page_key(json_response, current_page + 1, sources_filter), _prefetch_page,
+              (json_response, current_page + 1, sources_filter))
+    if next_search_center_details is not None:
+        _schedule(chat_id, _get_search_key(next_search_center_details), search_function, (next_search_center_details,))
+
+
+# Select and render the page, the rendered reply is kept by the render cache, None if the page is empty
+def _prefetch_page(json_response, page_number, sources_filter):
+    json_page, sources_available = select_results_page(json_response, page_number, sources_filter)
+    if len(json_page['locations']) == 0:
+        return None
+    telegramHandlerRender.render_page(json_page)
+    return json_page, sources_available
+
+
+# Drop the prefetches of the chat, e.g. when it sends a new location, those still running are discarded when they finish
+def cancel_prefetches(chat_id):
+    with _prefetch_lock:
+        for key, entry in list(_entries.items()):
+            if entry.chat_id == chat_id:
+                entry.is_cancelled = True
+                del _entries[key]
+
+
+# B. Serving Related Methods #########
+
+# Return the prefetched result of key and remove it from the store, waiting for it if it is still being prefetched
+def _take(key, counter_prefix):
+    with _prefetch_lock:
+        entry = _entries.get(key)
+    result = None
+    if entry is not None and entry.ready.wait(PREFETCH_WAIT_TIMEOUT):
+        with _prefetch_lock:
+            if _entries.get(key) is entry:
+                del _entries[key]
+        if not entry.is_cancelled and entry.expires_at >= time.time():
+            result = entry.result
+
+    prefetch_counters[counter_prefix + ('_hits' if result is not None else '_misses')] += 1
+    telegramHandlerMetrics.add_count("PrefetchHits" if result is not None else "PrefetchMisses")
+    logger.debug("Prefetch " + str(prefetch_counters) + ".")
+    return result
+
+
+# Return the (page, sources available) that select_results_page returns for the page, if it was prefetched
+def get_prefetched_page(json_response, page_number, sources_filter):
+    return _take(_get_page_key(json_response, page_number, sources_filter), "page")
+
+
+# Return the result of the geo database search, if it was prefetched
+def get_prefetched_search(search_center_details):
+    return _take(_get_search_key(search_center_details), "search")
+
+
+def reset_prefetch_store():
+    with _prefetch_lock:
+        for entry in _entries.values():
+            entry.is_cancelled = True
+        _entries.clear()
+    for counter in prefetch_counters:
+        prefetch_counters[counter] = 0
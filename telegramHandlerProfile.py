@@ -0,0 +1,135 @@
+import functools
+import json
+import os
+import random
+import sys
+import threading
+import time
+import logging
+
+import telegramHandlerMetrics
+
+# Profile configurations
+PROFILE_SAMPLE_RATE = float(os.environ.get('PROFILE_SAMPLE_RATE', 0))  # Fraction of the invocations profiled, e.g. 0.01
+PROFILE_CHAT_IDS = set(int(chat_id) for chat_id in os.environ.get('PROFILE_CHAT_IDS', "").split(",") if chat_id.strip())  # Chats whose invocations are always profiled, comma separated
+PROFILE_TOP_FUNCTIONS = int(os.environ.get('PROFILE_TOP_FUNCTIONS', 25))  # Functions logged per profile, by cumulative time
+PROFILE_DUMP_DIR = os.environ.get('PROFILE_DUMP_DIR')  # Optional, e.g. /tmp, where the full profiles are dumped for pstats
+PROFILE_ENABLED = PROFILE_SAMPLE_RATE > 0 or len(PROFILE_CHAT_IDS) > 0
+
+logger = logging.getLogger()  # Configured by telegramHandler
+
+_current = threading.local()  # Profile of the invocation being served by this thread, or by the thread that dispatched a stage
+
+
+# cProfile and pstats are only imported once an invocation is profiled, so that they cost nothing when profiling is disabled
+class _ProfileSession(object):  # The profiler of the handler thread of an invocation and those of the stages it dispatched
+    def __init__(self):
+        import cProfile
+        self.profiler = cProfile.Profile()
+        self.stage_profilers = []
+        self.lock = threading.Lock()  # Dispatched stages finish on the pool threads
+
+    # Run function in this thread under a profiler of its own, cProfile only profiles the thread it is enabled in
+    def run(self, function, args, kwargs):
+        import cProfile
+        previous_session = getattr(_current, 'session', None)
+        _current.session = self
+        profiler = cProfile.Profile()
+        try:
+            return profiler.runcall(function, *args, **kwargs)
+        finally:
+            _current.session = previous_session
+            with self.lock:
+                self.stage_profilers.append(profiler)
+
+    # Return the statistics of the handler thread and the stages merged together
+    def get_stats(self):
+        import pstats
+        stats = pstats.Stats(self.profiler)
+        with self.lock:
+            for profiler in self.stage_profilers:
+                stats.add(profiler)
+        return stats
+
+
+def get_current_session():
+    return getattr(_current, 'session', None)
+
+
+# Run function(*args) in this thread as part of the profile of session, e.g. the chats of a batch on its pool threads
+def run_in_session(session, function, *args):
+    if session is None:
+        return function(*args)
+    return session.run(function, args, {})
+
+
+# Return why the invocation of event is profiled, or None if it is not
+def _get_profile_reason(event, get_chat_ids):
+    if PROFILE_SAMPLE_RATE > 0 and random.random() < PROFILE_SAMPLE_RATE:
+        return "sampled"
+    if len(PROFILE_CHAT_IDS) > 0:
+        try:
+            chat_ids = set(int(chat_id) for chat_id in get_chat_ids(event))
+        except (ValueError, KeyError, TypeError):  # Not an update of a chat, the handler reports it
+            return None
+        if len(chat_ids & PROFILE_CHAT_IDS) > 0:
+            return "chat " + ",".join(str(chat_id) for chat_id in sorted(chat_ids & PROFILE_CHAT_IDS))
+    return None
+
+
+# Return the functions of the profile with the most cumulative time, in milliseconds, e.g. "telegramHandlerHelper.py:120(condense_offer_description)"
+def get_top_functions(stats, num_functions=PROFILE_TOP_FUNCTIONS):
+    top_functions = []
+    for (filename, line_number, function_name), (primitive_calls, calls, own_time, cumulative_time, callers) in \
+            sorted(stats.stats.items(), key=lambda function_stats: -function_stats[1][3])[:num_functions]:
+        top_functions.append({'function': (os.path.basename(filename) + ":" + str(line_number) + "(" + function_name + ")"
+                                           if filename != "~" else function_name),
+                              'calls': calls, 'cumulative': round(cumulative_time * 1000.0, 3),
+                              'own': round(own_time * 1000.0, 3)})
+    return top_functions
+
+
+# Return the profile of the invocation as a compact log line, and dump the full profile to PROFILE_DUMP_DIR if configured
+def format_profile(session, handler_name, reason, elapsed):
+    stats = session.get_stats()
+    record = telegramHandlerMetrics.get_current_record()
+    profile_record = {'profile': handler_name, 'reason': reason, 'duration': round(elapsed, 3),
+                      'messageType': record.properties.get('MessageType') if record is not None else None,
+                      'stages': len(session.stage_profilers), 'top': get_top_functions(stats)}
+    if PROFILE_DUMP_DIR is not None:
+        dump_path = os.path.join(PROFILE_DUMP_DIR, "profile-" + handler_name + "-" + str(int(time.time() * 1000)) + "-" +
+                                 str(os.getpid()) + "-" + str(threading.current_thread().ident) + ".prof")
+        stats.dump_stats(dump_path)
+        profile_record['dump'] = dump_path
+    return json.dumps(profile_record, separators=(',', ':'))
+
+
+# Decorator for the handlers, profiles the invocations sampled by PROFILE_SAMPLE_RATE and those of the chats in
+# PROFILE_CHAT_IDS, as returned by get_chat_ids(event), together with the stages they dispatch, and writes their top
+# functions to stdout. The handler is left as is when profiling is disabled, so that it costs nothing.
+# Work done on other threads, e.g. prefetches and the outbound scheduler, is not part of the profile.
+def profiled_handler(get_chat_ids):
+    def decorator(handler):
+        if not PROFILE_ENABLED:
+            return handler
+
+        @functools.wraps(handler)
+        def profiled(event, context=None):
+            reason = _get_profile_reason(event, get_chat_ids)
+            if reason is None:
+                return handler(event, context)
+
+            session = _ProfileSession()
+            _current.session = session
+            start_time = time.time()
+            try:
+                return session.profiler.runcall(handler, event, context)
+            finally:
+                _current.session = None
+                try:
+                    sys.stdout.write(format_profile(session, handler.__name__, reason, (time.time() - start_time) * 1000.0) + "\n")
+                    sys.stdout.flush()
+                except Exception:  # Profiling never fails the invocation
+                    logger.exception("Unable to write the profile.")
+        return profiled
+    return decorator
@@ -0,0 +1,51 @@
+from collections import OrderedDict
+import os
+import threading
+
+from telegramHandlerHelper import format_json_response
+
+# Render cache configurations
+RENDER_PAGE_CACHE_SIZE = int(os.environ.get('RENDER_PAGE_CACHE_SIZE', 200))  # Number of rendered pages kept
+
+# The caches are kept at module level so that they are reused across invocations on a warm container
+_pages = OrderedDict()  # (search, radius, sources filter, page) to the markdown reply, least recently used first
+_render_lock = threading.Lock()
+render_cache_counters = {'hits': 0, 'misses': 0}
+
+
+def _get_page(key):
+    with _render_lock:
+        markdown_reply = _pages.get(key)
+        if markdown_reply is not None:
+            _pages[key] = _pages.pop(key)  # Move to the most recently used end
+        render_cache_counters['hits' if markdown_reply is not None else 'misses'] += 1
+        return markdown_reply
+
+
+def _set_page(key, markdown_reply):
+    with _render_lock:
+        _pages[key] = markdown_reply
+        while len(_pages) > RENDER_PAGE_CACHE_SIZE:
+            _pages.popitem(last=False)
+
+
+# Convert a page from select_results_page into a telegram markdown reply, a page of the same search is only rendered once
+def render_page(json_response):
+    if json_response.get('searchId') is None or len(json_response['locations']) == 0:
+        return format_json_response(json_response)
+
+    sources_filter = json_response['sourcesFilter']
+    key = (json_response['searchId'], json_response['searchRadius'],
+           tuple(sorted(sources_filter)) if sources_filter is not None else None, json_response['startItemNumber'])
+    markdown_reply = _get_page(key)
+    if markdown_reply is None:
+        markdown_reply = format_json_response(json_response)
+        _set_page(key, markdown_reply)
+    return markdown_reply
+
+
+def reset_render_cache():
+    with _render_lock:
+        _pages.clear()
+    for counter in render_cache_counters:
+        render_cache_counters[counter] = 0
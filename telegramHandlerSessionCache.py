@@ -0,0 +1,288 @@
+from collections import OrderedDict
+import os
+import threading
+import time
+import logging
+
+import telegramHandlerMetrics
+
+# Session cache configurations
+SESSION_CACHE_SIZE = int(os.environ.get('SESSION_CACHE_SIZE', 200))  # Number of chats kept
+SESSION_CACHE_MAX_MERCHANTS = int(os.environ.get('SESSION_CACHE_MAX_MERCHANTS', 100000))  # Merchant records kept across the chats, about 1KB each
+SESSION_CACHE_TTL = int(os.environ.get('SESSION_CACHE_TTL', 60))  # Seconds a result is kept in memory
+SESSION_CACHE_VERIFY_INTERVAL = float(os.environ.get('SESSION_CACHE_VERIFY_INTERVAL', 0))  # Seconds a result is served without reading its versions after they were last read or written, 0 reads them on every hit
+SESSION_WRITE_BEHIND_DELAY = float(os.environ.get('SESSION_WRITE_BEHIND_DELAY', 0))  # Seconds the writes of a chat are held and coalesced, 0 writes them right away
+
+logger = logging.getLogger()  # Configured by telegramHandler
+
+# The cache is kept at module level so that a result written by one invocation is read by the next one of the chat on a
+# warm container. Results are copied in and out, as the callbacks change their view state in place.
+_entries = OrderedDict()  # Chat id to its _SessionEntry, least recently used first
+_num_merchants = 0
+_session_cache_lock = threading.Lock()
+session_cache_counters = {'hits': 0, 'unverified_hits': 0, 'misses': 0, 'expired': 0, 'stale': 0, 'writes': 0,
+                          'coalesced_writes': 0, 'conflicts': 0, 'evictions': 0}
+
+
+class _SessionEntry(object):  # The last result of a chat known to this container, and its write still to be made
+    def __init__(self, version):
+        self.json_response = None
+        self.num_merchants = 0
+        self.expires_at = 0
+        self.verified_at = 0  # Time the versions of the chat's item were last read or written by this container
+        self.version = version  # Version of the result cache item, None if not known
+        self.pending_result = None  # Result still to be written with write_function
+        self.pending_is_conditional = False  # Written only if the item is still at version, unless it is a new search
+        self.write_function = None
+        self.is_flush_scheduled = False
+        self.write_lock = threading.Lock()  # The writes of a chat are made in turn, a later one waits for the earlier one
+        self.is_complete = True  # False if the result lacks keys of the chat not known yet, it is read again before use
+
+
+def _copy_result(json_response):
+    return dict((key, list(value) if isinstance(value, list) and key != 'locations' else value)
+                for key, value in json_response.items())
+
+
+# Keep json_response as the chat's result, in its entry if it has one, and evict the least recently used chats over the
+# limits, except those with a result still to be written. The chat_keys json_response lacks, which belong to the chat
+# rather than to a search, e.g. the version of its view state, are kept from the previous result. Called with the lock held.
+def _store(chat_id, json_response, version=None, chat_keys=()):
+    global _num_merchants
+    entry = _entries.pop(chat_id, None)
+    if entry is None:
+        entry = _SessionEntry(version)
+    else:
+        _num_merchants -= entry.num_merchants
+        for key in chat_keys:
+            if key not in json_response and key in entry.json_response:
+                json_response[key] = entry.json_response[key]
+    json_response['resultVersion'] = entry.version
+    entry.json_response, entry.num_merchants = json_response, len(json_response['locations'])
+    entry.expires_at = time.time() + SESSION_CACHE_TTL
+    entry.verified_at = time.time()  # Just read or about to be written
+    _entries[chat_id] = entry
+    _num_merchants += entry.num_merchants
+
+    for evicted_chat_id in list(_entries.keys()):
+        if len(_entries) <= SESSION_CACHE_SIZE and _num_merchants <= SESSION_CACHE_MAX_MERCHANTS:
+            break
+        if evicted_chat_id != chat_id and _entries[evicted_chat_id].pending_result is None:
+            _discard(evicted_chat_id)
+            session_cache_counters['evictions'] += 1
+    return entry
+
+
+# Called with the lock held
+def _discard(chat_id):
+    global _num_merchants
+    entry = _entries.pop(chat_id, None)
+    if entry is not None:
+        _num_merchants -= entry.num_merchants
+
+
+# Return the versions the chat's item in dynamodb has if this container wrote or read it last, or None if they are not
+# known, i.e. a new search of the chat is still to be written and replaces the item regardless. Called with the lock held.
+def _get_expected_versions(entry):
+    if entry.pending_result is not None and not entry.pending_is_conditional:
+        return None
+    return {'resultVersion': entry.version, 'viewVersion': entry.json_response.get('viewVersion', 0)}
+
+
+# Return the chat's result with its version as resultVersion, from memory if this container read or wrote it last and
+# it has not expired, otherwise from read_function(chat_id), None if the chat has none. A result in memory is only served if the versions of the
+# chat's item, as returned by read_versions_function(chat_id), are still those it was read or written with, so that a
+# result written by another container in the meantime is read instead.
+# The versions are read with the round trip and the read units of a read of the whole item, which dynamodb bills on
+# its full size even though only the versions are returned. Within SESSION_CACHE_VERIFY_INTERVAL of the last read or
+# write the result is served without reading them: a result changed by another container may then be served until the
+# interval is over, or until the next write of the chat fails its version check and the result is read again.
+def get_result(chat_id, read_function, read_versions_function):
+    chat_id = int(chat_id)
+    with _session_cache_lock:
+        entry = _entries.get(chat_id)
+        is_incomplete = entry is not None and not entry.is_complete
+        if entry is not None and entry.expires_at < time.time() and entry.pending_result is None:
+            session_cache_counters['expired'] += 1
+            _discard(chat_id)
+            entry = None
+        if entry is not None and not entry.is_complete:
+            entry = None
+        if entry is not None:
+            json_response, expected_versions = _copy_result(entry.json_response), _get_expected_versions(entry)
+            is_verified = entry.verified_at + SESSION_CACHE_VERIFY_INTERVAL > time.time()
+
+    is_stale = False
+    if entry is not None and expected_versions is not None and not is_verified:
+        verified_at = time.time()
+        versions = read_versions_function(chat_id)
+        is_stale = versions is None or any(expected_versions[key] != version for key, version in versions.items())
+    with _session_cache_lock:
+        if entry is not None and not is_stale:
+            if _entries.get(chat_id) is entry:
+                _entries[chat_id] = _entries.pop(chat_id)  # Most recently used
+                if expected_versions is not None and not is_verified:
+                    entry.verified_at = max(entry.verified_at, verified_at)
+            session_cache_counters['hits'] += 1
+            if is_verified and expected_versions is not None:
+                session_cache_counters['unverified_hits'] += 1
+        else:
+            session_cache_counters['stale' if is_stale else 'misses'] += 1
+    telegramHandlerMetrics.add_count("SessionCacheHits" if entry is not None and not is_stale else "SessionCacheMisses")
+    logger.debug("Session cache " + str(session_cache_counters) + ".")
+    if entry is not None and not is_stale:
+        return json_response
+
+    if is_stale:  # Changed by another container, a result still to be written fails its version check
+        logger.info(str(chat_id) + "'s session result was changed by another container, reading it again.")
+        try:
+            flush_session_writes(chat_id)
+        except Exception as e:
+            logger.warning("Unable to write " + str(chat_id) + "'s stale session result: " + type(e).__name__ + ": " + str(e))
+        with _session_cache_lock:
+            if _entries.get(chat_id) is entry and entry.pending_result is None:
+                _discard(chat_id)
+    elif is_incomplete:  # Its write is read back
+        flush_session_writes(chat_id)
+    json_response = read_function(chat_id)
+    if json_response is None:  # The chat has no result
+        return None
+    json_response.setdefault('resultVersion', 0)  # Written without a version, e.g. before the session cache
+    with _session_cache_lock:
+        entry = _entries.get(chat_id)
+        if entry is not None and not entry.is_complete and entry.pending_result is None:
+            _discard(chat_id)
+        if chat_id not in _entries:  # Unless written by this container in the meantime
+            _store(chat_id, _copy_result(json_response), json_response['resultVersion'])
+    return json_response
+
+
+# Keep json_response as the chat's result and write it with write_function(chat_id, json_response, expected_version),
+# which returns the new version. A result read from the cache, i.e. with a resultVersion, is written only if the item
+# is still at the version this container knows, a new search is written regardless. With a write behind delay, the
+# result is written once the delay has passed, and a later result of the chat written in the meantime replaces it.
+# The result is read again before it is used if it lacks one of the chat_keys, see _store.
+def put_result(chat_id, json_response, write_function, chat_keys=()):
+    chat_id = int(chat_id)
+    with _session_cache_lock:
+        entry = _entries.get(chat_id)
+        if entry is not None and entry.pending_result is not None:
+            session_cache_counters['coalesced_writes'] += 1
+        is_conditional = 'resultVersion' in json_response
+        entry = _store(chat_id, _copy_result(json_response), json_response.get('resultVersion'), chat_keys)
+        entry.is_complete = all(key in entry.json_response for key in chat_keys)
+        entry.pending_result, entry.pending_is_conditional = entry.json_response, is_conditional
+        entry.write_function = write_function
+        schedule_flush = SESSION_WRITE_BEHIND_DELAY > 0 and not entry.is_flush_scheduled
+        entry.is_flush_scheduled = entry.is_flush_scheduled or schedule_flush
+
+    if SESSION_WRITE_BEHIND_DELAY <= 0:
+        return flush_session_writes(chat_id)
+    if schedule_flush:
+        timer = threading.Timer(SESSION_WRITE_BEHIND_DELAY, _flush_scheduled, (chat_id,))
+        timer.daemon = True
+        timer.start()
+    return True
+
+
+def _flush_scheduled(chat_id):
+    try:
+        flush_session_writes(chat_id)
+    except Exception as e:
+        logger.error("Unable to write " + str(chat_id) + "'s session result: " + type(e).__name__ + ": " + str(e))
+
+
+# Write the pending result of the chat, or of every chat, e.g. before the container is frozen at the end of an
+# invocation. The first error is raised once they were all tried.
+def flush_session_writes(chat_id=None):
+    with _session_cache_lock:
+        chat_ids = [chat_id] if chat_id is not None else [pending_chat_id for pending_chat_id, entry in _entries.items()
+                                                          if entry.pending_result is not None]
+    first_error = None
+    for pending_chat_id in chat_ids:
+        try:
+            _flush_chat(int(pending_chat_id))
+        except Exception as e:
+            first_error = first_error or e
+    if first_error is not None:
+        raise first_error
+    return True
+
+
+def _flush_chat(chat_id):
+    with _session_cache_lock:
+        entry = _entries.get(chat_id)
+    if entry is None:
+        return
+
+    with entry.write_lock:
+        with _session_cache_lock:
+            if entry.pending_result is None:  # Written by the flush that held the lock
+                return
+            json_response, write_function = entry.pending_result, entry.write_function
+            expected_version = entry.version if entry.pending_is_conditional else None
+            entry.pending_result, entry.is_flush_scheduled = None, False
+
+        try:
+            new_version = write_function(chat_id, json_response, expected_version)
+        except Exception as e:
+            with _session_cache_lock:  # Read again from dynamodb next time, e.g. another container changed the result
+                if _entries.get(chat_id) is entry:
+                    _discard(chat_id)
+                if getattr(e, 'response', {}).get('Error', {}).get('Code') == "ConditionalCheckFailedException":
+                    session_cache_counters['conflicts'] += 1
+            raise
+
+        with _session_cache_lock:
+            session_cache_counters['writes'] += 1
+            entry.version = new_version  # A result put in the meantime is based on the one just written
+            entry.json_response['resultVersion'] = new_version
+            entry.verified_at = time.time()
+
+
+# Write the view state of the chat's result with write_function(chat_id, json_response), which returns the new view
+# version, and keep the result with it. The chat's result is read again before it is used next if the view state was
+# not written, e.g. on a conflict, or if its version is not known, e.g. when coalesced by a batch.
+def put_view_state(chat_id, json_response, write_function):
+    chat_id = int(chat_id)
+    try:
+        view_version = write_function(chat_id, json_response)
+    except Exception as e:
+        invalidate_result(chat_id)
+        with _session_cache_lock:
+            if getattr(e, 'response', {}).get('Error', {}).get('Code') == "ConditionalCheckFailedException":
+                session_cache_counters['conflicts'] += 1
+        raise
+
+    with _session_cache_lock:
+        entry = _entries.get(chat_id)
+        if entry is None:
+            return view_version
+        if view_version is None:
+            entry.is_complete = False
+            return view_version
+        is_pending = entry.pending_result is not None
+        entry = _store(chat_id, _copy_result(json_response))
+        entry.json_response['viewVersion'] = view_version
+        entry.is_complete = True
+        if is_pending:  # The result still to be written has the same view state
+            entry.pending_result = entry.json_response
+    return view_version
+
+
+# Read the chat's result from dynamodb the next time it is used, once its pending result is written, e.g. after its
+# view state was written without a version check by flush_coalesced_results
+def invalidate_result(chat_id):
+    with _session_cache_lock:
+        entry = _entries.get(int(chat_id))
+        if entry is not None:
+            entry.is_complete = False
+
+
+def reset_session_cache():
+    global _num_merchants
+    with _session_cache_lock:
+        _entries.clear()
+        _num_merchants = 0
+        for counter in session_cache_counters:
+            session_cache_counters[counter] = 0
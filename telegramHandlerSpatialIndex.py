@@ -0,0 +1,234 @@
+import argparse
+import json
+import math
+import mmap
+import os
+import struct
+import threading
+import logging
+
+from telegramHandlerDistance import compute_distances, order_by_distance
+from telegramHandlerHelper import normalise_merchant
+from telegramHandlerMetrics import timed
+
+# Spatial index configurations
+SPATIAL_INDEX_SNAPSHOT = os.environ.get('SPATIAL_INDEX_SNAPSHOT')  # Optional path to a merchant snapshot, queried in process instead of queryGeoDatabase
+SPATIAL_INDEX_CELL_SIZE = float(os.environ.get('SPATIAL_INDEX_CELL_SIZE', 500))  # Metres, side of the grid cells of new snapshots
+SPATIAL_INDEX_DEFAULT_RADIUS = int(os.environ.get('SPATIAL_INDEX_DEFAULT_RADIUS', 1000))  # Radius of searches without a searchRadius, as the geo database uses
+SNAPSHOT_MAGIC = b"CHEAPOSI"
+SNAPSHOT_VERSION = 1
+SNAPSHOT_HEADER = struct.Struct("<8sIIII4d6Q")  # Magic, version, merchant, cell and column counts, grid, section offsets
+METRES_PER_DEGREE = 111320.0
+QUERY_MARGIN = 1.01  # A degree of latitude is up to 0.7% shorter than METRES_PER_DEGREE, the exact distances filter the rest
+
+logger = logging.getLogger()  # Configured by telegramHandler
+
+# The index is kept at module level so that it is mapped once per container, its pages are shared through the page cache
+_spatial_index = None
+_spatial_index_loaded = False  # Loaded on first use, a snapshot that cannot be loaded is not retried
+_spatial_index_lock = threading.Lock()
+
+
+# A. Snapshot Related Methods #########
+
+# Snapshot layout, every number little endian:
+#   header           SNAPSHOT_HEADER
+#   cell keys        uint32 per non empty cell, row * num_columns + column, ascending
+#   cell starts      uint32 per non empty cell and one more, index of the first merchant of the cell
+#   latitudes        float64 per merchant, merchants ordered by cell
+#   longitudes       float64 per merchant
+#   record offsets   uint64 per merchant and one more, offset of its record from the start of the records
+#   records          utf8 json of the merchant records made by normalise_merchant
+def _pack(typecode, values):
+    return struct.pack("<" + str(len(values)) + typecode, *values)
+
+
+def _unpack_from(typecode, count, offset, snapshot):
+    return struct.unpack_from("<" + str(count) + typecode, snapshot, offset)
+
+
+# Create a snapshot at path of the merchants in the dynamodb format returned by queryGeoDatabase, e.g. a dump of the geo
+# table, bucketed into a grid of cell_size metres cells over the area of the merchants
+def write_spatial_index_snapshot(merchants, path, cell_size=SPATIAL_INDEX_CELL_SIZE):
+    records = [normalise_merchant(merchant) for merchant in merchants]
+    if len(records) == 0:
+        raise ValueError("A spatial index snapshot needs at least one merchant.")
+
+    origin_latitude = min(record['latitude'] for record in records)
+    origin_longitude = min(record['longitude'] for record in records)
+    reference_latitude = (origin_latitude + max(record['latitude'] for record in records)) / 2.0
+    cell_latitude_degrees = cell_size / METRES_PER_DEGREE
+    cell_longitude_degrees = cell_size / (METRES_PER_DEGREE * max(math.cos(math.radians(reference_latitude)), 0.01))
+
+    cells = []
+    for record in records:
+        cells.append((int((record['latitude'] - origin_latitude) / cell_latitude_degrees),
+                      int((record['longitude'] - origin_longitude) / cell_longitude_degrees)))
+    num_columns = max(column for row, column in cells) + 1
+    if (max(row for row, column in cells) + 1) * num_columns >= 2 ** 32:
+        raise ValueError("Too many grid cells, use a larger cell size than " + str(cell_size) + "m.")
+    cell_keys = [row * num_columns + column for row, column in cells]
+    order = sorted(range(len(records)), key=lambda i: cell_keys[i])
+
+    unique_cell_keys, cell_starts = [], []
+    for position, i in enumerate(order):
+        if not unique_cell_keys or unique_cell_keys[-1] != cell_keys[i]:
+            unique_cell_keys.append(cell_keys[i])
+            cell_starts.append(position)
+    cell_starts.append(len(order))
+
+    encoded_records = [json.dumps(records[i], separators=(",", ":")).encode("utf8") for i in order]
+    record_offsets = [0]
+    for encoded_record in encoded_records:
+        record_offsets.append(record_offsets[-1] + len(encoded_record))
+
+    sections = [_pack("I", unique_cell_keys), _pack("I", cell_starts),
+                _pack("d", [records[i]['latitude'] for i in order]), _pack("d", [records[i]['longitude'] for i in order]),
+                _pack("Q", record_offsets), b"".join(encoded_records)]
+    section_offsets, offset = [], SNAPSHOT_HEADER.size
+    for section in sections:
+        offset += (-offset) % 8  # The float64 and uint64 sections are aligned
+        section_offsets.append(offset)
+        offset += len(section)
+
+    temporary_path = path + ".tmp"
+    with open(temporary_path, "wb") as snapshot_file:
+        snapshot_file.write(SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION, len(records), len(unique_cell_keys),
+                                                 num_columns, origin_latitude, origin_longitude, cell_latitude_degrees,
+                                                 cell_longitude_degrees, *section_offsets))
+        for section, section_offset in zip(sections, section_offsets):
+            snapshot_file.write(b"\0" * (section_offset - snapshot_file.tell()))
+            snapshot_file.write(section)
+    os.rename(temporary_path, path)  # Readers never see a partially written snapshot
+    logger.info("Wrote spatial index snapshot of " + str(len(records)) + " merchants in " +
+                str(len(unique_cell_keys)) + " cells to " + path + ".")
+
+
+# B. Query Related Methods #########
+
+class SpatialIndex(object):  # Read only view of a snapshot, memory mapped so that only the cells queried are paged in
+    def __init__(self, path):
+        with open(path, "rb") as snapshot_file:
+            self.snapshot = mmap.mmap(snapshot_file.fileno(), 0, access=mmap.ACCESS_READ)
+        header = SNAPSHOT_HEADER.unpack_from(self.snapshot, 0)
+        if header[0] != SNAPSHOT_MAGIC or header[1] != SNAPSHOT_VERSION:
+            self.snapshot.close()
+            raise ValueError(path + " is not a version " + str(SNAPSHOT_VERSION) + " spatial index snapshot.")
+        (self.num_merchants, self.num_cells, self.num_columns, self.origin_latitude, self.origin_longitude,
+         self.cell_latitude_degrees, self.cell_longitude_degrees) = header[2:9]
+        (self.cell_keys_offset, self.cell_starts_offset, self.latitudes_offset, self.longitudes_offset,
+         self.record_offsets_offset, self.records_offset) = header[9:]
+
+    def _get_cell_key(self, i):
+        return struct.unpack_from("<I", self.snapshot, self.cell_keys_offset + 4 * i)[0]
+
+    def _get_cell_start(self, i):
+        return struct.unpack_from("<I", self.snapshot, self.cell_starts_offset + 4 * i)[0]
+
+    # Return the index of the first non empty cell with a key of at least cell_key
+    def _find_cell(self, cell_key):
+        low, high = 0, self.num_cells
+        while low < high:
+            middle = (low + high) // 2
+            if self._get_cell_key(middle) < cell_key:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    # Return the (start, end) merchant ranges of the cells that may contain merchants within radius of the center
+    def get_candidate_ranges(self, latitude, longitude, radius):
+        latitude_span = radius * QUERY_MARGIN / METRES_PER_DEGREE
+        furthest_latitude = min(abs(latitude) + latitude_span, 89.0)
+        longitude_span = radius * QUERY_MARGIN / (METRES_PER_DEGREE * math.cos(math.radians(furthest_latitude)))
+
+        first_row = max(int(math.floor((latitude - latitude_span - self.origin_latitude) / self.cell_latitude_degrees)), 0)
+        last_row = int(math.floor((latitude + latitude_span - self.origin_latitude) / self.cell_latitude_degrees))
+        first_column = max(int(math.floor((longitude - longitude_span - self.origin_longitude) / self.cell_longitude_degrees)), 0)
+        last_column = min(int(math.floor((longitude + longitude_span - self.origin_longitude) / self.cell_longitude_degrees)),
+                          self.num_columns - 1)
+        if first_column > last_column:
+            return []
+
+        candidate_ranges = []
+        for row in range(first_row, last_row + 1):  # The cells of a row are contiguous, and so are their merchants
+            first_cell = self._find_cell(row * self.num_columns + first_column)
+            if first_cell == self.num_cells:
+                break
+            end_cell = self._find_cell(row * self.num_columns + last_column + 1)
+            if end_cell > first_cell:
+                candidate_ranges.append((self._get_cell_start(first_cell), self._get_cell_start(end_cell)))
+        return candidate_ranges
+
+    def _get_record(self, i):
+        start, end = struct.unpack_from("<QQ", self.snapshot, self.record_offsets_offset + 8 * i)
+        return json.loads(self.snapshot[self.records_offset + start:self.records_offset + end].decode("utf8"))
+
+    # Return the records of the merchants within radius metres of the center, closest first with their distance set
+    def query(self, latitude, longitude, radius):
+        candidates, latitudes, longitudes = [], [], []
+        for start, end in self.get_candidate_ranges(latitude, longitude, radius):
+            candidates.extend(range(start, end))
+            latitudes.extend(_unpack_from("d", end - start, self.latitudes_offset + 8 * start, self.snapshot))
+            longitudes.extend(_unpack_from("d", end - start, self.longitudes_offset + 8 * start, self.snapshot))
+
+        distances = compute_distances(latitudes, longitudes, latitude, longitude)
+        within_radius = [(i, float(distance)) for i, distance in zip(candidates, distances) if distance <= radius]
+        records = []
+        for position in order_by_distance([distance for i, distance in within_radius]):
+            i, distance = within_radius[position]
+            record = self._get_record(i)
+            record['distance'] = distance
+            records.append(record)
+        return records
+
+    def close(self):
+        self.snapshot.close()
+
+
+# Return the index of SPATIAL_INDEX_SNAPSHOT, or None if it is not configured or cannot be loaded
+def get_spatial_index():
+    global _spatial_index, _spatial_index_loaded
+    if not _spatial_index_loaded:
+        with _spatial_index_lock:
+            if not _spatial_index_loaded and SPATIAL_INDEX_SNAPSHOT is not None:
+                try:
+                    _spatial_index = SpatialIndex(SPATIAL_INDEX_SNAPSHOT)
+                except (IOError, OSError, ValueError, struct.error) as e:
+                    logger.warning("Unable to load the spatial index snapshot " + SPATIAL_INDEX_SNAPSHOT + ": " + str(e))
+            _spatial_index_loaded = True
+    return _spatial_index
+
+
+# Answer a queryGeoDatabase query from the index, with merchant records as filter_merchant_source_and_category expects
+# Returns None if there is no index, so that the caller falls back to the geo database
+@timed("spatial_index_query")
+def query_spatial_index(search_center_details):
+    spatial_index = get_spatial_index()
+    if spatial_index is None:
+        return None
+    search_radius = search_center_details.get('searchRadius', SPATIAL_INDEX_DEFAULT_RADIUS)
+    return {'searchRadius': search_radius,
+            'locations': spatial_index.query(float(search_center_details['latitude']),
+                                             float(search_center_details['longitude']), search_radius)}
+
+
+def reset_spatial_index():
+    global _spatial_index, _spatial_index_loaded
+    with _spatial_index_lock:
+        if _spatial_index is not None:
+            _spatial_index.close()
+        _spatial_index, _spatial_index_loaded = None, False
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Write a spatial index snapshot of the merchants.")
+    parser.add_argument("merchants", help="Merchants in the queryGeoDatabase format, a json list or {\"locations\": [...]}")
+    parser.add_argument("snapshot", help="Path of the snapshot to write, e.g. SPATIAL_INDEX_SNAPSHOT")
+    parser.add_argument("--cell-size", type=float, default=SPATIAL_INDEX_CELL_SIZE, help="Metres, side of the grid cells")
+    arguments = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    with open(arguments.merchants) as merchants_file:
+        merchant_dump = json.load(merchants_file)
+    write_spatial_index_snapshot(merchant_dump['locations'] if isinstance(merchant_dump, dict) else merchant_dump,
+                                 arguments.snapshot, arguments.cell_size)
@@ -0,0 +1,973 @@
+import copy
+import io
+import json
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import unittest
+import zlib
+
+import telegramHandlerBenchmark  # Sets up the environment the handler modules read on import, and provides the fakes
+import telegramHandler
+import telegramHandlerClients
+import telegramHandlerDBWriter
+import telegramHandlerDispatch
+import telegramHandlerGeoCache
+import telegramHandlerOutbound
+import telegramHandlerPayload
+import telegramHandlerRender
+import telegramHandlerSessionCache
+import telegramHandlerSpatialIndex
+import telegramHandlerUserCache
+import telegramHandlerWorker
+import telegramHandlerHelper
+import telegramHandlerCodec
+from telegramHandlerBenchmark import BENCHMARK_TELEGRAM_ID, FakeBotApiServer, FakeConditionalCheckFailed, FakeResponse, create_event, \
+    register_fake_clients
+
+# Test configurations
+OTHER_SEARCH_CENTER = {"latitude": 1.3006, "longitude": 103.8390}  # Orchard, the cached result is not sorted for it
+SOURCES_FILTERS = [None, [1], [2, 3], [1, 2, 3], []]
+ACKNOWLEDGEMENT_WAIT = 2  # Seconds the cache read waits for answerCallbackQuery to reach the fake Bot API
+CACHE_WRITE_LATENCY = 0.2  # Seconds the cache write takes, so that it is still running when the reply is sent
+LOCATION_SEARCH_RADIUS = 1000  # Radius queryGeoDatabase searches when a location is sent
+GEO_CELL_TABLE_NAME = "GeoCellCache"
+NEARBY_SEARCH_CENTER = {"latitude": 1.2840, "longitude": 103.8595}  # In the same geohash cell as SEARCH_CENTER
+NEARBY_TELEGRAM_ID = 1004  # Searches from NEARBY_SEARCH_CENTER
+SNAPSHOT_TELEGRAM_IDS = [1001, 1002]  # Registered when the bloom snapshot was written
+OTHER_CONTAINER_TELEGRAM_ID = 1003  # Registered by another container after the snapshot
+USER_CACHE_NEGATIVE_TTL = 0.05  # Seconds, short so that the rejections expire within the test
+UPDATE_PROCESSING_TIME = 0.05  # Seconds each update takes in the scheduler tests
+THROTTLED_RETRY_AFTER = 1  # Seconds of the retry_after answered to the first answerCallbackQuery
+VIEW_STATE_TABLE_NAME = "ViewState"
+OTHER_CONTAINER_SEARCH_RADIUS = 2000  # Radius set by another container's tap
+REGISTRY_TEST_KEY = "test.client"
+UNREGISTERED_TABLE_NAME = "Unregistered"  # Built by boto3, without a request being made
+RENDER_TAPS = [("page turn", "2"), ("page turn", "3"), ("page turn", "2"), ("source filter", "CITI"), ("page turn", "2"),
+               ("source filter", "CITI"), ("page turn", "2"), ("radius change", "1500"), ("page turn", "2")]
+REGISTRY_THREADS = 8
+REGISTRY_CALLS = 500  # Per thread
+SPATIAL_INDEX_CATALOGUE_RADIUS = 2000  # Metres, half the side of the square the snapshot merchants are spread over
+SPATIAL_INDEX_CELL_SIZE = 200  # Metres, small so that the queries cover many cells
+SPATIAL_INDEX_RADII = [100, 1000, 10000]  # The largest covers every cell from any corner
+VIEW_STATE_TAPS = [("source filter", "CITI"), ("page turn", "2"), ("radius change", "1500"), ("source filter", "OCBC"),
+                   ("page turn", "2"), ("source filter", "CITI"), ("page turn", "1")]  # The radius change is a new search
+PAYLOAD_MERCHANT_NAMES = [u"Caf\u00e9 \u5496\u5561", u"\U0001F35C Ramen", u"Kopi \"Tiam\" \\ 24h"]  # Multibyte and escaped
+PAYLOAD_OTHER_KEYS = {"fetchedRadius": 1555.42, "scale": -1.5e-3, "count": 12345, "isComplete": True, "next": None,
+                      "bounds": {"north": 1.3, "south": [1.2, -0.5e2]}}  # Tokens that a chunk boundary may split
+PAYLOAD_CHUNK_SIZES = list(range(1, 24)) + [64, 1000]
+OPTIONAL_MODULES = ["telegramHandlerGeoCache", "telegramHandlerOutbound", "telegramHandlerPayload", "telegramHandlerPrefetch",
+                    "telegramHandlerSessionCache", "telegramHandlerSpatialIndex", "cProfile", "pstats", "mmap"]
+OPTIONAL_FEATURE_FLAGS = ["GEO_CELL_CACHE", "TELEGRAM_SCHEDULER", "PAYLOAD_STREAMING", "PREFETCH", "SESSION_CACHE",
+                          "SPATIAL_INDEX_SNAPSHOT", "PROFILE_SAMPLE_RATE", "PROFILE_CHAT_IDS"]
+
+
+# A. Pagination Tests #########
+
+class SelectResultsPageTest(unittest.TestCase):  # select_results_page against the filter, sort and paginate chain it replaced
+    def assert_same_page(self, json_response, page_number, sources_filter, center_lat_lng):
+        expected_page, expected_sources = telegramHandlerBenchmark._select_results_page_chained(
+            copy.deepcopy(json_response), page_number, sources_filter, center_lat_lng)
+        page, sources_available = telegramHandlerHelper.select_results_page(
+            copy.deepcopy(json_response), page_number, sources_filter, center_lat_lng)
+        page.pop('searchId', None)
+        page.pop('sourcesFilter', None)
+        self.assertEqual(expected_page, page)
+        self.assertEqual(sorted(expected_sources), sorted(sources_available))
+
+    def assert_same_pages(self, json_response, center_lat_lng=telegramHandlerBenchmark.SEARCH_CENTER):
+        num_pages = len(json_response['locations']) // telegramHandlerHelper.MAX_NUM_RESULTS_PER_PAGE + 1
+        page_numbers = sorted(set([1, 2, num_pages // 2, num_pages, num_pages + 1]) - set([0]))  # Up to past the last page
+        for sources_filter in SOURCES_FILTERS:
+            for page_number in page_numbers:
+                self.assert_same_page(json_response, page_number, sources_filter, center_lat_lng)
+
+    def test_empty_result(self):
+        self.assert_same_pages(telegramHandlerBenchmark.create_cached_result(0))
+
+    def test_small_result(self):
+        self.assert_same_pages(telegramHandlerBenchmark.create_cached_result(5))
+
+    def test_large_result(self):
+        self.assert_same_pages(telegramHandlerBenchmark.create_cached_result(1000))
+
+    def test_page_overflow(self):
+        json_response = telegramHandlerBenchmark.create_cached_result(200)
+        for page_number in [20, 21, 100]:
+            self.assert_same_page(json_response, page_number, None, telegramHandlerBenchmark.SEARCH_CENTER)
+            self.assert_same_page(json_response, page_number, [2], telegramHandlerBenchmark.SEARCH_CENTER)
+
+    def test_other_search_center(self):
+        self.assert_same_pages(telegramHandlerBenchmark.create_cached_result(200), OTHER_SEARCH_CENTER)
+
+    def test_partly_sorted_result(self):
+        json_response = telegramHandlerHelper.normalise_results(telegramHandlerBenchmark.create_synthetic_merchants(200))
+        json_response = telegramHandlerHelper.filter_merchant_source_and_category(json_response)[0]
+        json_response = telegramHandlerHelper.sort_results_by_distance(
+            json_response, telegramHandlerBenchmark.SEARCH_CENTER, top_k=telegramHandlerHelper.MAX_NUM_RESULTS_PER_PAGE)
+        self.assert_same_pages(json_response)
+
+
+# B. Dispatch Tests #########
+
+class DispatchTest(unittest.TestCase):  # lambda_handler against a local fake Bot API, with the stages on the pool or inline
+    def setUp(self):
+        telegramHandlerBenchmark._reset_handler_caches()
+        self.fakes = register_fake_clients(5, fake_telegram=False)
+        self.bot_api = FakeBotApiServer()
+        self.base_url, self.pool_size = telegramHandler.BASE_URL, telegramHandlerDispatch.DISPATCH_POOL_SIZE
+        telegramHandler.BASE_URL = self.bot_api.url + "/bot" + telegramHandler.TOKEN
+        self.error_counter = telegramHandlerBenchmark._ErrorCounter()
+        logging.getLogger().addHandler(self.error_counter)
+
+    def tearDown(self):
+        logging.getLogger().removeHandler(self.error_counter)
+        telegramHandler.BASE_URL, telegramHandlerDispatch.DISPATCH_POOL_SIZE = self.base_url, self.pool_size
+        self.bot_api.shutdown()
+
+    def get_sent_methods(self):
+        with self.bot_api.lock:
+            return [method for method, fields in self.bot_api.requests]
+
+    # The cache read of a callback waits for answerCallbackQuery to arrive, so it fails unless the acknowledgement is sent
+    # before the read, or while the read is in progress
+    def assert_acknowledged_before_read(self):
+        telegramHandler.lambda_handler(create_event("location"), None)
+        cache_table = self.fakes['cache_table']
+        get_item, acknowledged = cache_table.get_item, []
+
+        def observed_get_item(Key):
+            deadline = time.time() + ACKNOWLEDGEMENT_WAIT
+            while "answerCallbackQuery" not in self.get_sent_methods() and time.time() < deadline:
+                time.sleep(0.005)
+            acknowledged.append("answerCallbackQuery" in self.get_sent_methods())
+            return get_item(Key)
+        cache_table.get_item = observed_get_item
+
+        telegramHandler.lambda_handler(create_event("page turn"), None)
+        self.assertEqual([True], acknowledged)
+        self.assertEqual(sorted(["sendMessage", "answerCallbackQuery", "editMessageText"]), sorted(self.get_sent_methods()))
+        self.assertEqual(0, self.error_counter.num_errors)
+
+    # The reply is only sent once the result is written, as the tap that follows may reach another container
+    def assert_written_before_reply(self):
+        cache_table = self.fakes['cache_table']
+        put_item, written_times = cache_table.put_item, []
+
+        def slow_put_item(Item):
+            time.sleep(CACHE_WRITE_LATENCY)
+            response = put_item(Item)
+            written_times.append(time.time())
+            return response
+        cache_table.put_item = slow_put_item
+
+        telegramHandler.lambda_handler(create_event("location"), None)
+        self.assertEqual(1, len(written_times))
+        self.assertEqual(["sendMessage"], self.get_sent_methods())
+        self.assertGreaterEqual(self.bot_api.call_times[0][1], written_times[0])
+        self.assertEqual(0, self.error_counter.num_errors)
+
+    def assert_missing_result_answered(self):
+        telegramHandler.lambda_handler(create_event("page turn"), None)
+        self.assertEqual(sorted(["answerCallbackQuery", "sendMessage"]), sorted(self.get_sent_methods()))
+        self.assertEqual(0, self.error_counter.num_errors)
+
+    # A stage that fails is logged, the other stages still complete and nothing is left for the next invocation to wait for
+    def assert_failed_stage_handled(self):
+        cache_table = self.fakes['cache_table']
+        put_item = cache_table.put_item
+
+        def failing_put_item(Item):
+            raise IOError("Cache table unavailable")
+        cache_table.put_item = failing_put_item
+
+        self.assertEqual({"statusCode": 200}, telegramHandler.lambda_handler(create_event("location"), None))
+        self.assertEqual(["sendMessage"], self.get_sent_methods())
+        self.assertEqual(1, self.error_counter.num_errors)
+        self.assertEqual([], telegramHandlerDispatch._get_pending_stages())
+
+        cache_table.put_item = put_item
+        telegramHandler.lambda_handler(create_event("location"), None)
+        self.assertIn(BENCHMARK_TELEGRAM_ID, cache_table.items)
+        self.assertEqual(1, self.error_counter.num_errors)
+
+    def test_acknowledged_before_read(self):
+        self.assert_acknowledged_before_read()
+
+    def test_written_before_reply(self):
+        self.assert_written_before_reply()
+
+    def test_missing_result(self):
+        self.assert_missing_result_answered()
+
+    def test_failed_stage(self):
+        self.assert_failed_stage_handled()
+
+    def test_acknowledged_before_read_inline(self):
+        telegramHandlerDispatch.DISPATCH_POOL_SIZE = 0
+        self.assert_acknowledged_before_read()
+
+    def test_written_before_reply_inline(self):
+        telegramHandlerDispatch.DISPATCH_POOL_SIZE = 0
+        self.assert_written_before_reply()
+
+    def test_failed_stage_inline(self):
+        telegramHandlerDispatch.DISPATCH_POOL_SIZE = 0
+        self.assert_failed_stage_handled()
+
+
+# C. Radius Fast Path Tests #########
+
+class RadiusFastPathTest(unittest.TestCase):  # Radius changes served from the merchants fetched for a larger radius
+    def setUp(self):
+        telegramHandlerBenchmark._reset_handler_caches()
+        self.fakes = register_fake_clients(200)
+        self.fakes['lambda'].default_radius = LOCATION_SEARCH_RADIUS
+        self.radius_fast_path, self.invoke_geo_database = telegramHandler.RADIUS_FAST_PATH, telegramHandler.invoke_geo_database
+        self.searched_radii = []  # searchRadius of every geo query, None for the default radius
+
+        def counted_invoke_geo_database(search_center_details):
+            self.searched_radii.append(search_center_details.get('searchRadius'))
+            return self.invoke_geo_database(search_center_details)
+        telegramHandler.RADIUS_FAST_PATH, telegramHandler.invoke_geo_database = True, counted_invoke_geo_database
+
+    def tearDown(self):
+        telegramHandler.RADIUS_FAST_PATH, telegramHandler.invoke_geo_database = self.radius_fast_path, self.invoke_geo_database
+
+    # Change the radius of the chat's last reply and return its cached result
+    def change_radius(self, search_radius):
+        telegramHandler.lambda_handler(create_event("radius change", callback_data=str(search_radius)), None)
+        json_response = telegramHandler.read_results_cache(BENCHMARK_TELEGRAM_ID)
+        self.assertEqual(search_radius, json_response['searchRadius'])
+        return json_response
+
+    def assert_within_radius(self, json_response):
+        num_within_radius = sum(1 for merchant in json_response['locations']
+                                if merchant['distance'] <= json_response['searchRadius'])
+        page = telegramHandlerHelper.select_results_page(json_response, 1)[0]
+        self.assertEqual(num_within_radius, page['totalItems'])
+        self.assertTrue(all(merchant['distance'] <= json_response['searchRadius'] for merchant in page['locations']))
+
+    def test_radius_changes(self):
+        telegramHandler.lambda_handler(create_event("location"), None)
+        self.assertEqual([None], self.searched_radii)
+
+        json_response = self.change_radius(LOCATION_SEARCH_RADIUS - telegramHandlerHelper.RADIUS_CHANGE)
+        self.assertEqual([None], self.searched_radii)  # Within the radius of the location search
+        self.assertEqual(LOCATION_SEARCH_RADIUS, json_response['fetchedRadius'])
+        self.assert_within_radius(json_response)
+
+        json_response = self.change_radius(LOCATION_SEARCH_RADIUS + telegramHandlerHelper.RADIUS_CHANGE)
+        self.assertEqual([None, telegramHandlerHelper.MAX_SEARCH_RADIUS], self.searched_radii)  # One fetch of the largest radius
+        self.assertEqual(telegramHandlerHelper.MAX_SEARCH_RADIUS, json_response['fetchedRadius'])
+        self.assert_within_radius(json_response)
+
+        for search_radius in [2000, telegramHandlerHelper.MAX_SEARCH_RADIUS, telegramHandlerHelper.RADIUS_CHANGE, 1500]:
+            self.assert_within_radius(self.change_radius(search_radius))
+        self.assertEqual([None, telegramHandlerHelper.MAX_SEARCH_RADIUS], self.searched_radii)
+        self.assertEqual(2, self.fakes['lambda'].calls['invoke'])
+
+    def test_new_location(self):
+        telegramHandler.lambda_handler(create_event("location"), None)
+        self.change_radius(telegramHandlerHelper.MAX_SEARCH_RADIUS)
+        telegramHandler.lambda_handler(create_event("location"), None)  # The merchants fetched before are not reused
+        json_response = self.change_radius(LOCATION_SEARCH_RADIUS + telegramHandlerHelper.RADIUS_CHANGE)
+        self.assertEqual([None, telegramHandlerHelper.MAX_SEARCH_RADIUS, None, telegramHandlerHelper.MAX_SEARCH_RADIUS],
+                         self.searched_radii)
+        self.assert_within_radius(json_response)
+
+
+    # A first page sorted for the largest radius, then narrowed to a radius whose merchants reach past the sorted ones
+    def test_partly_sorted_result(self):
+        json_response = telegramHandlerHelper.normalise_results(telegramHandlerBenchmark.create_synthetic_merchants(
+            2000, radius=telegramHandlerHelper.MAX_SEARCH_RADIUS))
+        json_response = telegramHandlerHelper.filter_merchant_source_and_category(json_response)[0]
+        json_response['fetchedRadius'] = telegramHandlerHelper.MAX_SEARCH_RADIUS
+        sorted_response = telegramHandlerHelper.sort_results_by_distance(
+            copy.deepcopy(json_response), telegramHandlerBenchmark.SEARCH_CENTER)
+        partly_sorted_response = telegramHandlerHelper.sort_results_by_distance(
+            copy.deepcopy(json_response), telegramHandlerBenchmark.SEARCH_CENTER,
+            top_k=telegramHandlerHelper.MAX_NUM_RESULTS_PER_PAGE)
+        sorted_response['searchRadius'] = partly_sorted_response['searchRadius'] = LOCATION_SEARCH_RADIUS
+        expected_names = [merchant['name'] for merchant in telegramHandlerHelper.iterate_results_within_radius(sorted_response)]
+        self.assertGreater(len(expected_names), telegramHandlerHelper.MAX_NUM_RESULTS_PER_PAGE)
+        self.assertTrue(all(merchant['distance'] <= LOCATION_SEARCH_RADIUS for merchant in sorted_response['locations'][
+            :len(expected_names)]))
+
+        names = [merchant['name'] for merchant in telegramHandlerHelper.iterate_results_within_radius(partly_sorted_response)]
+        self.assertEqual(sorted(expected_names), sorted(names))
+        self.assertEqual(expected_names[:telegramHandlerHelper.MAX_NUM_RESULTS_PER_PAGE],
+                         names[:telegramHandlerHelper.MAX_NUM_RESULTS_PER_PAGE])
+
+        completed_response = telegramHandlerHelper.complete_sort_by_distance(partly_sorted_response)
+        self.assertNotIn('sortedCount', completed_response)
+        self.assertEqual(telegramHandlerHelper.MAX_SEARCH_RADIUS, completed_response['fetchedRadius'])
+        self.assertEqual([merchant['name'] for merchant in sorted_response['locations']],
+                         [merchant['name'] for merchant in completed_response['locations']])
+        self.assertEqual(expected_names, [merchant['name'] for merchant in
+                                          telegramHandlerHelper.iterate_results_within_radius(completed_response)])
+        for page_number in [1, 2, len(expected_names) // telegramHandlerHelper.MAX_NUM_RESULTS_PER_PAGE + 1]:
+            self.assertEqual(telegramHandlerHelper.select_results_page(sorted_response, page_number),
+                             telegramHandlerHelper.select_results_page(partly_sorted_response, page_number))
+
+
+# D. Geo Cell Cache Tests #########
+
+class GeoCellCacheTest(unittest.TestCase):  # Geo cell cache in memory and in a fake dynamodb table
+    def setUp(self):
+        telegramHandlerBenchmark._reset_handler_caches()
+        self.table_name, self.geo_cell_cache_dynamodb = telegramHandlerDBWriter.geo_cell_cache_database_table, \
+            telegramHandlerGeoCache.GEO_CELL_CACHE_DYNAMODB
+        telegramHandlerDBWriter.geo_cell_cache_database_table = GEO_CELL_TABLE_NAME
+        telegramHandlerGeoCache.GEO_CELL_CACHE_DYNAMODB = True
+        self.fakes = register_fake_clients(0)
+        self.queries = []  # searchRadius of every geo query
+        self.max_returned_radius = telegramHandlerHelper.MAX_SEARCH_RADIUS  # Radius the fake geo database searches up to
+
+    def tearDown(self):
+        telegramHandlerDBWriter.geo_cell_cache_database_table = self.table_name
+        telegramHandlerGeoCache.GEO_CELL_CACHE_DYNAMODB = self.geo_cell_cache_dynamodb
+
+    # Stands in for queryGeoDatabase, which answers with the radius it searched
+    def query_geo_database(self, search_center_details):
+        self.queries.append(search_center_details['searchRadius'])
+        return telegramHandlerBenchmark.create_synthetic_merchants(
+            20, search_center_details, min(search_center_details['searchRadius'], self.max_returned_radius))
+
+    def query(self, center_lat_lng, search_radius):
+        return telegramHandlerGeoCache.query_with_geo_cell_cache(dict(center_lat_lng, searchRadius=search_radius),
+                                                                 self.query_geo_database)
+
+    def get_distance_to_cell(self, center_lat_lng):
+        geohash = telegramHandlerGeoCache.encode_geohash(center_lat_lng['latitude'], center_lat_lng['longitude'])
+        (cell_latitude, cell_longitude), cell_radius = telegramHandlerGeoCache.decode_geohash_cell(geohash)
+        return float(telegramHandlerGeoCache.compute_distances([center_lat_lng['latitude']], [center_lat_lng['longitude']],
+                                                               cell_latitude, cell_longitude, "haversine")[0])
+
+    def assert_covers(self, json_response, center_lat_lng, search_radius):
+        self.assertEqual(search_radius, json_response['searchRadius'])
+        self.assertTrue(json_response['fetchedRadius'] >= search_radius)
+        self.assertAlmostEqual(self.queries[-1] - self.get_distance_to_cell(center_lat_lng), json_response['fetchedRadius'])
+
+    def test_shared_between_nearby_searches(self):
+        self.assert_covers(self.query(telegramHandlerBenchmark.SEARCH_CENTER, 1000), telegramHandlerBenchmark.SEARCH_CENTER, 1000)
+        self.assert_covers(self.query(NEARBY_SEARCH_CENTER, 1000), NEARBY_SEARCH_CENTER, 1000)
+        self.assertEqual(1, len(self.queries))
+        self.assertEqual(1, telegramHandlerGeoCache.geo_cell_cache_counters['hits'])
+
+    def test_shared_through_dynamodb(self):
+        json_response = self.query(telegramHandlerBenchmark.SEARCH_CENTER, 1000)
+        item = list(self.fakes['geo_cell_table'].items.values())[0]
+        self.assertEqual(json.loads(json.dumps(json_response['locations'])),
+                         json.loads(zlib.decompress(item['Result'].value).decode("utf8"))['locations'])
+
+        telegramHandlerGeoCache.reset_geo_cell_cache()  # Another container, with the cells in memory gone
+        self.assertEqual(json.loads(json.dumps(json_response)), self.query(telegramHandlerBenchmark.SEARCH_CENTER, 1000))
+        self.assertEqual(1, len(self.queries))
+        self.assertEqual(1, telegramHandlerGeoCache.geo_cell_cache_counters['dynamodb_hits'])
+
+    def test_query_radius_clamped(self):
+        search_radius = telegramHandlerHelper.MAX_SEARCH_RADIUS - telegramHandlerHelper.RADIUS_CHANGE  # Within a cell radius
+        json_response = self.query(telegramHandlerBenchmark.SEARCH_CENTER, search_radius)
+        self.assertEqual([telegramHandlerHelper.MAX_SEARCH_RADIUS], self.queries)
+        self.assert_covers(json_response, telegramHandlerBenchmark.SEARCH_CENTER, search_radius)
+
+        json_response = self.query(telegramHandlerBenchmark.SEARCH_CENTER, telegramHandlerHelper.MAX_SEARCH_RADIUS)
+        self.assertEqual([telegramHandlerHelper.MAX_SEARCH_RADIUS] * 2, self.queries)  # Away from the cell center, not covered
+        self.assertNotIn('fetchedRadius', json_response)
+        self.assertEqual(1, telegramHandlerGeoCache.geo_cell_cache_counters['bypasses'])
+
+    def test_smaller_radius_returned(self):
+        self.max_returned_radius = 1100  # Less than the cell query asks for
+        json_response = self.query(telegramHandlerBenchmark.SEARCH_CENTER, 1000)
+        self.assertEqual(2, len(self.queries))  # The cell result does not cover the search, which is queried as it is
+        self.assertEqual(1000, self.queries[-1])
+        self.assertEqual(1000, json_response['searchRadius'])
+        self.assertNotIn('fetchedRadius', json_response)
+
+
+    # The merchants parsed from a streamed payload are the records kept in the cell, the searches served from it are
+    # sorted for their own search center without changing the distances of the others
+    def test_records_not_shared(self):
+        configured = (telegramHandler.GEO_CELL_CACHE, telegramHandler.PAYLOAD_STREAMING, telegramHandler.SESSION_CACHE)
+        telegramHandler.GEO_CELL_CACHE = telegramHandler.PAYLOAD_STREAMING = telegramHandler.SESSION_CACHE = True
+        try:
+            self.fakes = register_fake_clients(200, telegram_ids=(BENCHMARK_TELEGRAM_ID, NEARBY_TELEGRAM_ID))
+            self.fakes['lambda'].default_radius = LOCATION_SEARCH_RADIUS
+            telegramHandler.lambda_handler(create_event("location"), None)  # Learns the default radius
+            telegramHandler.lambda_handler(create_event("location"), None)
+            json_response = copy.deepcopy(telegramHandlerSessionCache._entries[BENCHMARK_TELEGRAM_ID].json_response)
+            nearby_event = json.loads(create_event("location", NEARBY_TELEGRAM_ID)['body'])
+            nearby_event['message']['location'] = NEARBY_SEARCH_CENTER
+            telegramHandler.lambda_handler({'body': json.dumps(nearby_event)}, None)
+            self.assertEqual(1, telegramHandlerGeoCache.geo_cell_cache_counters['hits'])
+            self.assertEqual(json_response, telegramHandlerSessionCache._entries[BENCHMARK_TELEGRAM_ID].json_response)
+            telegramHandler.lambda_handler(create_event("page turn", callback_data="2"), None)
+            self.assertEqual(json_response['locations'],
+                             telegramHandlerSessionCache._entries[BENCHMARK_TELEGRAM_ID].json_response['locations'])
+        finally:
+            telegramHandler.GEO_CELL_CACHE, telegramHandler.PAYLOAD_STREAMING, telegramHandler.SESSION_CACHE = configured
+            telegramHandlerBenchmark._reset_handler_caches()
+
+
+# E. User Cache Tests #########
+
+class UserBloomSnapshotTest(unittest.TestCase):  # Registrations made after the bloom snapshot by other containers
+    def setUp(self):
+        telegramHandlerUserCache.reset_user_cache()
+        self.snapshot_directory = tempfile.mkdtemp()
+        self.bloom_snapshot, self.negative_ttl = telegramHandlerUserCache.USER_BLOOM_SNAPSHOT, \
+            telegramHandlerUserCache.USER_CACHE_NEGATIVE_TTL
+        telegramHandlerUserCache.USER_BLOOM_SNAPSHOT = os.path.join(self.snapshot_directory, "users.bloom")
+        telegramHandlerUserCache.USER_CACHE_NEGATIVE_TTL = USER_CACHE_NEGATIVE_TTL
+        telegramHandlerUserCache.write_bloom_snapshot(SNAPSHOT_TELEGRAM_IDS, telegramHandlerUserCache.USER_BLOOM_SNAPSHOT)
+        self.registered_ids = set(SNAPSHOT_TELEGRAM_IDS + [OTHER_CONTAINER_TELEGRAM_ID])  # The user table
+        self.lookups = []
+
+    def tearDown(self):
+        telegramHandlerUserCache.USER_BLOOM_SNAPSHOT = self.bloom_snapshot
+        telegramHandlerUserCache.USER_CACHE_NEGATIVE_TTL = self.negative_ttl
+        telegramHandlerUserCache.reset_user_cache()
+        shutil.rmtree(self.snapshot_directory)
+
+    def lookup_user(self, telegram_id):
+        self.lookups.append(telegram_id)
+        return {'TelegramID': telegram_id} if telegram_id in self.registered_ids else None
+
+    def expire_rejections(self):
+        time.sleep(USER_CACHE_NEGATIVE_TTL * 2)
+
+    def test_registered_after_snapshot(self):
+        self.assertFalse(telegramHandlerUserCache.is_registered_user(OTHER_CONTAINER_TELEGRAM_ID, self.lookup_user))
+        self.assertEqual([], self.lookups)  # Rejected by the snapshot without a read
+        self.assertTrue(telegramHandlerUserCache.is_registered_user(SNAPSHOT_TELEGRAM_IDS[0], self.lookup_user))
+
+        self.expire_rejections()
+        self.assertTrue(telegramHandlerUserCache.is_registered_user(OTHER_CONTAINER_TELEGRAM_ID, self.lookup_user))
+        self.assertEqual([SNAPSHOT_TELEGRAM_IDS[0], OTHER_CONTAINER_TELEGRAM_ID], self.lookups)
+
+    def test_unregistered_read_once_rejection_expires(self):
+        unregistered_id = OTHER_CONTAINER_TELEGRAM_ID + 1
+        for is_expired in [False, True, True]:
+            if is_expired:
+                self.expire_rejections()
+            self.assertFalse(telegramHandlerUserCache.is_registered_user(unregistered_id, self.lookup_user))
+        self.assertEqual([unregistered_id] * 2, self.lookups)
+        self.assertEqual(1, telegramHandlerUserCache.user_cache_counters['bloom_rejections'])
+
+    def test_uncached_users_of_batch(self):
+        telegram_ids = SNAPSHOT_TELEGRAM_IDS + [OTHER_CONTAINER_TELEGRAM_ID]
+        self.assertEqual(SNAPSHOT_TELEGRAM_IDS, sorted(telegramHandlerUserCache.get_uncached_users(telegram_ids)))
+        self.assertFalse(telegramHandlerUserCache.is_registered_user(OTHER_CONTAINER_TELEGRAM_ID, self.lookup_user))
+
+        self.expire_rejections()
+        self.assertEqual(sorted(telegram_ids), sorted(telegramHandlerUserCache.get_uncached_users(telegram_ids)))
+
+
+# F. Cold Start Tests #########
+
+class ColdStartTest(unittest.TestCase):  # The modules of the optional features are not imported while they are disabled
+    def setUp(self):
+        self.environment = dict((name, os.environ.pop(name)) for name in OPTIONAL_FEATURE_FLAGS if name in os.environ)
+
+    def tearDown(self):
+        os.environ.update(self.environment)
+
+    def get_loaded_modules(self, statement):
+        return telegramHandlerBenchmark._run_in_fresh_interpreter(["-c", "import json, sys; " + statement + "; print(json.dumps("
+                                                                  "[name for name in " + repr(OPTIONAL_MODULES) + " if name in sys.modules]))"])
+
+    def test_handler_import(self):
+        self.assertEqual([], self.get_loaded_modules("import telegramHandler"))
+
+    def test_batch_handler_import(self):
+        self.assertEqual([], self.get_loaded_modules("import telegramHandlerBatch"))
+
+
+# G. Worker Tests #########
+
+class UpdateSchedulerTest(unittest.TestCase):  # Updates of a chat in order, and nothing started after the shutdown
+    def setUp(self):
+        self.processed_update_ids = []
+        self.lock = threading.Lock()
+
+    def process_update(self, update):
+        time.sleep(UPDATE_PROCESSING_TIME)
+        with self.lock:
+            self.processed_update_ids.append(update["update_id"])
+
+    def submit_updates(self, scheduler, num_chats, num_updates):
+        for update_id in range(num_updates):
+            scheduler.submit(update_id % num_chats, {"update_id": update_id})
+
+    def test_chat_order(self):
+        scheduler = telegramHandlerWorker.UpdateScheduler(self.process_update, num_threads=3)
+        self.submit_updates(scheduler, 3, 12)
+        self.assertTrue(scheduler.shutdown(timeout=5))
+        self.assertEqual(list(range(12)), sorted(self.processed_update_ids))
+        for chat_id in range(3):
+            chat_update_ids = [update_id for update_id in self.processed_update_ids if update_id % 3 == chat_id]
+            self.assertEqual(sorted(chat_update_ids), chat_update_ids)
+        self.assertEqual(12, scheduler.get_committed_offset(12))
+
+    def test_shutdown_timeout(self):
+        scheduler = telegramHandlerWorker.UpdateScheduler(self.process_update, num_threads=2)
+        self.submit_updates(scheduler, 2, 20)
+        self.assertFalse(scheduler.shutdown(timeout=UPDATE_PROCESSING_TIME * 2.5))
+        processed_update_ids = list(self.processed_update_ids)
+        committed_offset = scheduler.get_committed_offset(20)
+        time.sleep(UPDATE_PROCESSING_TIME * 4)
+        self.assertEqual(processed_update_ids, self.processed_update_ids)  # Nothing was started after the shutdown
+        self.assertTrue(all(not thread.is_alive() for thread in scheduler.threads))
+        self.assertEqual(committed_offset, scheduler.get_committed_offset(20))
+        self.assertTrue(set(range(committed_offset)) <= set(processed_update_ids))  # The others are polled again
+
+
+# H. Outbound Tests #########
+
+class TelegramSchedulerTest(unittest.TestCase):  # Calls sent through the outbound scheduler to a fake post function
+    def setUp(self):
+        self.scheduler = telegramHandlerOutbound.TelegramScheduler(num_threads=2)
+        self.sent_times = {}  # Function name to the time it was last sent without a 429
+        self.num_throttled = 0
+        self.throttled_function_name = "answerCallbackQuery"  # Answered 429 the first time it is called
+        self.edits = []  # Text of every edit posted
+        self.lock = threading.Lock()
+
+    def tearDown(self):
+        self.scheduler.stop()
+
+    def post(self, function_name, data):
+        response = FakeResponse()
+        with self.lock:
+            if function_name == self.throttled_function_name and self.num_throttled == 0:
+                self.num_throttled += 1
+                response.status_code = 429
+                response.text = json.dumps({'ok': False, 'error_code': 429,
+                                            'parameters': {'retry_after': THROTTLED_RETRY_AFTER}})
+            elif function_name == telegramHandlerOutbound.EDIT_FUNCTION_NAME and data["text"] in self.edits[-1:]:
+                response.status_code = 400
+                response.text = json.dumps({'ok': False, 'error_code': 400, 'description': "Bad Request: message is not "
+                                            "modified: specified new message content is the same as a current content"})
+            else:
+                self.sent_times[function_name] = time.time()
+            if function_name == telegramHandlerOutbound.EDIT_FUNCTION_NAME:
+                self.edits.append(data["text"])
+        return response
+
+    def edit(self, text):
+        return self.scheduler.submit(telegramHandlerOutbound.EDIT_FUNCTION_NAME,
+                                     {"chat_id": BENCHMARK_TELEGRAM_ID, "message_id": 2, "text": text}, self.post).wait(5)
+
+    def test_throttled_call_without_chat(self):
+        start_time = time.time()
+        answer = self.scheduler.submit("answerCallbackQuery", {"callback_query_id": "1"}, self.post)
+        time.sleep(0.05)  # The 429 is answered before the message is submitted
+        message = self.scheduler.submit("sendMessage", {"chat_id": BENCHMARK_TELEGRAM_ID, "text": "results"}, self.post)
+        self.assertEqual(200, message.wait(5).status_code)
+        self.assertLess(self.sent_times["sendMessage"] - start_time, THROTTLED_RETRY_AFTER)  # Not held up by the 429
+        self.assertEqual(200, answer.wait(5).status_code)
+        self.assertGreaterEqual(self.sent_times["answerCallbackQuery"] - start_time, THROTTLED_RETRY_AFTER)
+        self.assertEqual(1, self.scheduler.counters['throttled'])
+        self.assertEqual(2, self.scheduler.counters['sent'])
+
+    # The chat waits for its retry_after in its lane, the only sender thread sends to the other chats meanwhile
+    def test_throttled_chat(self):
+        self.scheduler.stop()
+        self.scheduler = telegramHandlerOutbound.TelegramScheduler(num_threads=1)
+        self.throttled_function_name = "sendMessage"
+        start_time = time.time()
+        throttled_message = self.scheduler.submit("sendMessage", {"chat_id": BENCHMARK_TELEGRAM_ID, "text": "results"}, self.post)
+        time.sleep(0.05)  # The 429 is answered before the other chat's message is submitted
+        message = self.scheduler.submit("editMessageText", {"chat_id": OTHER_CONTAINER_TELEGRAM_ID, "text": "page"}, self.post)
+        self.assertEqual(200, message.wait(5).status_code)
+        self.assertLess(self.sent_times["editMessageText"] - start_time, THROTTLED_RETRY_AFTER)
+        self.assertEqual(200, throttled_message.wait(5).status_code)
+        self.assertGreaterEqual(self.sent_times["sendMessage"] - start_time, THROTTLED_RETRY_AFTER)
+        self.assertEqual(1, self.scheduler.counters['retried'])
+
+    # An identical edit is only skipped within an invocation, afterwards the message may have been edited elsewhere
+    def test_identical_edits(self):
+        self.scheduler.global_bucket.rate = self.scheduler.global_bucket.burst = 1000  # Not waiting for the rates
+        self.assertEqual(200, self.edit("page 2").status_code)
+        self.assertIsNone(self.edit("page 2"))
+        self.assertEqual(1, self.scheduler.counters['skipped'])
+        self.scheduler.forget_sent_messages()  # By wait_for_sent, at the end of the invocation
+        self.assertEqual(400, self.edit("page 2").status_code)
+        self.assertEqual((1, 1, 0), (self.scheduler.counters['sent'], self.scheduler.counters['unmodified'],
+                                     self.scheduler.counters['failed']))
+        self.assertIsNone(self.edit("page 2"))  # Known to be showing it
+        self.assertEqual(["page 2", "page 2"], self.edits)
+
+
+# I. Session Cache Tests #########
+
+class SessionCacheTest(unittest.TestCase):  # Results kept in memory against the writes of another container
+    def setUp(self):
+        self.configured = (telegramHandler.SESSION_CACHE, telegramHandler.VIEW_STATE_UPDATES,
+                           telegramHandlerDBWriter.view_state_database_table)
+        telegramHandler.SESSION_CACHE, telegramHandler.VIEW_STATE_UPDATES = True, True
+        telegramHandlerDBWriter.view_state_database_table = VIEW_STATE_TABLE_NAME
+        telegramHandlerBenchmark._reset_handler_caches()
+        self.fakes = register_fake_clients(200)
+        telegramHandler.lambda_handler(create_event("location"), None)
+        self.counters = telegramHandlerSessionCache.session_cache_counters
+
+    def tearDown(self):
+        (telegramHandler.SESSION_CACHE, telegramHandler.VIEW_STATE_UPDATES,
+         telegramHandlerDBWriter.view_state_database_table) = self.configured
+        telegramHandlerBenchmark._reset_handler_caches()
+
+    def turn_page(self):
+        telegramHandler.lambda_handler(create_event("page turn", callback_data="2"), None)
+        return telegramHandlerSessionCache._entries[BENCHMARK_TELEGRAM_ID].json_response
+
+    def read_other_result(self):
+        return telegramHandlerCodec.decode_result(telegramHandlerDBWriter.get_from_result_cache(BENCHMARK_TELEGRAM_ID))
+
+    def test_unchanged(self):
+        self.turn_page()  # Read back, the new search was written without its view version
+        self.turn_page()
+        self.turn_page()
+        self.assertEqual((2, 1, 0), (self.counters['hits'], self.counters['misses'], self.counters['stale']))
+
+    def test_other_container_search(self):
+        self.turn_page()
+        other_result = self.read_other_result()
+        other_result['searchId'] = "other container"
+        telegramHandlerDBWriter.write_versioned_result_to_results_cache(BENCHMARK_TELEGRAM_ID, other_result,
+                                                                        other_result['resultVersion'])
+        self.assertEqual("other container", self.turn_page()['searchId'])
+        self.assertEqual(1, self.counters['stale'])
+
+    def test_other_container_view_state(self):
+        self.turn_page()
+        other_result = self.read_other_result()
+        other_result['searchRadius'] = OTHER_CONTAINER_SEARCH_RADIUS
+        telegramHandlerDBWriter._update_view_state_item(BENCHMARK_TELEGRAM_ID, other_result['searchId'],
+                                                        telegramHandlerCodec.encode_view_state(other_result),
+                                                        other_result.get('viewVersion', 0))
+        self.assertEqual(OTHER_CONTAINER_SEARCH_RADIUS, self.turn_page()['searchRadius'])
+        self.assertEqual(1, self.counters['stale'])
+
+    # Within the verify interval the view state of another container is not seen, until the next tap's write fails
+    def test_verify_interval(self):
+        self.turn_page()
+        verify_interval = telegramHandlerSessionCache.SESSION_CACHE_VERIFY_INTERVAL
+        telegramHandlerSessionCache.SESSION_CACHE_VERIFY_INTERVAL = 60
+        try:
+            other_result = self.read_other_result()
+            other_result['searchRadius'] = OTHER_CONTAINER_SEARCH_RADIUS
+            telegramHandlerDBWriter._update_view_state_item(BENCHMARK_TELEGRAM_ID, other_result['searchId'],
+                                                            telegramHandlerCodec.encode_view_state(other_result),
+                                                            other_result.get('viewVersion', 0))
+            version_reads = self.fakes['database'].calls['batch_get_item']
+            self.assertNotEqual(OTHER_CONTAINER_SEARCH_RADIUS, self.turn_page()['searchRadius'])
+            self.assertEqual(version_reads, self.fakes['database'].calls['batch_get_item'])
+            self.assertEqual((1, 0), (self.counters['unverified_hits'], self.counters['stale']))
+
+            telegramHandler.lambda_handler(create_event("source filter", callback_data="CITI"), None)
+            self.assertEqual(1, self.counters['conflicts'])
+            self.assertEqual(OTHER_CONTAINER_SEARCH_RADIUS, self.turn_page()['searchRadius'])
+        finally:
+            telegramHandlerSessionCache.SESSION_CACHE_VERIFY_INTERVAL = verify_interval
+
+
+# J. Client Registry Tests #########
+
+class ClientRegistryTest(unittest.TestCase):  # Clients built once per key and reused by every thread
+    def setUp(self):
+        self.num_built = 0
+        self.lock = threading.Lock()
+        if hasattr(sys, 'setcheckinterval'):  # Python 2 switches threads after every instruction, so that a race shows
+            self.check_interval = sys.getcheckinterval()
+            sys.setcheckinterval(1)
+
+    def tearDown(self):
+        if hasattr(sys, 'setcheckinterval'):
+            sys.setcheckinterval(self.check_interval)
+        with telegramHandlerClients._client_registry_lock:
+            telegramHandlerClients._client_registry.pop(REGISTRY_TEST_KEY, None)
+            telegramHandlerClients.client_counters.pop(REGISTRY_TEST_KEY, None)
+
+    def build_client(self):
+        with self.lock:
+            self.num_built += 1
+        time.sleep(0.01)  # The other threads ask for the client while it is being built
+        return object()
+
+    def get_client(self):
+        return telegramHandlerClients._get_or_build_client(REGISTRY_TEST_KEY, self.build_client)
+
+    def test_concurrent_reuse(self):
+        clients = []
+
+        def get_clients():
+            thread_clients = [self.get_client() for _ in range(REGISTRY_CALLS)]
+            with self.lock:
+                clients.extend(thread_clients)
+        threads = [threading.Thread(target=get_clients) for _ in range(REGISTRY_THREADS)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(1, self.num_built)
+        self.assertEqual(1, len(set(id(client) for client in clients)))
+        self.assertEqual({'built': 1, 'reused': REGISTRY_THREADS * REGISTRY_CALLS - 1},
+                         telegramHandlerClients.client_counters[REGISTRY_TEST_KEY])
+
+    def test_thread_resources(self):
+        get_table = lambda: telegramHandlerClients.get_database_table(
+            telegramHandlerDBWriter.database_type, telegramHandlerDBWriter.database_region, UNREGISTERED_TABLE_NAME)
+        table, other_thread_tables = get_table(), []
+        thread = threading.Thread(target=lambda: other_thread_tables.extend([get_table(), get_table()]))
+        thread.start()
+        thread.join()
+        self.assertIs(table, get_table())
+        self.assertIsNot(table, other_thread_tables[0])
+        self.assertIs(other_thread_tables[0], other_thread_tables[1])
+
+    def test_registered_client(self):
+        fake_client = object()
+        telegramHandlerClients.register_client(REGISTRY_TEST_KEY, fake_client)
+        self.assertIs(fake_client, self.get_client())
+        self.assertEqual(0, self.num_built)
+        telegramHandlerClients.register_client(REGISTRY_TEST_KEY, None)  # Built again
+        self.assertIsNot(fake_client, self.get_client())
+        self.assertEqual(1, self.num_built)
+
+
+# K. Render Cache Tests #########
+
+class RenderCacheTest(unittest.TestCase):  # Memoised pages against pages rendered every time
+    def setUp(self):
+        self.render_page_cache_size = telegramHandlerRender.RENDER_PAGE_CACHE_SIZE
+        telegramHandlerBenchmark._reset_handler_caches()
+
+    def tearDown(self):
+        telegramHandlerRender.RENDER_PAGE_CACHE_SIZE = self.render_page_cache_size
+
+    # Return the replies and edits of a search and its taps, with their text and keyboard
+    def get_replies(self, render_page_cache_size):
+        telegramHandlerRender.RENDER_PAGE_CACHE_SIZE = render_page_cache_size
+        telegramHandlerBenchmark._reset_handler_caches()
+        fakes = register_fake_clients(200)
+        telegramHandler.lambda_handler(create_event("location"), None)
+        for message_type, callback_data in RENDER_TAPS:
+            telegramHandler.lambda_handler(create_event(message_type, callback_data=callback_data), None)
+        return telegramHandlerBenchmark.get_chat_posts(fakes['telegram'].posts)[BENCHMARK_TELEGRAM_ID][0]
+
+    def test_same_replies(self):
+        replies = self.get_replies(self.render_page_cache_size)
+        self.assertGreater(telegramHandlerRender.render_cache_counters['hits'], 0)
+        uncached_replies = self.get_replies(0)
+        self.assertEqual(0, telegramHandlerRender.render_cache_counters['hits'])
+        self.assertEqual(len(RENDER_TAPS) + 1, len(replies))
+        self.assertEqual(uncached_replies, replies)
+
+    def test_page_key(self):
+        json_response = telegramHandlerBenchmark.create_cached_result(200)
+        json_response['searchId'] = "search"
+        pages = [(1, [1, 2, 3], 1000), (2, [1, 2, 3], 1000), (1, [2], 1000), (1, [1, 2, 3], 500)]  # Page, filter, radius
+        for page_number, sources_filter, search_radius in pages:
+            page = telegramHandlerHelper.select_results_page(dict(json_response, searchRadius=search_radius), page_number,
+                                                             sources_filter, telegramHandlerBenchmark.SEARCH_CENTER)[0]
+            self.assertEqual(telegramHandlerHelper.format_json_response(page), telegramHandlerRender.render_page(page))
+            self.assertEqual(telegramHandlerHelper.format_json_response(page), telegramHandlerRender.render_page(page))
+        self.assertEqual({'hits': len(pages), 'misses': len(pages)}, telegramHandlerRender.render_cache_counters)
+
+
+
+# L. Spatial Index Tests #########
+
+class SpatialIndexTest(unittest.TestCase):  # Queries of a snapshot against a linear scan of its merchants
+    @classmethod
+    def setUpClass(cls):
+        cls.snapshot_directory = tempfile.mkdtemp()
+        merchants = telegramHandlerBenchmark.create_synthetic_merchants(500, radius=SPATIAL_INDEX_CATALOGUE_RADIUS)['locations']
+        snapshot_path = os.path.join(cls.snapshot_directory, "merchants.snapshot")
+        telegramHandlerSpatialIndex.write_spatial_index_snapshot(merchants, snapshot_path, SPATIAL_INDEX_CELL_SIZE)
+        cls.spatial_index = telegramHandlerSpatialIndex.SpatialIndex(snapshot_path)
+        cls.records = [telegramHandlerHelper.normalise_merchant(merchant) for merchant in merchants]
+        cls.latitudes = [record['latitude'] for record in cls.records]
+        cls.longitudes = [record['longitude'] for record in cls.records]
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.spatial_index.close()
+        shutil.rmtree(cls.snapshot_directory)
+
+    def assert_same_merchants(self, center_lat_lng):
+        for radius in SPATIAL_INDEX_RADII:
+            expected = telegramHandlerBenchmark._query_linear(self.records, self.latitudes, self.longitudes, center_lat_lng, radius)
+            found = self.spatial_index.query(center_lat_lng['latitude'], center_lat_lng['longitude'], radius)
+            self.assertEqual([record['name'] for record in expected], [record['name'] for record in found])
+            self.assertEqual(expected, found)
+
+    def test_center(self):
+        self.assert_same_merchants(telegramHandlerBenchmark.SEARCH_CENTER)
+
+    def test_edge_cells(self):
+        catalogue = [(min(self.latitudes), max(self.latitudes)), (min(self.longitudes), max(self.longitudes))]
+        for latitude in catalogue[0]:
+            for longitude in catalogue[1]:  # The corners, where the grid ends within the radius
+                self.assert_same_merchants({'latitude': latitude, 'longitude': longitude})
+        self.assert_same_merchants({'latitude': catalogue[0][0], 'longitude': telegramHandlerBenchmark.SEARCH_CENTER['longitude']})
+        self.assert_same_merchants({'latitude': telegramHandlerBenchmark.SEARCH_CENTER['latitude'], 'longitude': catalogue[1][1]})
+
+    def test_outside_catalogue(self):
+        degree_offset = 2 * SPATIAL_INDEX_CATALOGUE_RADIUS / 111320.0  # Past the first and last rows and columns
+        for latitude_sign, longitude_sign in [(-1, -1), (1, 1), (-1, 1), (0, -1)]:
+            self.assert_same_merchants({
+                'latitude': telegramHandlerBenchmark.SEARCH_CENTER['latitude'] + latitude_sign * degree_offset,
+                'longitude': telegramHandlerBenchmark.SEARCH_CENTER['longitude'] + longitude_sign * degree_offset})
+
+    def test_merchant_location(self):
+        record = self.records[0]  # Found at a radius of 0
+        found = self.spatial_index.query(record['latitude'], record['longitude'], 0)
+        self.assertIn(record['name'], [merchant['name'] for merchant in found])
+
+
+
+# M. View State Tests #########
+
+class ViewStateTest(unittest.TestCase):  # Filter and radius changes written to the view state table apart from the result
+    def setUp(self):
+        self.configured = (telegramHandler.SESSION_CACHE, telegramHandler.VIEW_STATE_UPDATES,
+                           telegramHandlerDBWriter.view_state_database_table, telegramHandlerDBWriter.get_from_result_cache)
+        telegramHandler.SESSION_CACHE = False
+        self.set_view_state_table(VIEW_STATE_TABLE_NAME)
+
+    def tearDown(self):
+        (telegramHandler.SESSION_CACHE, telegramHandler.VIEW_STATE_UPDATES,
+         telegramHandlerDBWriter.view_state_database_table, telegramHandlerDBWriter.get_from_result_cache) = self.configured
+        telegramHandlerBenchmark._reset_handler_caches()
+
+    def set_view_state_table(self, table_name):
+        telegramHandlerDBWriter.view_state_database_table = table_name
+        telegramHandler.VIEW_STATE_UPDATES = table_name is not None
+        telegramHandlerBenchmark._reset_handler_caches()
+        self.fakes = register_fake_clients(200)
+        telegramHandler.lambda_handler(create_event("location"), None)
+
+    def get_view_state_item(self):
+        return self.fakes['view_state_table'].items.get(BENCHMARK_TELEGRAM_ID)
+
+    def test_version_check(self):
+        update = lambda search_radius, expected_version: telegramHandlerDBWriter._update_view_state_item(
+            BENCHMARK_TELEGRAM_ID, "search", json.dumps({'searchRadius': search_radius}), expected_version)
+        self.assertEqual(1, update(1000, 0))  # Created
+        self.assertRaises(FakeConditionalCheckFailed, update, 1500, 0)
+        self.assertEqual(2, update(1500, 1))
+        self.assertRaises(FakeConditionalCheckFailed, update, 2000, 1)
+        self.assertRaises(FakeConditionalCheckFailed, update, 2000, 3)
+        self.assertEqual({'searchRadius': 1500}, json.loads(self.get_view_state_item()['ViewState']))
+        self.assertEqual(3, update(2000, None))  # Unconditional, as written by flush_coalesced_results
+        self.assertEqual(3, self.get_view_state_item()['ViewVersion'])
+
+    # A tap of the chat on another container writes its view state between the read and the write of this tap
+    def test_conflicting_tap(self):
+        telegramHandler.lambda_handler(create_event("source filter", callback_data="CITI"), None)
+        get_from_result_cache, other_results = telegramHandlerDBWriter.get_from_result_cache, []
+
+        def raced_get_from_result_cache(chat_id):
+            item = get_from_result_cache(chat_id)
+            other_result = telegramHandlerCodec.decode_result(dict(item))
+            other_result['searchRadius'] = OTHER_CONTAINER_SEARCH_RADIUS
+            other_results.append(other_result)
+            telegramHandlerDBWriter.write_view_state_to_results_cache(chat_id, other_result)
+            return item
+        telegramHandlerDBWriter.get_from_result_cache = raced_get_from_result_cache
+        puts_before, error_counter = self.fakes['cache_table'].calls['put_item'], telegramHandlerBenchmark._ErrorCounter()
+        logging.getLogger().addHandler(error_counter)
+        try:
+            telegramHandler.lambda_handler(create_event("source filter", callback_data="OCBC"), None)
+        finally:
+            logging.getLogger().removeHandler(error_counter)
+            telegramHandlerDBWriter.get_from_result_cache = get_from_result_cache
+
+        self.assertEqual(1, len(other_results))
+        self.assertGreater(error_counter.num_errors, 0)  # The write_view_state stage failed its version check
+        self.assertEqual(other_results[0]['viewVersion'] + 1, self.get_view_state_item()['ViewVersion'])  # Only its write
+        self.assertEqual(puts_before, self.fakes['cache_table'].calls['put_item'])
+        json_response = telegramHandler.read_results_cache(BENCHMARK_TELEGRAM_ID)
+        self.assertEqual(OTHER_CONTAINER_SEARCH_RADIUS, json_response['searchRadius'])
+        self.assertEqual(sorted(other_results[0]['sourcesFilter']), sorted(json_response['sourcesFilter']))
+        self.assertRaises(FakeConditionalCheckFailed, telegramHandlerDBWriter.write_view_state_to_results_cache,
+                          BENCHMARK_TELEGRAM_ID, dict(json_response, viewVersion=other_results[0]['viewVersion']))
+
+    # The taps read the result with the view state of the previous taps, and reply as if the result had been rewritten
+    def get_replies(self, table_name):
+        self.set_view_state_table(table_name)
+        for message_type, callback_data in VIEW_STATE_TAPS:
+            telegramHandler.lambda_handler(create_event(message_type, callback_data=callback_data), None)
+        return telegramHandlerBenchmark.get_chat_posts(self.fakes['telegram'].posts)[BENCHMARK_TELEGRAM_ID][0]
+
+    def test_merged_read(self):
+        replies = self.get_replies(VIEW_STATE_TABLE_NAME)
+        self.assertEqual(2, self.fakes['cache_table'].calls['put_item'])  # Only the searches, the filters are in the view state
+        self.assertEqual(3, self.get_view_state_item()['ViewVersion'])
+        self.assertEqual(replies, self.get_replies(None))
+
+    def test_previous_search_view_state(self):
+        telegramHandler.lambda_handler(create_event("source filter", callback_data="CITI"), None)
+        telegramHandler.lambda_handler(create_event("location"), None)  # The view state item is left from the search before
+        self.assertIsNotNone(self.get_view_state_item())
+        json_response = telegramHandler.read_results_cache(BENCHMARK_TELEGRAM_ID)
+        cached_result = telegramHandlerCodec.decode_result(self.fakes['cache_table'].items[BENCHMARK_TELEGRAM_ID])
+        self.assertEqual(cached_result['sourcesFilter'], json_response['sourcesFilter'])
+        self.assertEqual(1, json_response['viewVersion'])
+
+
+
+# N. Payload Tests #########
+
+class PayloadStreamingTest(unittest.TestCase):  # Payloads parsed from small chunks against the payload parsed whole
+    def create_payload(self, indent=None):
+        json_response = telegramHandlerBenchmark.create_synthetic_merchants(12)
+        for i, merchant in enumerate(json_response['locations']):
+            merchant['Name']['S'] = PAYLOAD_MERCHANT_NAMES[i % len(PAYLOAD_MERCHANT_NAMES)] + u" " + str(i)
+        json_response.update(PAYLOAD_OTHER_KEYS)
+        payload = json.dumps(json_response, ensure_ascii=False, indent=indent, separators=(", ", " : "))
+        return payload.encode("utf8") if not isinstance(payload, bytes) else payload
+
+    # The merchants as invoke_lambda_function and update_result_cache make them from the payload parsed whole
+    def parse_whole_payload(self, payload):
+        json_response = json.loads(payload.decode("utf8"))
+        json_response['locations'] = telegramHandlerHelper.filter_merchant_source_and_category(
+            telegramHandlerHelper.normalise_results(json_response))[0]['locations']
+        return json_response
+
+    def assert_same_parse(self, payload):
+        expected = self.parse_whole_payload(payload)
+        for chunk_size in PAYLOAD_CHUNK_SIZES:  # Every boundary within the multibyte characters, tokens and whitespace
+            self.assertEqual(expected, telegramHandlerPayload.parse_geo_payload(io.BytesIO(payload), chunk_size))
+
+    def test_compact_payload(self):
+        self.assert_same_parse(json.dumps(telegramHandlerBenchmark.create_synthetic_merchants(12)).encode("utf8"))
+
+    def test_multibyte_payload(self):
+        payload = self.create_payload()
+        self.assertNotEqual(len(payload), len(payload.decode("utf8")))
+        self.assertGreater(len(self.parse_whole_payload(payload)['locations']), 0)
+        self.assert_same_parse(payload)
+
+    def test_whitespace_payload(self):
+        self.assert_same_parse(b" \r\n" + self.create_payload(indent=2) + b"\n\t ")
+
+    def test_empty_payload(self):
+        self.assert_same_parse(b'{"searchRadius": 1000, "locations": [ ]}')
+        self.assertEqual({}, telegramHandlerPayload.parse_geo_payload(io.BytesIO(b" { } "), 1))
+
+    def test_truncated_payload(self):
+        payload = self.create_payload()
+        for end in [len(payload) // 2, len(payload) - 1]:
+            self.assertRaises(ValueError, telegramHandlerPayload.parse_geo_payload, io.BytesIO(payload[:end]), 7)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,160 @@
+from collections import OrderedDict
+import base64
+import hashlib
+import json
+import math
+import os
+import struct
+import threading
+import time
+import logging
+
+# User cache configurations
+USER_CACHE_TTL = int(os.environ.get('USER_CACHE_TTL', 3600))  # Seconds a registered user is trusted without a read
+USER_CACHE_NEGATIVE_TTL = int(os.environ.get('USER_CACHE_NEGATIVE_TTL', 30))  # Short, so that new registrations take effect
+USER_CACHE_SIZE = int(os.environ.get('USER_CACHE_SIZE', 10000))  # Number of telegram ids kept in memory
+USER_BLOOM_SNAPSHOT = os.environ.get('USER_BLOOM_SNAPSHOT')  # Optional path to a bloom filter of the registered telegram ids
+USER_BLOOM_MAX_AGE = int(os.environ.get('USER_BLOOM_MAX_AGE', 3600))  # Older snapshots are ignored, the ids they reject are read once their rejection expires
+USER_BLOOM_FALSE_POSITIVE_RATE = 0.01
+
+logger = logging.getLogger()
+
+# The users are kept at module level so that they are reused across invocations on a warm container
+_users = OrderedDict()  # Telegram id to (expiry time, is registered), least recently used first
+_users_lock = threading.Lock()
+_bloom_filter = None  # (num_bits, num_hashes, bits, created at), loaded on first use
+_bloom_filter_loaded_at = None
+_registered_since_snapshot = set()  # Registrations made by this container, which the snapshot may not contain yet
+user_cache_counters = {'hits': 0, 'negative_hits': 0, 'bloom_rejections': 0, 'misses': 0}
+
+
+# A. Bloom Filter Related Methods #########
+
+# Return the bit positions of the telegram id, using double hashing over a single md5 digest
+def _get_bloom_positions(telegram_id, num_bits, num_hashes):
+    first_hash, second_hash = struct.unpack("<QQ", hashlib.md5(str(int(telegram_id)).encode("utf8")).digest())
+    return [(first_hash + i * second_hash) % num_bits for i in range(num_hashes)]
+
+
+# Create a bloom filter snapshot of the telegram ids, e.g. from telegramHandlerDBWriter.scan_user_table_ids(), at path
+def write_bloom_snapshot(telegram_ids, path, false_positive_rate=USER_BLOOM_FALSE_POSITIVE_RATE):
+    num_ids = max(len(telegram_ids), 1)
+    num_bits = int(math.ceil(-num_ids * math.log(false_positive_rate) / (math.log(2) ** 2)))
+    num_hashes = max(int(round(float(num_bits) / num_ids * math.log(2))), 1)
+    bits = bytearray((num_bits + 7) // 8)
+
+    for telegram_id in telegram_ids:
+        for position in _get_bloom_positions(telegram_id, num_bits, num_hashes):
+            bits[position // 8] |= 1 << (position % 8)
+
+    snapshot = {"numBits": num_bits, "numHashes": num_hashes, "createdAt": int(time.time()),
+                "bits": base64.b64encode(bytes(bits)).decode("ascii")}
+    temporary_path = path + ".tmp"
+    with open(temporary_path, "w") as snapshot_file:
+        json.dump(snapshot, snapshot_file)
+    os.rename(temporary_path, path)  # Readers never see a partially written snapshot
+    logger.info("Wrote bloom snapshot of " + str(len(telegram_ids)) + " users to " + path + ".")
+
+
+def _get_bloom_filter():
+    global _bloom_filter, _bloom_filter_loaded_at
+    now = time.time()
+    if USER_BLOOM_SNAPSHOT is None:
+        return None
+    if _bloom_filter_loaded_at is None or now - _bloom_filter_loaded_at > USER_CACHE_NEGATIVE_TTL:  # Pick up refreshed snapshots
+        _bloom_filter_loaded_at = now
+        try:
+            with open(USER_BLOOM_SNAPSHOT) as snapshot_file:
+                snapshot = json.load(snapshot_file)
+            _bloom_filter = (snapshot["numBits"], snapshot["numHashes"], bytearray(base64.b64decode(snapshot["bits"])),
+                             snapshot["createdAt"])
+        except (IOError, OSError, ValueError, KeyError) as e:
+            logger.warning("Unable to load the bloom snapshot " + USER_BLOOM_SNAPSHOT + ": " + str(e))
+            _bloom_filter = None
+    if _bloom_filter is None or now - _bloom_filter[3] > USER_BLOOM_MAX_AGE:
+        return None  # Users registered since a stale snapshot would be rejected
+    return _bloom_filter
+
+
+# Return False if the telegram id is definitely not in the snapshot, True if it may be or if there is no snapshot
+def _may_be_registered(telegram_id):
+    bloom_filter = _get_bloom_filter()
+    if bloom_filter is None or telegram_id in _registered_since_snapshot:
+        return True
+    num_bits, num_hashes, bits, created_at = bloom_filter
+    return all(bits[position // 8] & (1 << (position % 8))
+               for position in _get_bloom_positions(telegram_id, num_bits, num_hashes))
+
+
+# Return True if the telegram id is rejected by the snapshot without a read, cached_user is its entry, expired or not
+# Only ids not seen before are rejected, an id rejected before is read once its rejection expires after
+# USER_CACHE_NEGATIVE_TTL, so that users registered by other containers since the snapshot are not kept out until the next one
+def _is_bloom_rejected(telegram_id, cached_user):
+    return cached_user is None and not _may_be_registered(telegram_id)
+
+
+# B. Membership Cache Related Methods #########
+
+def _set_registered(telegram_id, is_registered):
+    with _users_lock:
+        _users.pop(telegram_id, None)
+        _users[telegram_id] = (time.time() + (USER_CACHE_TTL if is_registered else USER_CACHE_NEGATIVE_TTL), is_registered)
+        while len(_users) > USER_CACHE_SIZE:
+            _users.popitem(last=False)
+
+
+# Return True if the telegram id is registered, lookup_function is called with the telegram id on a cache miss and
+# returns None for unregistered users, e.g. telegramHandlerDBWriter.get_from_user_table
+def is_registered_user(telegram_id, lookup_function):
+    with _users_lock:
+        cached_user = _users.get(telegram_id)
+        if cached_user is not None and cached_user[0] >= time.time():
+            _users[telegram_id] = _users.pop(telegram_id)  # Move to the most recently used end
+            user_cache_counters['hits' if cached_user[1] else 'negative_hits'] += 1
+            return cached_user[1]
+
+    if _is_bloom_rejected(telegram_id, cached_user):
+        user_cache_counters['bloom_rejections'] += 1
+        is_registered = False
+    else:
+        user_cache_counters['misses'] += 1
+        is_registered = lookup_function(telegram_id) is not None
+    _set_registered(telegram_id, is_registered)
+    return is_registered
+
+
+# Return the telegram ids that is_registered_user would look up, e.g. to look them up together for a batch of updates
+def get_uncached_users(telegram_ids):
+    now = time.time()
+    with _users_lock:
+        uncached_users = [(telegram_id, _users.get(telegram_id)) for telegram_id in telegram_ids
+                          if telegram_id not in _users or _users[telegram_id][0] < now]
+    return [telegram_id for telegram_id, cached_user in uncached_users if not _is_bloom_rejected(telegram_id, cached_user)]
+
+
+# Cache the result of looking up the telegram ids together, registered_ids are the ones found in the user table
+def prime_users(telegram_ids, registered_ids):
+    for telegram_id in telegram_ids:
+        _set_registered(telegram_id, telegram_id in registered_ids)
+
+
+# Record a registration made by this container, e.g. by telegramHandlerDBWriter.write_to_user_table
+def mark_user_registered(telegram_id):
+    _set_registered(telegram_id, True)
+    if USER_BLOOM_SNAPSHOT is not None:
+        _registered_since_snapshot.add(telegram_id)
+
+
+def invalidate_user(telegram_id):
+    with _users_lock:
+        _users.pop(telegram_id, None)
+
+
+def reset_user_cache():
+    global _bloom_filter, _bloom_filter_loaded_at
+    with _users_lock:
+        _users.clear()
+    _bloom_filter, _bloom_filter_loaded_at = None, None
+    _registered_since_snapshot.clear()
+    for counter in user_cache_counters:
+        user_cache_counters[counter] = 0
@@ -0,0 +1,226 @@
+from collections import deque
+import json
+import os
+import signal
+import threading
+import time
+import logging
+
+try:
+    import Queue as queue
+except ImportError:  # Python 3
+    import queue
+
+import telegramHandler
+import telegramHandlerBatch
+import telegramHandlerClients
+import telegramHandlerMetrics
+import telegramHandlerProfile
+from telegramHandlerDispatch import wait_for_dispatched
+from telegramHandlerDistance import compute_distances
+
+# Worker configurations
+WORKER_POLL_TIMEOUT = int(os.environ.get('WORKER_POLL_TIMEOUT', 30))  # Seconds getUpdates waits for new updates
+WORKER_THREADS = int(os.environ.get('WORKER_THREADS', 4))  # Updates of different chats processed at the same time
+WORKER_QUEUE_SIZE = int(os.environ.get('WORKER_QUEUE_SIZE', 100))  # Polling stops once this many updates are pending
+WORKER_OFFSET_FILE = os.environ.get('WORKER_OFFSET_FILE', "telegramHandlerWorker.offset")  # Offset kept across restarts
+WORKER_SHUTDOWN_TIMEOUT = float(os.environ.get('WORKER_SHUTDOWN_TIMEOUT', 20))  # Seconds to finish the pending updates
+WORKER_RETRY_DELAY = float(os.environ.get('WORKER_RETRY_DELAY', 1))  # Seconds before polling again after an error, doubled up to 60
+WORKER_PENDING_POLL_DELAY = 1  # Most seconds before polling again when only pending updates were returned
+# Prefetch the next page and radius step while the user reads a reply. Only the worker prefetches, a lambda container is
+# frozen once its handler returns, so its prefetches would make no progress and only hold up the next tap
+PREFETCH = os.environ.get('PREFETCH', "false").lower() == "true"
+ALLOWED_UPDATES = ["message", "callback_query"]
+
+logger = logging.getLogger()  # Configured by telegramHandler
+
+
+# A. Offset Related Methods #########
+
+# Return the offset of the first update that was not processed, or None if the worker has never run
+def read_offset(path=WORKER_OFFSET_FILE):
+    try:
+        with open(path) as offset_file:
+            return int(offset_file.read().strip())
+    except (IOError, OSError, ValueError):
+        return None
+
+
+def write_offset(offset, path=WORKER_OFFSET_FILE):
+    temporary_path = path + ".tmp"
+    with open(temporary_path, "w") as offset_file:
+        offset_file.write(str(offset))
+    os.rename(temporary_path, path)  # A crash never leaves a partially written offset
+
+
+# B. Scheduler Related Methods #########
+
+class UpdateScheduler(object):  # Runs the updates on a pool of threads, the updates of a chat one at a time and in order
+    def __init__(self, process_function, num_threads=WORKER_THREADS, queue_size=WORKER_QUEUE_SIZE):
+        self.process_function = process_function
+        self.capacity = threading.Semaphore(queue_size)  # Submitting blocks once queue_size updates are pending
+        self.lanes = {}  # Chat id to its updates waiting to run, kept while one of its updates is running or waiting
+        self.ready_chats = queue.Queue()  # Chats whose next update can run, None stops a thread
+        self.pending_update_ids = set()
+        self.lock = threading.Lock()
+        self.progress = threading.Condition(self.lock)  # Notified whenever an update is processed
+        self.is_stopping = False  # Set by shutdown, no update is started after it
+        self.threads = [threading.Thread(target=self._run_lanes, name="worker-" + str(i)) for i in range(num_threads)]
+        for thread in self.threads:
+            thread.daemon = True
+            thread.start()
+
+    # Queue the update of the chat, blocking while the queue is full
+    def submit(self, chat_id, update):
+        self.capacity.acquire()
+        with self.lock:
+            self.pending_update_ids.add(update["update_id"])
+            if chat_id in self.lanes:  # Runs after the updates of the chat before it
+                self.lanes[chat_id].append(update)
+            else:
+                self.lanes[chat_id] = deque([update])
+                self.ready_chats.put(chat_id)
+
+    def _run_lanes(self):
+        while True:
+            chat_id = self.ready_chats.get()
+            if chat_id is None:
+                return
+            with self.lock:
+                if self.is_stopping:  # The update stays pending, so that it is polled again after a restart
+                    return
+                update = self.lanes[chat_id].popleft()
+            try:
+                self.process_function(update)
+            except Exception as e:
+                logger.exception("Unable to process update " + str(update["update_id"]) + ": " + str(e))
+            finally:
+                with self.lock:
+                    self.pending_update_ids.discard(update["update_id"])
+                    if self.lanes[chat_id]:
+                        self.ready_chats.put(chat_id)
+                    else:
+                        del self.lanes[chat_id]
+                    self.progress.notify_all()
+                self.capacity.release()
+
+    # Return the offset from which the updates are not all processed, next_offset if they all are
+    def get_committed_offset(self, next_offset):
+        with self.lock:
+            return min(self.pending_update_ids) if self.pending_update_ids else next_offset
+
+    # Wait up to timeout seconds for an update to be processed, if any is pending
+    def wait_for_progress(self, timeout):
+        with self.lock:
+            if self.pending_update_ids:
+                self.progress.wait(timeout)
+
+    # Wait up to timeout seconds for the pending updates, then stop starting new ones and wait for the threads to finish
+    # the updates they are running, up to timeout seconds more, so that the committed offset does not change after it is
+    # written. Return True if every update was processed.
+    def shutdown(self, timeout=WORKER_SHUTDOWN_TIMEOUT):
+        deadline = time.time() + timeout
+        with self.lock:
+            while self.pending_update_ids and time.time() < deadline:
+                self.progress.wait(deadline - time.time())
+            self.is_stopping = True
+        for _ in self.threads:
+            self.ready_chats.put(None)  # Wakes up the idle threads
+        deadline = time.time() + timeout
+        for thread in self.threads:
+            thread.join(max(deadline - time.time(), 0))
+        with self.lock:
+            return not self.pending_update_ids
+
+
+# C. Polling Related Methods #########
+
+# Process an update the way lambda_handler does, errors are logged and the update is not retried
+@telegramHandlerMetrics.instrumented_handler
+@telegramHandlerProfile.profiled_handler(lambda update: [telegramHandlerBatch.get_chat_id(update)])
+def handle_update(update, context=None):
+    try:
+        telegramHandler.process_update(update)
+    except Exception as e:
+        logger.exception("Unable to process update " + str(update.get("update_id")) + ": " + type(e).__name__ + ": " + str(e))
+        telegramHandlerMetrics.add_count("Errors")
+    wait_for_dispatched()
+
+
+# Return the updates from offset, waiting up to timeout seconds for new ones
+def get_updates(offset, timeout=WORKER_POLL_TIMEOUT):
+    data = {"timeout": timeout, "allowed_updates": json.dumps(ALLOWED_UPDATES)}
+    if offset is not None:
+        data["offset"] = offset
+    response = telegramHandlerClients.get_http_session().post(telegramHandler.BASE_URL + "/getUpdates", data,
+                                                              timeout=timeout + 10)
+    reply = response.json()
+    if not reply.get("ok"):
+        raise RuntimeError("getUpdates failed: " + str(reply.get("description")))  # e.g. a webhook is still set
+    return reply["result"]
+
+
+# Build the clients and load the geodesic engine before the first update arrives
+def warm_up():
+    telegramHandlerClients.get_http_session()
+    telegramHandlerClients.get_lambda_client()
+    compute_distances([0.0], [0.0], 0.0, 0.0)
+
+
+# Poll and process updates until stop_event is set, the offset of the processed updates is kept in offset_path
+# getUpdates is always called from the committed offset, so that updates still pending are not confirmed to telegram
+# and are polled again after a crash, the updates already queued are skipped by their update_id
+def run_worker(stop_event=None, process_function=handle_update, offset_path=WORKER_OFFSET_FILE):
+    stop_event = stop_event or threading.Event()
+    telegramHandler.PREFETCH = PREFETCH
+    warm_up()
+    scheduler = UpdateScheduler(process_function)
+    committed_offset = read_offset(offset_path)
+    next_offset = committed_offset  # One after the last update queued
+    retry_delay = WORKER_RETRY_DELAY
+    logger.info("Worker started from offset " + str(committed_offset) + ".")
+
+    while not stop_event.is_set():
+        try:
+            updates = get_updates(committed_offset)
+            retry_delay = WORKER_RETRY_DELAY
+        except Exception as e:
+            logger.error("Unable to poll updates, retrying in " + str(retry_delay) + "s: " + str(e))
+            stop_event.wait(retry_delay)
+            retry_delay = min(retry_delay * 2, 60)
+            continue
+
+        new_updates = [update for update in updates if next_offset is None or update["update_id"] >= next_offset]
+        for update in new_updates:
+            next_offset = update["update_id"] + 1
+            try:
+                chat_id = telegramHandlerBatch.get_chat_id(update)
+            except KeyError:  # Not a message or callback query, nothing to process
+                logger.debug("Skipping update " + str(update["update_id"]) + ".")
+                continue
+            scheduler.submit(chat_id, update)
+
+        if next_offset is not None:
+            committed_offset = scheduler.get_committed_offset(next_offset)
+            write_offset(committed_offset, offset_path)
+        if len(new_updates) == 0 and len(updates) > 0:  # Only updates still pending, which getUpdates returns right away
+            scheduler.wait_for_progress(WORKER_PENDING_POLL_DELAY)
+
+    all_processed = scheduler.shutdown()
+    if telegramHandler.SESSION_CACHE:  # The results held back by the session cache
+        telegramHandler.flush_session_writes()
+    if telegramHandler.TELEGRAM_SCHEDULER:  # The edits are sent in the background, send those still pending
+        import telegramHandlerOutbound
+        telegramHandlerOutbound.wait_for_sent(WORKER_SHUTDOWN_TIMEOUT)
+    if next_offset is not None:
+        write_offset(scheduler.get_committed_offset(next_offset), offset_path)
+    logger.info("Worker stopped, " + ("all updates processed." if all_processed else "pending updates are polled again on restart."))
+    return all_processed
+
+
+if __name__ == "__main__":
+    logging.basicConfig(format="%(asctime)s %(threadName)s %(levelname)s %(message)s")
+    worker_stop_event = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signal_number, frame: worker_stop_event.set())
+    signal.signal(signal.SIGINT, lambda signal_number, frame: worker_stop_event.set())
+    run_worker(worker_stop_event)